@@ -0,0 +1,56 @@
+# -*- mode: python; coding: utf-8 -*-
+
+# Copyright © 2008 by Jeffrey C. Ollie
+#
+# This file is part of Secant.
+#
+# Secant is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Secant is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Secant.  If not, see <http://www.gnu.org/licenses/>.
+
+# Compare the per-byte pseudo_pad() generator against the bulk
+# crypt_body() implementation for body sizes from 64 bytes to 64 KB.
+#
+#   PYTHONPATH=lib python bench/cipher.py
+
+import os
+import sys
+import timeit
+
+from secant import packet
+
+header = b'\xc1\x02\x01\x00\x12\x34\x56\x78\x00\x00\x00\x00'
+secret = b'secret'
+
+def reference_crypt(body):
+    return bytes([data ^ pad for data, pad in zip(body, packet.pseudo_pad(header, secret))])
+
+def bulk_crypt(body):
+    return packet.crypt_body(header, secret, body)
+
+def measure(function, body):
+    timer = timeit.Timer(lambda: function(body))
+    number, elapsed = timer.autorange()
+    return min(timer.repeat(repeat = 3, number = number)) / number
+
+print('{:>8} {:>14} {:>14} {:>8}'.format('size', 'reference us', 'bulk us', 'speedup'))
+
+for size in [64, 256, 1024, 4096, 16384, 65536]:
+    body = os.urandom(size)
+
+    if reference_crypt(body) != bulk_crypt(body):
+        sys.exit('mismatch at {} bytes'.format(size))
+
+    reference = measure(reference_crypt, body)
+    bulk = measure(bulk_crypt, body)
+
+    print('{:>8} {:>14.2f} {:>14.2f} {:>7.1f}x'.format(size, reference * 1e6, bulk * 1e6, reference / bulk))
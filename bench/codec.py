@@ -0,0 +1,387 @@
+# -*- mode: python; coding: utf-8 -*-
+
+# Copyright © 2008 by Jeffrey C. Ollie
+#
+# This file is part of Secant.
+#
+# Secant is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Secant is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Secant.  If not, see <http://www.gnu.org/licenses/>.
+
+# Measure the packet codec: header packing, body encryption, argument
+# parsing and the body packers and unpackers of every packet type,
+# using packets shaped like real traffic.  Every timing of a case is
+# paired with a timing of a calibration loop taken right next to it,
+# and a case's speed is the median over several rounds of its ops/sec
+# divided by the calibration loop's, which takes out both the speed of
+# the machine and bursts of noise from other processes.  allocs/op is
+# the number of memory blocks still held per operation by what it
+# produced (the decoded packet, the encoded body), which is what the
+# server keeps alive for each session in flight.
+#
+#   PYTHONPATH=lib python bench/codec.py                 compare with the baseline
+#   PYTHONPATH=lib python bench/codec.py --save          record a new baseline
+#   PYTHONPATH=lib python bench/codec.py -k author       only cases matching author
+#
+# Each case also records its noise: the spread of its per-round speeds
+# (the median absolute deviation, scaled to match a standard
+# deviation), as a fraction of the median.  The comparison fails when a
+# case runs slower than its baseline by more than --bands times the
+# larger of its noise then and now, or by more than --tolerance if that
+# is wider, or when it holds on to more blocks per operation.  A
+# baseline is best recorded on the machine the comparison will run on,
+# and only re-saved, in a commit of its own, when a case is added or
+# meant to change.
+
+import argparse
+import gc
+import json
+import os
+import statistics
+import sys
+import timeit
+
+from secant import framing
+from secant import packet
+
+secret = b'secret'
+
+def argument_list(pairs):
+    return [packet.Argument(key = key, value = value) for key, value in pairs]
+
+def authorization_pairs(count):
+    pairs = [('service', 'shell'), ('cmd', 'show')]
+    pairs += [('cmd-arg', 'interface{}'.format(i)) for i in range(count - len(pairs))]
+    return pairs[:count]
+
+# A STOP record as sent by a router at the end of a long exec session.
+stop_pairs = [('task_id', '4711'),
+              ('timezone', 'UTC'),
+              ('service', 'shell'),
+              ('start_time', '1500000000'),
+              ('stop_time', '1500086400'),
+              ('elapsed_time', '86400'),
+              ('disc-cause', '1'),
+              ('disc-cause-ext', '1020'),
+              ('pre-session-time', '12'),
+              ('nas-rx-speed', '0'),
+              ('nas-tx-speed', '0'),
+              ('bytes_in', '1234567890'),
+              ('bytes_out', '9876543210'),
+              ('paks_in', '12345678'),
+              ('paks_out', '87654321'),
+              ('priv-lvl', '15'),
+              ('protocol', 'ip'),
+              ('addr', '192.0.2.17')]
+stop_pairs += [('cmd', 'configure terminal interface GigabitEthernet0/{} description uplink-{}'.format(i, i))
+               for i in range(64)]
+
+def fill(request, user = 'someone'):
+    request.secret_key = secret
+    request.session_id = 0x12345678
+    request.seq_no = 1
+    request.priv_lvl = packet.TAC_PLUS_PRIV_LVL_USER
+    request.authen_type = packet.TAC_PLUS_AUTHEN_TYPE_ASCII
+    request.user = user
+    request.port = 'tty0'
+    request.rem_addr = '192.0.2.1'
+    return request
+
+def authentication_start():
+    request = fill(packet.AuthenticationStart())
+    request.action = packet.TAC_PLUS_AUTHEN_LOGIN
+    request.service = packet.TAC_PLUS_AUTHEN_SVC_LOGIN
+    return request
+
+def authentication_reply():
+    reply = packet.AuthenticationReply(reply_to = authentication_start())
+    reply.authentication_status = packet.TAC_PLUS_AUTHEN_STATUS_GETPASS
+    reply.authentication_flags = packet.TAC_PLUS_REPLY_FLAG_NOECHO
+    reply.server_msg = 'Password: '
+    return reply
+
+def authentication_continue():
+    request = packet.AuthenticationContinue()
+    request.secret_key = secret
+    request.session_id = 0x12345678
+    request.seq_no = 3
+    request.authentication_flags = 0
+    request.user_msg = 'correct horse battery staple'
+    return request
+
+def authorization_request(count):
+    request = fill(packet.AuthorizationRequest())
+    request.authen_method = packet.TAC_PLUS_AUTHEN_METH_TACACSPLUS
+    request.authen_service = packet.TAC_PLUS_AUTHEN_SVC_LOGIN
+    request.args = argument_list(authorization_pairs(count))
+    return request
+
+def authorization_response():
+    reply = packet.AuthorizationResponse(reply_to = authorization_request(3))
+    reply.authorization_status = packet.TAC_PLUS_AUTHOR_STATUS_PASS_ADD
+    reply.args = argument_list([('priv-lvl', '15')])
+    return reply
+
+def accounting_request(flags, pairs):
+    request = fill(packet.AccountingRequest())
+    request.accounting_flags = flags
+    request.authen_method = packet.TAC_PLUS_AUTHEN_METH_TACACSPLUS
+    request.authen_service = packet.TAC_PLUS_AUTHEN_SVC_LOGIN
+    request.args = argument_list(pairs)
+    return request
+
+def accounting_reply():
+    reply = packet.AccountingReply(reply_to = accounting_request(packet.TAC_PLUS_ACCT_FLAG_START, stop_pairs[:3]))
+    reply.accounting_status = packet.TAC_PLUS_ACCT_STATUS_SUCCESS
+    return reply
+
+corpus = [('authen_start', authentication_start),
+          ('authen_reply', authentication_reply),
+          ('authen_continue', authentication_continue),
+          ('author_request_1', lambda: authorization_request(1)),
+          ('author_request_10', lambda: authorization_request(10)),
+          ('author_request_100', lambda: authorization_request(100)),
+          ('author_response', authorization_response),
+          ('acct_start', lambda: accounting_request(packet.TAC_PLUS_ACCT_FLAG_START, stop_pairs[:3])),
+          ('acct_stop_large', lambda: accounting_request(packet.TAC_PLUS_ACCT_FLAG_STOP, stop_pairs)),
+          ('acct_reply', accounting_reply)]
+
+authentication_start_sample = authentication_start()
+authorization_request_sample = authorization_request(3)
+accounting_request_sample = accounting_request(packet.TAC_PLUS_ACCT_FLAG_START, stop_pairs[:3])
+
+def decoder(sample):
+    """Return a function that unpacks sample's plaintext body into a
+    fresh packet of the same type."""
+    sample.pack_body()
+    body = sample.plaintext_body
+
+    if isinstance(sample, packet.AuthenticationReply):
+        make = lambda: packet.AuthenticationReply(reply_to = authentication_start_sample)
+    elif isinstance(sample, packet.AuthorizationResponse):
+        make = lambda: packet.AuthorizationResponse(reply_to = authorization_request_sample)
+    elif isinstance(sample, packet.AccountingReply):
+        make = lambda: packet.AccountingReply(reply_to = accounting_request_sample)
+    else:
+        make = type(sample)
+
+    def unpack():
+        decoded = make()
+        decoded.plaintext_body = body
+        decoded.unpack_body()
+        return decoded
+
+    return unpack
+
+def cases():
+    header = fill(packet.AuthorizationRequest())
+    header.length = 64
+    header.pack_header()
+    header_bytes = header.header
+
+    def unpack_header():
+        p = packet.Packet()
+        p.set_header(header_bytes)
+        return p
+
+    yield 'header.unpack', unpack_header
+    def pack_header():
+        header.pack_header()
+        return header.header
+
+    yield 'header.pack', pack_header
+
+    for size in [64, 1024]:
+        p = fill(packet.AuthorizationRequest())
+        p.length = size
+        p.pack_header()
+        p.plaintext_body = os.urandom(size)
+        p.ciphertext_body = os.urandom(size)
+
+        def encrypt(p = p):
+            p.encrypt_body()
+            return p.ciphertext_body
+
+        def decrypt(p = p):
+            p.decrypt_body()
+            return p.plaintext_body
+
+        yield 'encrypt.{}'.format(size), encrypt
+        yield 'decrypt.{}'.format(size), decrypt
+
+    # A read's worth of pipelined requests received into a frame
+    # buffer and split into frames.
+    frames = framing.FrameBuffer()
+    chunk = b''.join(packet.header_struct.pack(0xc0, packet.TAC_PLUS_ACCT, 1, 0, session_id, 64) + os.urandom(64)
+                     for session_id in range(8))
+
+    def receive():
+        frames.feed(chunk)
+        return [header for header, body in frames]
+
+    yield 'frames.receive_8', receive
+
+    yield 'argument.parse', lambda: packet.Argument(b'cmd-arg=running-config')
+
+    # A whole prompt reply, built field by field and from a template.
+    def prompt_fields():
+        reply = authentication_start_sample.get_reply()
+        reply.authentication_status = packet.TAC_PLUS_AUTHEN_STATUS_GETPASS
+        reply.authentication_flags = packet.TAC_PLUS_REPLY_FLAG_NOECHO
+        reply.server_msg = 'Password: '
+        return reply.pack()
+
+    template = packet.ReplyTemplate(packet.TAC_PLUS_AUTHEN_STATUS_GETPASS, packet.TAC_PLUS_REPLY_FLAG_NOECHO, 'Password: ')
+
+    yield 'authen_prompt.fields', prompt_fields
+    yield 'authen_prompt.template', lambda: template.reply(authentication_start_sample).pack()
+
+    for name, build in corpus:
+        sample = build()
+        unpack = decoder(sample)
+        yield '{}.unpack'.format(name), unpack
+
+        # Unpacking may leave AV pairs to be decoded when they are
+        # looked at, so also time unpacking and reading all of them.
+        if hasattr(sample, 'args'):
+            yield '{}.args'.format(name), lambda unpack = unpack: [str(arg) for arg in unpack().args]
+
+        def pack(sample = sample):
+            sample.pack_body()
+            return sample.plaintext_body
+
+        yield '{}.pack'.format(name), pack
+
+def calibration():
+    """A fixed pure Python workload used to scale out changes in the
+    speed of the machine between the baseline and the current run."""
+    total = 0
+    for i in range(100):
+        total += i * i
+    return total
+
+def timer_for(function, duration):
+    timer = timeit.Timer(function)
+    number, elapsed = timer.autorange()
+    return timer, max(1, int(number * duration / elapsed))
+
+def timings(functions, rounds, duration = 0.02):
+    """Return the ops/sec and the calibration-relative speed of each
+    function in each round.  Every round times each function once,
+    right after the calibration loop, so that a burst of noise on a
+    shared machine slows both halves of a pair and hurts one round of
+    every case instead of all rounds of one."""
+    reference, reference_number = timer_for(calibration, duration)
+    timers = {name: timer_for(function, duration) for name, function in functions.items()}
+
+    samples = {name: [] for name in functions}
+    samples['calibration'] = []
+    for i in range(rounds):
+        for name, (timer, number) in timers.items():
+            calibration_speed = reference_number / reference.timeit(reference_number)
+            speed = number / timer.timeit(number)
+            samples[name].append((speed, speed / calibration_speed))
+            samples['calibration'].append((calibration_speed, 1.0))
+    return samples
+
+def summarize(samples):
+    """Reduce one case's samples to its median ops/sec, its median
+    speed relative to the calibration loop and the noise of the
+    latter."""
+    speeds = [speed for speed, relative in samples]
+    relatives = [relative for speed, relative in samples]
+    relative = statistics.median(relatives)
+    deviation = statistics.median(abs(r - relative) for r in relatives)
+    return {'ops_per_sec': round(statistics.median(speeds)),
+            'relative': round(relative, 6),
+            'noise': round(1.4826 * deviation / relative, 4)}
+
+def relative_of(previous, baseline):
+    """Return a baseline entry's calibration-relative speed, working it
+    out from the ops/sec of baselines recorded before it was kept."""
+    if 'relative' in previous:
+        return previous['relative']
+    return previous['ops_per_sec'] / baseline['calibration']['ops_per_sec']
+
+def allocs_per_op(function, count = 1000):
+    results = [None] * count
+    function()
+    gc.collect()
+    gc.disable()
+    try:
+        before = sys.getallocatedblocks()
+        for i in range(count):
+            results[i] = function()
+        after = sys.getallocatedblocks()
+    finally:
+        gc.enable()
+    return (after - before) / count
+
+def main():
+    parser = argparse.ArgumentParser(description = 'packet codec microbenchmarks')
+    parser.add_argument('--baseline', default = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'codec-baseline.json'))
+    parser.add_argument('--save', action = 'store_true', help = 'write the results as the new baseline')
+    parser.add_argument('--tolerance', type = float, default = 0.1, help = 'smallest slowdown counted as a regression, as a fraction')
+    parser.add_argument('--bands', type = float, default = 3.0, help = 'allowed slowdown, in multiples of the measured noise')
+    parser.add_argument('--rounds', type = int, default = 15)
+    parser.add_argument('-k', dest = 'match', default = '', help = 'only run cases whose name contains this')
+    options = parser.parse_args()
+
+    baseline = {}
+    if not options.save and os.path.exists(options.baseline):
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+
+    functions = {name: function for name, function in cases() if options.match in name}
+    samples = timings(functions, options.rounds)
+    functions['calibration'] = calibration
+
+    results = {}
+    regressions = []
+
+    print('{:<26} {:>12} {:>10} {:>12} {:>8} {:>8}'.format('case', 'ops/sec', 'allocs/op', 'baseline', 'change', 'noise'))
+    for name, function in functions.items():
+        result = summarize(samples[name])
+        result['allocs_per_op'] = round(allocs_per_op(function), 1)
+        results[name] = result
+
+        previous = baseline.get(name)
+        if previous is None:
+            print('{:<26} {:>12} {:>10.1f} {:>12} {:>8} {:>+8.1%}'.format(
+                name, result['ops_per_sec'], result['allocs_per_op'], '', '', result['noise']))
+            continue
+
+        change = result['relative'] / relative_of(previous, baseline) - 1
+        noise = max(result['noise'], previous.get('noise', 0))
+        tolerance = max(options.tolerance, options.bands * noise)
+
+        flag = ''
+        if change < -tolerance:
+            flag = ' slower'
+        if result['allocs_per_op'] > previous['allocs_per_op']:
+            flag += ' allocs'
+        if flag:
+            regressions.append(name)
+        print('{:<26} {:>12} {:>10.1f} {:>12} {:>+8.0%} {:>+8.1%}{}'.format(
+            name, result['ops_per_sec'], result['allocs_per_op'], previous['ops_per_sec'], change, noise, flag))
+
+    if options.save:
+        with open(options.baseline, 'w') as f:
+            json.dump(results, f, indent = 2, sort_keys = True)
+            f.write('\n')
+        print('baseline written to {}'.format(options.baseline))
+
+    elif regressions:
+        sys.exit('regressed: {}'.format(', '.join(regressions)))
+
+if __name__ == '__main__':
+    main()
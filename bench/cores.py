@@ -0,0 +1,53 @@
+# -*- mode: python; coding: utf-8 -*-
+
+# Copyright © 2008 by Jeffrey C. Ollie
+#
+# This file is part of Secant.
+#
+# Secant is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Secant is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Secant.  If not, see <http://www.gnu.org/licenses/>.
+
+# Run bin/loadgen.py against a local server once for each server core
+# and compare completed requests per second and latency.  Extra
+# arguments are passed on to loadgen, and cores whose event loop is not
+# installed are skipped.
+#
+#   PYTHONPATH=lib python bench/cores.py [--rate 5000 --duration 10 ...]
+
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+cores = ['twisted', 'asyncio', 'uvloop']
+
+loadgen = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'bin', 'loadgen.py')
+
+def run(core):
+    with tempfile.NamedTemporaryFile(suffix = '.json') as f:
+        subprocess.run([sys.executable, loadgen, '--core', core, '--json', f.name] + sys.argv[1:],
+                       stdout = subprocess.DEVNULL, check = True)
+        return json.load(f)
+
+print('{:<8} {:>9} {:>9} {:>8} {:>9} {:>9}'.format('core', 'done', 'per sec', 'errors', 'p50 ms', 'p99 ms'))
+for core in cores:
+    if core == 'uvloop' and importlib.util.find_spec('uvloop') is None:
+        print('{:<8} not installed'.format(core))
+        continue
+    kinds = run(core)['kinds'].values()
+    completed = sum(kind['completed'] for kind in kinds)
+    print('{:<8} {:>9} {:>9.0f} {:>8} {:>9.2f} {:>9.2f}'.format(
+        core, completed, sum(kind['per_second'] for kind in kinds), sum(kind['errors'] for kind in kinds),
+        max(kind.get('p50_ms', 0) for kind in kinds), max(kind.get('p99_ms', 0) for kind in kinds)))
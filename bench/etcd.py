@@ -0,0 +1,109 @@
+# -*- mode: python; coding: utf-8 -*-
+
+# Copyright © 2008 by Jeffrey C. Ollie
+#
+# This file is part of Secant.
+#
+# Secant is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Secant is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Secant.  If not, see <http://www.gnu.org/licenses/>.
+
+# Drive user lookups at a fixed rate against a local stand-in etcd
+# server and report latency percentiles and the number of TCP
+# connections the server saw, once with a new client per lookup (how
+# find_user used to work) and once with the shared pooled client.
+#
+#   PYTHONPATH=lib python bench/etcd.py [rate] [seconds]
+
+import sys
+import time
+
+from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.internet import task
+
+from secant import etcd
+from secant.test.fake_etcd import FakeEtcdSite
+
+rate = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+duration = float(sys.argv[2]) if len(sys.argv) > 2 else 5.0
+tick = 0.01
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+@defer.inlineCallbacks
+def run(name, site, port, make_client):
+    site.connections = 0
+    latencies = []
+    errors = []
+    outstanding = []
+    url = 'http://127.0.0.1:{}'.format(port.getHost().port)
+
+    def lookup():
+        client = make_client(url)
+        started = time.monotonic()
+        d = client.get('/secant/users/user{}/passwords'.format(len(latencies) % 100))
+        d.addCallback(lambda response: latencies.append(time.monotonic() - started))
+        d.addErrback(errors.append)
+        if client is not shared.get(url):
+            d.addBoth(lambda result: client.close())
+        outstanding.append(d)
+
+    def fire():
+        for i in range(int(rate * tick)):
+            lookup()
+
+    loop = task.LoopingCall(fire)
+    started = time.monotonic()
+    loop.start(tick)
+    yield task.deferLater(reactor, duration, loop.stop)
+    yield defer.DeferredList(outstanding)
+    elapsed = time.monotonic() - started
+
+    print('{:<12} {:>8} {:>10.0f} {:>10.2f} {:>10.2f} {:>8} {:>8}'.format(
+        name, len(latencies), len(latencies) / elapsed,
+        percentile(latencies, 0.50) * 1000, percentile(latencies, 0.99) * 1000,
+        site.connections, len(errors)))
+
+shared = {}
+
+def per_lookup_client(url):
+    return etcd.EtcdClient(reactor, url = url, pool_size = 1)
+
+def pooled_client(url):
+    if url not in shared:
+        shared[url] = etcd.EtcdClient(reactor, url = url, pool_size = 8)
+    return shared[url]
+
+@defer.inlineCallbacks
+def main():
+    site = FakeEtcdSite()
+    for i in range(100):
+        site.etcd.set('/secant/users/user{}/passwords'.format(i), '{}')
+    port = reactor.listenTCP(0, site, interface = '127.0.0.1')
+
+    print('{} lookups/s for {} seconds'.format(rate, duration))
+    print('{:<12} {:>8} {:>10} {:>10} {:>10} {:>8} {:>8}'.format(
+        'client', 'lookups', 'per sec', 'p50 ms', 'p99 ms', 'conns', 'errors'))
+    try:
+        yield run('per-lookup', site, port, per_lookup_client)
+        yield run('pooled', site, port, pooled_client)
+    finally:
+        for client in shared.values():
+            yield client.close()
+        yield port.stopListening()
+        reactor.stop()
+
+reactor.callWhenRunning(main)
+reactor.run()
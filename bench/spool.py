@@ -0,0 +1,79 @@
+# -*- mode: python; coding: utf-8 -*-
+
+# Copyright © 2008 by Jeffrey C. Ollie
+#
+# This file is part of Secant.
+#
+# Secant is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Secant is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Secant.  If not, see <http://www.gnu.org/licenses/>.
+# Submit accounting records to the spool as fast as the sink will take
+# them and report records per second and how many group commits were
+# needed, with and without fsync.
+#
+#   PYTHONPATH=lib python bench/spool.py [records]
+
+import shutil
+import sys
+import tempfile
+import time
+
+from twisted.internet import defer
+from twisted.internet import reactor
+
+from secant import config
+from secant import spool
+
+count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+record = {'record_type': 'http://fedorahosted.org/secant/accounting_record',
+          'time': 0.0,
+          'session_id': 1,
+          'accounting_flags': {'2': 'START'},
+          'authen_method': 'TACACSPLUS',
+          'priv_lvl': 'USER',
+          'authen_service': 'LOGIN',
+          'user': 'someone',
+          'port': 'tty0',
+          'rem_addr': '192.0.2.1',
+          'arguments': {'service': {'value': 'shell', 'is_optional': False}},
+          'av_pairs': ['service=shell']}
+
+@defer.inlineCallbacks
+def run(fsync):
+    directory = tempfile.mkdtemp()
+    settings = dict(config.current.settings,
+                    accounting_spool = directory,
+                    accounting_fsync = fsync,
+                    accounting_queue_limit = count)
+    config.install(config.current.replace(settings = settings))
+
+    sink = spool.AccountingSink(reactor)
+    sink.start()
+    started = time.monotonic()
+    yield defer.gatherResults([sink.submit(dict(record, session_id = i)) for i in range(count)])
+    elapsed = time.monotonic() - started
+    sink.stop()
+    shutil.rmtree(directory)
+
+    print('{:<8} {:>8} {:>10.0f} {:>8} {:>10.2f}'.format(
+        'on' if fsync else 'off', count, count / elapsed, sink.batches, sink.commit_time * 1000 / sink.batches))
+
+@defer.inlineCallbacks
+def main():
+    print('{:<8} {:>8} {:>10} {:>8} {:>10}'.format('fsync', 'records', 'per sec', 'commits', 'ms/commit'))
+    yield run(True)
+    yield run(False)
+    reactor.stop()
+
+reactor.callWhenRunning(main)
+reactor.run()
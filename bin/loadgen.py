@@ -0,0 +1,463 @@
+# -*- mode: python; coding: utf-8 -*-
+
+# Copyright © 2008 by Jeffrey C. Ollie
+#
+# This file is part of Secant.
+#
+# Secant is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Secant is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Secant.  If not, see <http://www.gnu.org/licenses/>.
+
+# Generate TACACS+ load and report throughput and latency.
+#
+# Without --host a complete test setup is started: an in-process etcd
+# stand-in holding --users users, and bin/server.py in a subprocess
+# with a generated configuration pointing at it, so that runs are
+# repeatable without any outside services.
+#
+#   PYTHONPATH=lib python bin/loadgen.py --rate 2000 --duration 10 \
+#       --connections 16 --single-connect --mix login=1,author=4,acct=5
+
+import argparse
+import binascii
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import scrypt
+
+from twisted.internet import defer
+from twisted.internet import protocol
+from twisted.internet import reactor
+from twisted.internet import task
+from twisted.internet.endpoints import TCP4ClientEndpoint
+from twisted.internet.endpoints import connectProtocol
+from twisted.web.client import Agent
+from twisted.web.client import readBody
+
+from secant import framing
+from secant import packet
+from secant.test.fake_etcd import FakeEtcdSite
+
+class Session:
+    """The client side of one TACACS+ session.  start() returns the
+    first request, reply() is given each reply and returns the next
+    request, or None once the session is over."""
+
+    def __init__(self, generator, session_id):
+        self.generator = generator
+        self.session_id = session_id
+        self.started = None
+        self.ok = False
+
+    def prepare(self, request, seq_no = 1):
+        request.secret_key = self.generator.secret
+        request.session_id = self.session_id
+        request.seq_no = seq_no
+        if self.generator.options.single_connect:
+            request.header_flags |= packet.TAC_PLUS_SINGLE_CONNECT_FLAG
+        self.request = request
+        return request
+
+    def decode(self, reply, header, body):
+        reply.set_header(header)
+        reply.set_body(body)
+        return reply
+
+class Login(Session):
+    kind = 'login'
+
+    def start(self):
+        request = packet.AuthenticationStart()
+        request.action = packet.TAC_PLUS_AUTHEN_LOGIN
+        request.priv_lvl = packet.TAC_PLUS_PRIV_LVL_USER
+        request.authen_type = packet.TAC_PLUS_AUTHEN_TYPE_ASCII
+        request.service = packet.TAC_PLUS_AUTHEN_SVC_LOGIN
+        request.user = self.generator.username()
+        request.port = 'tty0'
+        request.rem_addr = '192.0.2.1'
+        return self.prepare(request)
+
+    def reply(self, header, body):
+        reply = self.decode(packet.AuthenticationReply(reply_to = self.request), header, body)
+        if reply.authentication_status == packet.TAC_PLUS_AUTHEN_STATUS_GETPASS:
+            request = packet.AuthenticationContinue()
+            request.authentication_flags = 0
+            request.user_msg = self.generator.options.password
+            return self.prepare(request, seq_no = reply.seq_no + 1)
+        self.ok = reply.authentication_status == packet.TAC_PLUS_AUTHEN_STATUS_PASS
+
+class Authorization(Session):
+    kind = 'author'
+
+    def start(self):
+        request = packet.AuthorizationRequest()
+        request.authen_method = packet.TAC_PLUS_AUTHEN_METH_TACACSPLUS
+        request.priv_lvl = packet.TAC_PLUS_PRIV_LVL_USER
+        request.authen_type = packet.TAC_PLUS_AUTHEN_TYPE_ASCII
+        request.authen_service = packet.TAC_PLUS_AUTHEN_SVC_LOGIN
+        request.user = self.generator.username()
+        request.port = 'tty0'
+        request.rem_addr = '192.0.2.1'
+        request.args = [packet.Argument(key = 'service', value = 'shell'),
+                        packet.Argument(key = 'cmd', value = 'show'),
+                        packet.Argument(key = 'cmd-arg', value = 'running-config')]
+        return self.prepare(request)
+
+    def reply(self, header, body):
+        reply = self.decode(packet.AuthorizationResponse(reply_to = self.request), header, body)
+        self.ok = reply.authorization_status in [packet.TAC_PLUS_AUTHOR_STATUS_PASS_ADD,
+                                                 packet.TAC_PLUS_AUTHOR_STATUS_PASS_REPL]
+
+class Accounting(Session):
+    kind = 'acct'
+
+    def start(self):
+        request = packet.AccountingRequest()
+        request.accounting_flags = random.choice([packet.TAC_PLUS_ACCT_FLAG_START, packet.TAC_PLUS_ACCT_FLAG_STOP])
+        request.authen_method = packet.TAC_PLUS_AUTHEN_METH_TACACSPLUS
+        request.priv_lvl = packet.TAC_PLUS_PRIV_LVL_USER
+        request.authen_type = packet.TAC_PLUS_AUTHEN_TYPE_ASCII
+        request.authen_service = packet.TAC_PLUS_AUTHEN_SVC_LOGIN
+        request.user = self.generator.username()
+        request.port = 'tty0'
+        request.rem_addr = '192.0.2.1'
+        request.args = [packet.Argument(key = 'task_id', value = str(self.session_id)),
+                        packet.Argument(key = 'service', value = 'shell')]
+        return self.prepare(request)
+
+    def reply(self, header, body):
+        reply = self.decode(packet.AccountingReply(reply_to = self.request), header, body)
+        self.ok = reply.accounting_status == packet.TAC_PLUS_ACCT_STATUS_SUCCESS
+
+session_kinds = {kind.kind: kind for kind in [Login, Authorization, Accounting]}
+
+class LoadProtocol(protocol.Protocol):
+    def __init__(self, generator):
+        self.generator = generator
+        self.frames = framing.FrameBuffer()
+        self.sessions = {}
+
+    def send(self, session):
+        self.sessions[session.session_id] = session
+        self.transport.write(session.start().pack())
+
+    def dataReceived(self, data):
+        self.frames.feed(data)
+        for header, body in self.frames:
+            session_id = int.from_bytes(header[4:8], 'big')
+            session = self.sessions.get(session_id)
+            if session is None:
+                continue
+            request = session.reply(bytes(header), bytes(body))
+            if request is None:
+                del self.sessions[session_id]
+                self.generator.finished(self, session)
+            else:
+                self.transport.write(request.pack())
+
+    def connectionLost(self, reason):
+        sessions = list(self.sessions.values())
+        self.sessions.clear()
+        self.generator.lost(self, sessions)
+
+class Generator:
+    def __init__(self, options, host, port):
+        self.options = options
+        self.endpoint = TCP4ClientEndpoint(reactor, host, port)
+        self.secret = options.secret.encode('utf-8')
+        self.kinds = []
+        self.weights = []
+        for item in options.mix.split(','):
+            kind, _, weight = item.partition('=')
+            self.kinds.append(session_kinds[kind.strip()])
+            self.weights.append(float(weight or 1))
+        self.connections = []
+        self.next_connection = 0
+        self.connecting = 0
+        self.outstanding = 0
+        self.latencies = {kind: [] for kind in session_kinds}
+        self.failures = {kind: 0 for kind in session_kinds}
+        self.errors = {kind: 0 for kind in session_kinds}
+        self.skipped = 0
+        self.done = None
+
+    def username(self):
+        return 'user{}'.format(random.randrange(self.options.users))
+
+    @defer.inlineCallbacks
+    def run(self):
+        if self.options.single_connect:
+            self.connections = yield defer.gatherResults([connectProtocol(self.endpoint, LoadProtocol(self))
+                                                          for i in range(self.options.connections)])
+
+        loop = task.LoopingCall(self.tick)
+        self.credit = 0.0
+        self.last_tick = time.monotonic()
+        started = time.monotonic()
+        loop.start(0.01)
+        yield task.deferLater(reactor, self.options.duration, loop.stop)
+
+        if self.outstanding:
+            self.done = defer.Deferred()
+            timeout = reactor.callLater(10, self.done.callback, None)
+            yield self.done
+            if timeout.active():
+                timeout.cancel()
+        elapsed = time.monotonic() - started
+
+        for connection in self.connections:
+            connection.transport.loseConnection()
+
+        return elapsed
+
+    def tick(self):
+        now = time.monotonic()
+        self.credit += (now - self.last_tick) * self.options.rate
+        self.last_tick = now
+        while self.credit >= 1:
+            self.credit -= 1
+            self.startSession()
+
+    def startSession(self):
+        kind = random.choices(self.kinds, self.weights)[0]
+        session = kind(self, random.getrandbits(32))
+
+        if self.options.single_connect:
+            connection = self.connections[self.next_connection % len(self.connections)]
+            self.next_connection += 1
+            self.begin(connection, session)
+            return
+
+        # Without single-connect every session has a connection to
+        # itself, at most --connections of them at once.
+        if self.outstanding + self.connecting >= self.options.connections:
+            self.skipped += 1
+            return
+        self.connecting += 1
+        d = connectProtocol(self.endpoint, LoadProtocol(self))
+        d.addCallbacks(self.connected, self.connectFailed, callbackArgs = (session,), errbackArgs = (session,))
+
+    def connected(self, connection, session):
+        self.connecting -= 1
+        self.begin(connection, session)
+
+    def connectFailed(self, reason, session):
+        self.connecting -= 1
+        self.errors[session.kind] += 1
+
+    def begin(self, connection, session):
+        self.outstanding += 1
+        session.started = time.monotonic()
+        connection.send(session)
+
+    def finished(self, connection, session):
+        self.outstanding -= 1
+        self.latencies[session.kind].append(time.monotonic() - session.started)
+        if not session.ok:
+            self.failures[session.kind] += 1
+        if not self.options.single_connect:
+            connection.transport.loseConnection()
+        self.checkDone()
+
+    def lost(self, connection, sessions):
+        for session in sessions:
+            self.outstanding -= 1
+            self.errors[session.kind] += 1
+        self.checkDone()
+
+    def checkDone(self):
+        if self.done is not None and not self.outstanding and not self.done.called:
+            self.done.callback(None)
+
+    def results(self, elapsed):
+        results = {'elapsed': elapsed, 'skipped': self.skipped, 'kinds': {}}
+        for kind, latencies in self.latencies.items():
+            if not latencies and not self.errors[kind]:
+                continue
+            latencies = sorted(latencies)
+            result = {'completed': len(latencies),
+                      'per_second': len(latencies) / elapsed,
+                      'failures': self.failures[kind],
+                      'errors': self.errors[kind]}
+            for name, fraction in [('p50', 0.50), ('p90', 0.90), ('p99', 0.99), ('max', 1.0)]:
+                if latencies:
+                    result[name + '_ms'] = latencies[min(len(latencies) - 1, int(len(latencies) * fraction))] * 1000
+            results['kinds'][kind] = result
+        return results
+
+def report(results):
+    print('{:<8} {:>9} {:>9} {:>8} {:>8} {:>9} {:>9} {:>9} {:>9}'.format(
+        'kind', 'done', 'per sec', 'failed', 'errors', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms'))
+    for kind, result in sorted(results['kinds'].items()):
+        print('{:<8} {:>9} {:>9.0f} {:>8} {:>8} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f}'.format(
+            kind, result['completed'], result['per_second'], result['failures'], result['errors'],
+            result.get('p50_ms', 0), result.get('p90_ms', 0), result.get('p99_ms', 0), result.get('max_ms', 0)))
+    if results['skipped']:
+        print('{} sessions not started because all connections were busy'.format(results['skipped']))
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+config_xml = """<?xml version="1.0" encoding="UTF-8"?>
+<config>
+  <config-files>
+    <clients><path>{directory}/clients.xml</path></clients>
+    <users><path>{directory}/users.xml</path></users>
+  </config-files>
+  <settings>
+    <listen_address>127.0.0.1</listen_address>
+    <listen_port>{port}</listen_port>
+    <workers>{workers}</workers>
+    <etcd_url>{etcd_url}</etcd_url>
+    <accounting_spool>{directory}/spool</accounting_spool>
+    <accounting_fsync>{fsync}</accounting_fsync>
+    <log_level>warn</log_level>
+    <reload_check_interval>0</reload_check_interval>
+    <metrics_port>{metrics_port}</metrics_port>
+    <!-- Measure the server, not its rate limits. -->
+    <session_rate>0</session_rate>
+    <authentication_rate>0</authentication_rate>
+    <user_authentication_rate>0</user_authentication_rate>
+  </settings>
+</config>
+"""
+
+clients_xml = """<?xml version="1.0" encoding="UTF-8"?>
+<clients>
+  <client>
+    <address>127.0.0.0/8</address>
+    <secret>{secret}</secret>
+  </client>
+</clients>
+"""
+
+class TestSetup:
+    """An etcd stand-in with some users in it, and a server using it."""
+
+    def __init__(self, options):
+        self.options = options
+        self.directory = tempfile.mkdtemp(prefix = 'secant-loadgen-')
+        self.server = None
+        self.metrics_port = free_port() if options.metrics else 0
+
+    def start(self):
+        site = FakeEtcdSite()
+        salt = b'loadgen-salt'
+        passwords = json.dumps({'login': {'salt': binascii.hexlify(salt).decode('ascii'),
+                                          'hash': binascii.hexlify(scrypt.hash(self.options.password, salt)).decode('ascii')}})
+        for i in range(self.options.users):
+            site.etcd.set('/secant/users/user{}/passwords'.format(i), passwords)
+        etcd_port = reactor.listenTCP(0, site, interface = '127.0.0.1')
+
+        self.port = free_port()
+        with open(os.path.join(self.directory, 'clients.xml'), 'w') as f:
+            f.write(clients_xml.format(secret = self.options.secret))
+        with open(os.path.join(self.directory, 'users.xml'), 'w') as f:
+            f.write('<users/>\n')
+        with open(os.path.join(self.directory, 'config.xml'), 'w') as f:
+            f.write(config_xml.format(directory = self.directory,
+                                      port = self.port,
+                                      workers = self.options.workers,
+                                      etcd_url = 'http://127.0.0.1:{}'.format(etcd_port.getHost().port),
+                                      fsync = 'true' if self.options.fsync else 'false',
+                                      metrics_port = self.metrics_port))
+
+        server_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+        self.server = subprocess.Popen([sys.executable, server_py, '--core', self.options.core, os.path.join(self.directory, 'config.xml')])
+        return self.waitForServer(time.monotonic() + 30)
+
+    def waitForServer(self, deadline):
+        try:
+            socket.create_connection(('127.0.0.1', self.port)).close()
+            return defer.succeed(None)
+        except OSError:
+            if time.monotonic() > deadline or self.server.poll() is not None:
+                return defer.fail(RuntimeError('server did not start'))
+        return task.deferLater(reactor, 0.1, self.waitForServer, deadline)
+
+    @defer.inlineCallbacks
+    def saveMetrics(self, path):
+        response = yield Agent(reactor).request(b'GET', 'http://127.0.0.1:{}/'.format(self.metrics_port).encode('ascii'))
+        body = yield readBody(response)
+        with open(path, 'wb') as f:
+            f.write(body)
+
+    def stop(self):
+        if self.server is not None:
+            self.server.terminate()
+            self.server.wait()
+        shutil.rmtree(self.directory, ignore_errors = True)
+
+@defer.inlineCallbacks
+def main(options):
+    random.seed(options.seed)
+    setup = None
+    try:
+        if options.host is None:
+            setup = TestSetup(options)
+            yield setup.start()
+            host, port = '127.0.0.1', setup.port
+        else:
+            host, port = options.host, options.port
+
+        print('{} sessions/s for {} seconds over {} {}connections, mix {}'.format(
+            options.rate, options.duration, options.connections,
+            'single-connect ' if options.single_connect else '', options.mix))
+
+        generator = Generator(options, host, port)
+        elapsed = yield generator.run()
+        results = generator.results(elapsed)
+        report(results)
+
+        if options.json:
+            with open(options.json, 'w') as f:
+                json.dump(results, f, indent = 2, sort_keys = True)
+
+        if setup is not None and options.metrics:
+            yield setup.saveMetrics(options.metrics)
+    finally:
+        if setup is not None:
+            setup.stop()
+        reactor.stop()
+
+parser = argparse.ArgumentParser(description = 'TACACS+ load generator')
+parser.add_argument('--host', help = 'server to test, by default start a local one')
+parser.add_argument('--port', type = int, default = 49)
+parser.add_argument('--secret', default = 'loadgen')
+parser.add_argument('--rate', type = float, default = 1000, help = 'sessions started per second')
+parser.add_argument('--duration', type = float, default = 10)
+parser.add_argument('--connections', type = int, default = 8)
+parser.add_argument('--single-connect', action = 'store_true')
+parser.add_argument('--mix', default = 'login=1,author=4,acct=5', help = 'weights for login, author and acct sessions')
+parser.add_argument('--users', type = int, default = 100)
+parser.add_argument('--password', default = 'password')
+parser.add_argument('--workers', type = int, default = 1, help = 'worker processes for the local server')
+parser.add_argument('--core', choices = ['twisted', 'asyncio', 'uvloop'], default = 'twisted', help = 'event loop for the local server')
+parser.add_argument('--fsync', action = 'store_true', help = 'fsync the local server\'s accounting spool')
+parser.add_argument('--seed', type = int, default = 0)
+parser.add_argument('--json', help = 'also write the results to this file')
+parser.add_argument('--metrics', help = 'turn on the local server\'s metrics and save them to this file at the end')
+
+if __name__ == '__main__':
+    reactor.callWhenRunning(main, parser.parse_args())
+    reactor.run()
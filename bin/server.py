@@ -17,22 +17,57 @@
 # You should have received a copy of the GNU General Public License
 # along with Secant.  If not, see <http://www.gnu.org/licenses/>.
 
+import argparse
 import sys
 
+parser = argparse.ArgumentParser(description = 'Secant TACACS+ server')
+parser.add_argument('--core', choices = ['twisted', 'asyncio', 'uvloop'], default = 'twisted',
+                    help = 'event loop to serve connections from: Twisted\'s own reactor, '
+                    'or an asyncio loop (uvloop\'s with uvloop) with Twisted running on top of it')
+parser.add_argument('--worker', nargs = argparse.REMAINDER, help = argparse.SUPPRESS)
+parser.add_argument('config_paths', nargs = '*')
+options = parser.parse_args()
+
+# The reactor has to be chosen before anything imports it, and
+# importing secant does.
+if options.core != 'twisted':
+    import asyncio
+    from twisted.internet import asyncioreactor
+    if options.core == 'uvloop':
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    asyncioreactor.install(loop)
+
 from twisted.internet import reactor
-from twisted.internet import endpoints
 from twisted.logger import globalLogBeginner
 from twisted.logger import textFileLogObserver
-from twisted.logger import Logger
 
 from secant import config
-from secant import TacacsProtocolFactory
+from secant import loglevel
+from secant import workers
+
+# Worker processes started by the supervisor come back through here so
+# that they get the same core.
+if options.worker is not None:
+    workers.main(options.worker, core = options.core)
+    sys.exit()
 
 output = textFileLogObserver(sys.stdout)
-globalLogBeginner.beginLoggingTo([output])
+globalLogBeginner.beginLoggingTo([loglevel.observer(output)])
+
+config.load_config(options.config_paths)
+
+# With more than one worker this process only looks after the worker
+# processes, otherwise it does all of the work itself.
+if config.settings['workers'] > 1:
+    server = workers.Supervisor(reactor, command = [sys.executable, __file__, '--core', options.core, '--worker'])
+else:
+    server = workers.Worker(reactor, core = options.core)
 
-factory = TacacsProtocolFactory()
-endpoint = endpoints.serverFromString(reactor, 'tcp:port=49')
-endpoint.listen(factory)
+server.privilegedStartService()
+reactor.callWhenRunning(server.startService)
+reactor.addSystemEventTrigger('before', 'shutdown', server.stopService)
 
 reactor.run()
@@ -25,7 +25,7 @@ from twisted.logger import globalLogBeginner
 from twisted.logger import textFileLogObserver
 from twisted.logger import Logger
 
-from txetcd.client import EtcdClient
+from secant import etcd
 
 import scrypt
 import binascii
@@ -37,7 +37,7 @@ class Main(object):
     def __init__(self, username, passwords):
         self.username = username
         self.passwords = json.dumps(passwords).encode('utf-8')
-        self.client = EtcdClient(reactor)
+        self.client = etcd.EtcdClient(reactor)
         reactor.callWhenRunning(self.setPasswords)
 
     def setPasswords(self):
@@ -17,137 +17,441 @@
 # You should have received a copy of the GNU General Public License
 # along with Secant.  If not, see <http://www.gnu.org/licenses/>.
 
+from twisted.internet import defer
 from twisted.internet.protocol import Factory
 from twisted.internet.protocol import Protocol
-from twisted.internet.address import IPv4Address
 from twisted.internet.error import ConnectionDone
 from twisted.logger import Logger
 
+import collections
+
+from secant import admission
+from secant import aio
 from secant import packet
+from secant import framing
 from secant import config
+from secant import metrics
 from secant import users
 from secant import clients
+from secant import timers
 from secant.session import authentication
 from secant.session import authorization
 from secant.session import accounting
+from secant.session import table
 
-__all__ = ['packet', 'clients', 'config', 'users', 'templates', 'session', 'test', 'TacacsProtocol', 'TacacsProtocolFactory']
+__all__ = ['admission', 'aio', 'packet', 'framing', 'clients', 'config', 'reload', 'loglevel', 'metrics', 'spool', 'workers', 'users', 'templates', 'timers', 'session', 'test', 'TacacsProtocol', 'TacacsProtocolFactory']
 
 class TacacsProtocolFactory(Factory):
+    """Builds a TacacsProtocol for each connection that is admitted.
+    Connections from addresses that aren't clients, and connections over
+    the max_connections or max_connections_per_address limits, are
+    closed straight away, before anything is read from them."""
+
     log = Logger()
 
+    def __init__(self):
+        self.connections = set()
+        self.addresses = collections.Counter()
+        # Connections closed by TacacsProtocol.drop(), by reason.
+        self.dropped = dict.fromkeys(['body_too_large', 'read_timeout', 'idle_timeout'], 0)
+
     def buildProtocol(self, peer):
+        if clients.find_client(peer.host) is None:
+            self.log.info('Connection from unknown client {host:}, closing.', host = peer.host)
+            return self.reject('unknown_client')
+
+        if len(self.connections) >= config.settings['max_connections']:
+            self.log.warn('Too many connections, closing connection from {host:}.', host = peer.host)
+            return self.reject('max_connections')
+
+        if self.addresses[peer.host] >= config.settings['max_connections_per_address']:
+            self.log.warn('Too many connections from {host:}, closing.', host = peer.host)
+            return self.reject('max_connections_per_address')
+
         self.log.info('Connection from {peer:}', peer = peer)
-        return TacacsProtocol(peer)
+        protocol = TacacsProtocol(peer)
+        protocol.factory = self
+        return protocol
+
+    def reject(self, reason):
+        admission.control.reject(reason)
+        if metrics.enabled:
+            metrics.connections.inc(reason)
+        return None
+
+    def opened(self, protocol):
+        self.connections.add(protocol)
+        self.addresses[protocol.peer.host] += 1
+
+    def closed(self, protocol):
+        if protocol in self.connections:
+            self.connections.discard(protocol)
+            self.addresses[protocol.peer.host] -= 1
+            if not self.addresses[protocol.peer.host]:
+                del self.addresses[protocol.peer.host]
     
 class TacacsProtocol(Protocol):
+    """One connection from a client.
+
+    A connection is dropped if a header advertises a body longer than
+    max_body_length, if the rest of a frame takes longer than
+    frame_read_timeout seconds to arrive, or if it has been idle for
+    connection_idle_timeout seconds.  The deadlines are checked by a
+    timer on the shared timers.wheel, which is only moved when a
+    deadline gets closer.  When it fires the deadline is worked out
+    again from the state of the connection.
+    """
+
     log = Logger()
 
     def __init__(self, peer):
         self.peer = peer
-        self.buffer = b''
-        self.request = None
-        self.handlers = {}
+        self.frames = framing.FrameBuffer(max_length = config.settings['max_body_length'])
+        self.wheel = timers.wheel
+        self.timer = None
+        self.last_active = None
+        self.frame_started = None
+        self.dispatching = False
+        self.paused = False
         self.client = None
+        self.snapshot = None
+
+        # Requests that have been handed to a session handler and are
+        # waiting for a reply, keyed by session_id.  A session only
+        # ever has one request outstanding, further requests for the
+        # same session wait in backlog until the reply has been sent.
+        self.inflight = {}
+        self.backlog = {}
+        self.backlog_count = 0
+
+        self.sessions = table.SessionTable(inflight = self.inflight)
 
     def connectionMade(self):
         self.log.debug('Connection made.')
+        if self.factory is not None:
+            self.factory.opened(self)
         self.transport.setTcpNoDelay(True)
+        self.findClient()
+        if metrics.enabled:
+            metrics.connections.inc('unknown_client' if self.client is None else 'accepted')
+        if self.client is not None:
+            self.last_active = self.wheel.clock.seconds()
+            self.checkDeadlines()
+
+    def findClient(self):
+        self.snapshot = config.current
+        started = metrics.enabled and metrics.clock()
+        self.client = clients.find_client(self.peer.host)
+        if started:
+            metrics.observe_stage('find_client', started)
+        if self.client is None:
+            self.log.info('Connection from unknown client {host:}, closing.', host = self.peer.host)
+            self.transport.loseConnection()
 
-        if isinstance(self.peer, IPv4Address):
-            d = clients.find_client(self.peer.host)
-            d.addCallback(self.setClient)
-            d.addErrback(self.errorClient)
-            #return d
+    def dataReceived(self, data):
+        with self.frames.get_buffer(len(data)) as view:
+            view[:len(data)] = data
+        self.bufferUpdated(len(data))
 
-    def setClient(self, client):
-        self.log.debug('setting client')
-        self.client = client
+    def bufferUpdated(self, nbytes):
+        """Process nbytes that have just been written to the space
+        returned by frames.get_buffer(), by dataReceived() or straight
+        from the socket by secant.aio."""
+        self.frames.buffer_updated(nbytes)
+        self.last_active = self.wheel.clock.seconds()
+        self.log.debug('Received {count:} bytes.', count = nbytes)
         self.processData()
 
-    def errorClient(self, failure):
-        self.log.debug('Error getting client: {failure:}', failure = failure)
-        self.transport.loseConnection()
+    def nextDeadline(self):
+        """Return the time at which the connection should be dropped if
+        nothing changes before then, and the reason, or (None, None)."""
+        now = self.wheel.clock.seconds()
+        read_timeout = config.settings['frame_read_timeout']
+        idle_timeout = config.settings['connection_idle_timeout']
 
-    def dataReceived(self, data):
-        self.buffer += data
-        self.log.debug('Received {count:} bytes.', count = len(data))
-        self.processData()
+        # While we are working on requests the client isn't expected to
+        # send anything, look again later.
+        if self.paused or self.inflight or self.backlog_count:
+            interval = idle_timeout or read_timeout
+            return (now + interval if interval > 0 else None), None
+
+        if len(self.frames):
+            if read_timeout > 0:
+                return self.frame_started + read_timeout, 'read_timeout'
+            return None, None
+
+        if idle_timeout > 0:
+            return self.last_active + idle_timeout, 'idle_timeout'
+        return None, None
+
+    def scheduleCheck(self, deadline):
+        if self.timer is not None:
+            if self.timer.deadline <= deadline:
+                return
+            self.wheel.cancel(self.timer)
+        self.timer = self.wheel.schedule(deadline, self.checkDeadlines)
+
+    def checkDeadlines(self):
+        self.timer = None
+        if self.client is None:
+            return
+
+        deadline, reason = self.nextDeadline()
+        if deadline is None:
+            return
+        if reason is not None and deadline <= self.wheel.clock.seconds():
+            self.drop(reason)
+            return
+        self.scheduleCheck(deadline)
+
+    def drop(self, reason):
+        self.log.info('Dropping connection from {host:}: {reason:}.', host = self.peer.host, reason = reason)
+        if self.factory is not None:
+            self.factory.dropped[reason] += 1
+        if metrics.enabled:
+            metrics.dropped.inc(reason)
+
+        # Anything that is still buffered or arrives from now on is
+        # ignored.
+        self.client = None
+        if reason == 'idle_timeout':
+            self.transport.loseConnection()
+        else:
+            self.transport.abortConnection()
+
+    def atCapacity(self):
+        return len(self.inflight) + self.backlog_count >= config.settings['max_inflight_requests']
 
     def processData(self):
+        # Ignore anything from an unknown client while the connection
+        # is being closed.
         if self.client is None:
-            self.log.debug('Waiting for client info...')
             return
 
-        # If we aren't in the middle of processing a request see if we
-        # have enough data for the TACACS+ header, which is always 12
-        # bytes.  If we have enough data for the header, start a
-        # generic request and decode the header so we know how many
-        # bytes to expect for the body of the request.
-        if self.request is None and len(self.buffer) >= 12:
-            request_header = self.buffer[:12]
-            self.buffer = self.buffer[12:]
-            
-            # Start a generic request packet using the header.
-            #self.request = packet.Packet(self.client.get_secret().render())
-            self.request = packet.Packet(self.client.get_secret())
-            self.request.set_header(request_header)
-
-            self.log.debug('Header received, need {count:} bytes for the body.', count = self.request.length)
-
-        # We've gotten enough data for the header and have started a
-        # request, see if we have enough data for the body so we can
-        # finish creating the generic request and can dispatch it to
-        # the appropriate handler.
-        if self.request is not None and len(self.buffer) >= self.request.length:
-            self.log.debug('{count:} bytes received for the body.', count = self.request.length)
-
-            request_body = self.buffer[:self.request.length]
-            self.buffer = self.buffer[self.request.length:]
-
-            self.request.set_body(request_body)
-
-            self.processRequest()
-
-    def processRequest(self):
+        # The configuration has been reloaded since the client was
+        # looked up, the secret may have changed or the client may have
+        # been removed altogether.
+        if self.snapshot is not config.current:
+            self.findClient()
+            if self.client is None:
+                return
+
+        # Don't decode any more requests while we are at the limit of
+        # outstanding requests for this connection.  Stop reading from
+        # the socket as well so that the backlog stays in the kernel
+        # and TCP flow control pushes back on the client.
+        if self.atCapacity():
+            self.pauseReading()
+            return
+
+        # Dispatch every complete frame in the buffer.  Each frame is a
+        # 12 byte TACACS+ header followed by the number of body bytes
+        # given in the header.
+        self.dispatching = True
+        dispatched = False
+        try:
+            for request_header, request_body in self.frames:
+                dispatched = True
+
+                # Decode the request straight into the packet class
+                # for its type.
+                started = metrics.enabled and metrics.clock()
+                request = packet.parse_request(request_header, request_body, self.client.get_secret())
+                if started:
+                    metrics.observe_stage('decode', started)
+
+                self.log.debug('{count:} bytes received for the body.', count = request.length)
+
+                if request.session_id in self.inflight:
+                    self.log.debug('Session {session_id:} already has a request outstanding, queueing.',
+                                   session_id = request.session_id)
+                    self.backlog.setdefault(request.session_id, collections.deque()).append(request)
+                    self.backlog_count += 1
+
+                else:
+                    self.processRequest(request)
+
+                if self.atCapacity():
+                    self.pauseReading()
+                    break
+
+        except framing.FrameTooLarge as e:
+            self.log.info('Client advertised a {length:} byte body.', length = e.args[0])
+            self.drop('body_too_large')
+            return
+
+        finally:
+            self.dispatching = False
+
+        # The clock for reading a frame starts with its first byte, or
+        # when the frame before it was finished.
+        if not len(self.frames):
+            self.frame_started = None
+        elif dispatched or self.frame_started is None:
+            self.frame_started = self.wheel.clock.seconds()
+            if config.settings['frame_read_timeout'] > 0:
+                self.scheduleCheck(self.frame_started + config.settings['frame_read_timeout'])
+
+    def pauseReading(self):
+        if not self.paused:
+            self.log.debug('Too many requests outstanding, pausing.')
+            self.paused = True
+            self.transport.pauseProducing()
+
+    def resumeReading(self):
+        if self.paused:
+            self.log.debug('Resuming.')
+            self.paused = False
+            self.transport.resumeProducing()
+            # Reading the rest of a frame starts over now that we are
+            # reading again.
+            if self.frame_started is not None:
+                self.frame_started = self.wheel.clock.seconds()
+
+    def processRequest(self, request):
         # Is this a request from a session we have already seen?
-        if self.request.session_id in self.handlers:
-            # Yes, look up the handler from our cache.
-            handler = self.handlers[self.request.session_id]
+        handler = self.sessions.get(request.session_id)
+
+        if handler is None:
+            # Turn new sessions away at once if the client is starting
+            # them too quickly.
+            if not admission.control.allow_session(self.client, self.peer.host):
+                self.rejectRequest(request, 'Too many new sessions, try again later.')
+                return
 
-        else:
             # No, create a new session handler based upon the request type.
-            if self.request.packet_type == packet.TAC_PLUS_AUTHEN:
-                self.log.debug('New authentication session {session_id:}.', session_id = self.request.session_id)
-                handler = authentication.AuthenticationSessionHandler(self.client, self.request.session_id)
+            if request.packet_type == packet.TAC_PLUS_AUTHEN:
+                self.log.debug('New authentication session {session_id:}.', session_id = request.session_id)
+                handler = authentication.AuthenticationSessionHandler(self.client, request.session_id, self.peer.host)
+
+            elif request.packet_type == packet.TAC_PLUS_AUTHOR:
+                self.log.debug('New authorization session {session_id:}.', session_id = request.session_id)
+                handler = authorization.AuthorizationSessionHandler(self.client, request.session_id, self.peer.host)
+
+            elif request.packet_type == packet.TAC_PLUS_ACCT:
+                self.log.debug('New accounting session {session_id:}.', session_id = request.session_id)
+                handler = accounting.AccountingSessionHandler(self.client, request.session_id, self.peer.host)
+
+            if metrics.enabled:
+                metrics.sessions.inc(metrics.packet_type(request))
 
-            elif self.request.packet_type == packet.TAC_PLUS_AUTHOR:
-                self.log.debug('New authorization session {session_id:}.', session_id = self.request.session_id)
-                handler = authorization.AuthorizationSessionHandler(self.client, self.request.session_id)
+            # Remember the new handler for the next request, if there is
+            # room for another session.
+            if not self.sessions.add(request.session_id, handler):
+                self.rejectRequest(request, 'Too many sessions, try again later.')
+                return
 
-            elif self.request.packet_type == packet.TAC_PLUS_ACCT:
-                self.log.debug('New accounting session {session_id:}.', session_id = self.request.session_id)
-                handler = accounting.AccountingSessionHandler(self.client, self.request.session_id)
+        self.inflight[request.session_id] = request
 
-            # Cache the new handler for the next request
-            self.handlers[self.request.session_id] = handler
+        # Dispatch the request to the handler.  A handler that raises
+        # instead of returning a failed Deferred is answered the same
+        # way, so that the request doesn't stay in flight for ever.
+        started = metrics.enabled and metrics.clock()
+        try:
+            reply_deferred = aio.as_deferred(handler.process_request(request))
+        except Exception:
+            reply_deferred = defer.fail()
 
-        # Dispatch the request to the handler
-        reply_deferred = handler.process_request(self.request)
-        reply_deferred.addCallback(self.handleReply)
+        # If the handler has to wait for something before it can reply,
+        # use the time to compute the pad that will encrypt the reply.
+        if not reply_deferred.called:
+            request.prefetch_reply_pad()
 
-    def handleReply(self, reply):
-        # If the handler returns a reply, send the reply back to the client.
+        # handleError also catches anything that goes wrong in
+        # handleReply, encoding the reply say, and whatever happens the
+        # request is no longer in flight afterwards.
+        reply_deferred.addCallback(self.handleReply, request, handler, started)
+        reply_deferred.addErrback(self.handleError, request, started)
+        reply_deferred.addBoth(lambda result: self.finishRequest(request))
+
+    def rejectRequest(self, request, message):
+        self.log.debug('Rejecting session {session_id:}: {message:}', session_id = request.session_id, message = message)
+        queued = self.backlog.pop(request.session_id, ())
+        self.backlog_count -= len(queued)
+        self.writeError(request, message)
+
+    def writeError(self, request, message):
+        reply = admission.error_reply(request, message)
+        if request.header_flags & packet.TAC_PLUS_SINGLE_CONNECT_FLAG:
+            reply.header_flags |= packet.TAC_PLUS_SINGLE_CONNECT_FLAG
+        self.transport.write(reply.pack())
+
+    def handleReply(self, reply, request, handler, started = None):
+        # If the handler returns a reply, send the reply back to the
+        # client.  The reply was created from the request so it
+        # already carries the right session_id and seq_no.  Nothing is
+        # written until the reply has been encoded and the session
+        # updated, so that if either fails handleError can send an
+        # error reply in its place.
+        data = None
+        encoding = None
         if reply != None:
-            if self.request.header_flags & packet.TAC_PLUS_SINGLE_CONNECT_FLAG:
+            if request.header_flags & packet.TAC_PLUS_SINGLE_CONNECT_FLAG:
                 reply.header_flags |= packet.TAC_PLUS_SINGLE_CONNECT_FLAG
-            self.log.debug('Sending reply.')
-            self.transport.write(reply.pack())
+            encoding = started and metrics.clock()
+            data = reply.pack()
+            if encoding:
+                encoding = metrics.observe_stage('encode', encoding)
+
+        # Forget about sessions that have run their course.
+        handler.reply_sent(reply)
+        if handler.finished:
+            self.sessions.remove(request.session_id)
 
-        # Reset so that we start looking for a new request
-        self.request = None
+        if data is not None:
+            self.last_active = self.wheel.clock.seconds()
+            self.log.debug('Sending reply for session {session_id:}.', session_id = request.session_id)
+            self.transport.write(data)
+            if encoding:
+                metrics.observe_stage('write', encoding)
+
+        if started:
+            metrics.observe_request(request, reply, started)
+
+    def handleError(self, failure, request, started = None):
+        self.log.failure('Error handling request for session {session_id:}.', failure, session_id = request.session_id)
+        if started:
+            metrics.errors.inc(metrics.packet_type(request))
+            metrics.request_seconds.observe(metrics.clock() - started, metrics.packet_type(request), 'exception')
+        self.sessions.remove(request.session_id, 'failed')
+
+        # Tell the client rather than leave it waiting for a reply
+        # until it times out.
+        try:
+            self.writeError(request, 'Internal error, try again later.')
+        except Exception:
+            self.log.failure('Unable to send an error reply for session {session_id:}.', session_id = request.session_id)
+
+    def finishRequest(self, request):
+        if self.inflight.get(request.session_id) is request:
+            del self.inflight[request.session_id]
+
+        # Hand the session its next request if one arrived while we
+        # were waiting on this one.
+        queued = self.backlog.get(request.session_id)
+        if queued:
+            next_request = queued.popleft()
+            self.backlog_count -= 1
+            if not queued:
+                del self.backlog[request.session_id]
+            self.processRequest(next_request)
+
+        # Requests that arrived while we were waiting for this reply
+        # are still sitting in the buffer.
+        if not self.atCapacity():
+            self.resumeReading()
+            if not self.dispatching:
+                self.processData()
 
     def connectionLost(self, reason):
+        if self.timer is not None:
+            self.wheel.cancel(self.timer)
+            self.timer = None
+        self.sessions.clear()
+        self.frames.release()
+        if self.factory is not None:
+            self.factory.closed(self)
+
         if not isinstance(reason.value, ConnectionDone):
             self.log.debug('Connection lost: {value:}', value = reason.value)
         else:
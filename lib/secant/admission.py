@@ -0,0 +1,167 @@
+# -*- mode: python; coding: utf-8 -*-
+
+# Copyright © 2008,2010 by Jeffrey C. Ollie
+#
+# This file is part of Secant.
+#
+# Secant is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Secant is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Secant.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import collections
+
+from secant import cache
+from secant import config
+from secant import metrics
+from secant import packet
+
+class RateLimiter:
+    """Token buckets, one per key, that fill at <name>_rate tokens a
+    second up to <name>_burst tokens.  Each allowed event takes a
+    token.  A rate of 0 turns the limit off.
+
+    A bucket that has been left alone long enough to fill up is no
+    different from a new one, so buckets are forgotten after that long,
+    and at most rate_limit_table_size are kept.
+    """
+
+    def __init__(self, name, clock = None):
+        self.name = name
+        self.clock = clock
+        self.limits = None
+        self.buckets = None
+        self.rejected = 0
+
+    def configure(self):
+        rate = config.settings[self.name + '_rate']
+        burst = config.settings[self.name + '_burst']
+        size = config.settings['rate_limit_table_size']
+        if (rate, burst, size) != self.limits:
+            self.limits = (rate, burst, size)
+            self.buckets = cache.LRUCache(maxsize = size,
+                                          ttl = burst / rate if rate > 0 else 0,
+                                          clock = self.clock)
+        return rate, burst
+
+    def tokens(self, key, now, rate, burst):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            return burst
+        tokens, updated = bucket
+        return min(burst, tokens + (now - updated) * rate)
+
+    def allow(self, key, take = True):
+        """Return whether key has a token left, and unless take is
+        False spend it."""
+        rate, burst = self.configure()
+        if rate <= 0:
+            return True
+
+        now = self.buckets.clock.seconds()
+        tokens = self.tokens(key, now, rate, burst)
+        if tokens < 1:
+            self.rejected += 1
+            return False
+
+        if take:
+            self.buckets.set(key, (tokens - 1, now))
+        return True
+
+    def take(self, key):
+        """Spend a token of key's, if it has one left."""
+        rate, burst = self.configure()
+        if rate <= 0:
+            return
+
+        now = self.buckets.clock.seconds()
+        self.buckets.set(key, (max(0, self.tokens(key, now, rate, burst) - 1), now))
+
+def client_key(client, peer):
+    """The key of the per client buckets: the address the connection
+    came from, or with rate_limit_by set to client, the client entry
+    in clients.xml (by its first address), so that every device in a
+    network that is one client shares a bucket."""
+    if config.settings['rate_limit_by'] == 'client':
+        if client is None:
+            return None
+        return client.address
+    return peer
+
+class AdmissionControl:
+    """Limits on what clients may ask of the server, so that overload
+    turns into quick rejections rather than queues that keep growing.
+
+    Connections are limited by TacacsProtocolFactory.  New sessions are
+    limited per client, and authentication attempts both per client and
+    per username, where a client is the address the connection came
+    from (see client_key()).  Only failed attempts count against a
+    username (see authentication_failed()), so that an account that
+    logs in to many devices at once isn't turned away, while guessing
+    one user's password is still slowed down.
+    """
+
+    def __init__(self, clock = None):
+        self.sessions = RateLimiter('session', clock)
+        self.client_authentications = RateLimiter('authentication', clock)
+        self.user_authentications = RateLimiter('user_authentication', clock)
+        self.rejections = collections.Counter()
+
+    def reject(self, reason):
+        self.rejections[reason] += 1
+        if metrics.enabled:
+            metrics.rejections.inc(reason)
+
+    def allow_session(self, client, peer = None):
+        if self.sessions.allow(client_key(client, peer)):
+            return True
+        self.reject('session_rate')
+        return False
+
+    def allow_authentication(self, client, username, peer = None):
+        if not self.client_authentications.allow(client_key(client, peer)):
+            self.reject('authentication_rate')
+            return False
+        if not self.user_authentications.allow(username, take = False):
+            self.reject('user_authentication_rate')
+            return False
+        return True
+
+    def authentication_failed(self, username):
+        """Count a failed authentication attempt against username."""
+        self.user_authentications.take(username)
+
+    @property
+    def stats(self):
+        stats = dict(self.rejections)
+        stats['buckets'] = sum(len(limiter.buckets) for limiter in [self.sessions,
+                                                                    self.client_authentications,
+                                                                    self.user_authentications]
+                               if limiter.buckets is not None)
+        return stats
+
+control = AdmissionControl()
+
+# Where the status goes in the reply to each type of request.
+error_statuses = {packet.AuthenticationReply: ('authentication_status', packet.TAC_PLUS_AUTHEN_STATUS_ERROR),
+                  packet.AuthorizationResponse: ('authorization_status', packet.TAC_PLUS_AUTHOR_STATUS_ERROR),
+                  packet.AccountingReply: ('accounting_status', packet.TAC_PLUS_ACCT_STATUS_ERROR)}
+
+def error_reply(request, message):
+    """Return an error reply to request that carries message."""
+    reply = request.get_reply()
+    attribute, status = error_statuses[type(reply)]
+    setattr(reply, attribute, status)
+    if isinstance(reply, packet.AuthenticationReply):
+        reply.authentication_flags = 0
+    reply.server_msg = message
+    return reply
@@ -0,0 +1,138 @@
+# -*- mode: python; coding: utf-8 -*-
+
+# Copyright © 2008,2010 by Jeffrey C. Ollie
+#
+# This file is part of Secant.
+#
+# Secant is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Secant is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Secant.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Serving connections from an asyncio event loop.
+
+With the asyncio core, Twisted runs on top of the asyncio loop (see
+bin/server.py --core), and the listening socket and connections are
+handled by asyncio transports instead of Twisted's.  Each connection
+still gets a TacacsProtocol from TacacsProtocolFactory, so admission
+control, framing, the session handlers and everything else are shared
+by both cores.  Connection adapts the asyncio side to it, and reads
+from the socket straight into the connection's frame buffer.
+"""
+
+from twisted.internet import address
+from twisted.internet import defer
+from twisted.internet import error
+from twisted.python import failure
+
+import asyncio
+import socket
+
+def as_deferred(result):
+    """Return a Deferred for what a session handler returned: a
+    Deferred, a coroutine (which may await Deferreds), an asyncio
+    future or a reply."""
+    if isinstance(result, defer.Deferred):
+        return result
+    if asyncio.iscoroutine(result):
+        return defer.Deferred.fromCoroutine(result)
+    if asyncio.isfuture(result):
+        return defer.Deferred.fromFuture(result)
+    return defer.succeed(result)
+
+def peer_address(transport):
+    host, port = transport.get_extra_info('peername')[:2]
+    if ':' in host:
+        return address.IPv6Address('TCP', host, port)
+    return address.IPv4Address('TCP', host, port)
+
+class TransportAdapter:
+    """The parts of a Twisted transport that TacacsProtocol uses, on
+    top of an asyncio transport."""
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.disconnecting = False
+
+    def write(self, data):
+        self.transport.write(data)
+
+    def loseConnection(self):
+        self.disconnecting = True
+        self.transport.close()
+
+    def abortConnection(self):
+        self.disconnecting = True
+        self.transport.abort()
+
+    def pauseProducing(self):
+        self.transport.pause_reading()
+
+    def resumeProducing(self):
+        self.transport.resume_reading()
+
+    def setTcpNoDelay(self, enabled):
+        sock = self.transport.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(enabled))
+
+class Connection(asyncio.BufferedProtocol):
+    """Receives straight into the arena of the TacacsProtocol's frame
+    buffer, so no bytes object is created for the data read from the
+    socket and nothing is copied before the body is decrypted."""
+
+    # Somewhere to put anything that is read from a connection that
+    # has already been closed.
+    discard = bytearray(4096)
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.protocol = None
+
+    def connection_made(self, transport):
+        self.protocol = self.factory.buildProtocol(peer_address(transport))
+        if self.protocol is None:
+            transport.abort()
+            return
+        self.protocol.makeConnection(TransportAdapter(transport))
+
+    def get_buffer(self, sizehint):
+        if self.protocol is None:
+            return self.discard
+        return self.protocol.frames.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        if self.protocol is not None:
+            self.protocol.bufferUpdated(nbytes)
+
+    def connection_lost(self, exc):
+        if self.protocol is not None:
+            if exc is None:
+                reason = error.ConnectionDone()
+            else:
+                reason = error.ConnectionLost(str(exc))
+            self.protocol.connectionLost(failure.Failure(reason))
+            self.protocol = None
+
+class Port:
+    """Accepts connections on a listening socket for factory.  Has the
+    stopListening() of a Twisted port."""
+
+    def __init__(self, sock, factory, loop = None):
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self.starting = asyncio.ensure_future(loop.create_server(lambda: Connection(factory), sock = sock), loop = loop)
+
+    def stopListening(self):
+        d = defer.Deferred.fromFuture(self.starting)
+        d.addCallback(lambda server: server.close())
+        return d
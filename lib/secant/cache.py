@@ -0,0 +1,88 @@
+# -*- mode: python; coding: utf-8 -*-
+
+# Copyright © 2008,2010 by Jeffrey C. Ollie
+#
+# This file is part of Secant.
+#
+# Secant is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Secant is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Secant.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+
+class LRUCache:
+    """A dictionary with a maximum size and an expiry time for each
+    entry.  When the cache is full the least recently used entry is
+    thrown away.  Time comes from clock.seconds() so that the reactor
+    (or a fake clock in tests) drives expiry."""
+
+    def __init__(self, maxsize, ttl, clock = None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        entry = self.entries.get(key)
+        return entry is not None and entry[1] > self.clock.seconds()
+
+    def get(self, key, default = None):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+
+        value, expires = entry
+        if expires <= self.clock.seconds():
+            del self.entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return default
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl = None):
+        if ttl is None:
+            ttl = self.ttl
+        self.entries[key] = (value, self.clock.seconds() + ttl)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last = False)
+            self.evictions += 1
+
+    def pop(self, key, default = None):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return default
+        return entry[0]
+
+    def clear(self):
+        self.entries.clear()
+
+    @property
+    def stats(self):
+        return {'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'expirations': self.expirations,
+                'evictions': self.evictions}
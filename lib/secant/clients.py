@@ -19,14 +19,13 @@
 # along with Secant.  If not, see <http://www.gnu.org/licenses/>.
 
 from twisted.logger import Logger
-from twisted.internet import defer
 
-import os
 import ipaddress
 
-from secant import config
+from lxml import etree
 
-import paisley
+from secant import config
+from secant import templates
 
 class Client:
     log = Logger()
@@ -35,18 +34,24 @@ class Client:
                  address,
                  secret = None,
                  description = None,
+                 group = None,
                  messages = {},
                  prompts = {}):
 
         self.address = address
         self.secret = secret
         self.description = description
+        self.group = group
         self.messages = messages
         self.prompts = prompts
+        self.prompt_replies = None
 
     def get_secret(self):
         if self.secret is None:
-            return config.globals['client_secret']
+            secret = config.globals['client_secret']
+            if secret is None:
+                return None
+            return secret.render().encode('utf-8')
         else:
             return self.secret
 
@@ -56,55 +61,165 @@ class Client:
             return config.messages.get(message_type)
         return message
 
-    def get_prompt(self, prompt_type):
+    def get_prompt(self, prompt_type, prompts = None):
         prompt = self.prompts.get(prompt_type)
         if prompt is None:
-            return config.prompts.get(prompt_type)
+            if prompts is None:
+                prompts = config.prompts
+            return prompts.get(prompt_type)
         return prompt
 
+class TrieNode:
+    __slots__ = ['bits', 'length', 'value', 'children']
+
+    def __init__(self, bits, length, value = None):
+        self.bits = bits
+        self.length = length
+        self.value = value
+        self.children = [None, None]
+
+class PrefixTrie:
+    """Path compressed binary (radix) trie mapping network prefixes to
+    values for longest prefix match lookups.  Prefixes are stored as
+    integers of width bits with the host bits cleared.  Each node on a
+    lookup path is a strictly longer prefix of the address, so a lookup
+    visits at most width nodes no matter how many prefixes are stored.
+    """
+
+    def __init__(self, width):
+        self.width = width
+        self.root = TrieNode(0, 0)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def bit(self, bits, position):
+        return (bits >> (self.width - position - 1)) & 1
+
+    def common_length(self, a, b, length):
+        difference = (a ^ b) >> (self.width - length) if length else 0
+        if difference == 0:
+            return length
+        return length - difference.bit_length()
+
+    def insert(self, bits, length, value):
+        node = self.root
+        while True:
+            if node.length == length:
+                if node.value is None:
+                    self.count += 1
+                node.value = value
+                return
+
+            branch = self.bit(bits, node.length)
+            child = node.children[branch]
+
+            if child is None:
+                node.children[branch] = TrieNode(bits, length, value)
+                self.count += 1
+                return
+
+            common = self.common_length(child.bits, bits, min(child.length, length))
+
+            if common == child.length:
+                node = child
+                continue
+
+            if common == length:
+                # The new prefix sits between node and child.
+                new = TrieNode(bits, length, value)
+                new.children[self.bit(child.bits, length)] = child
+                node.children[branch] = new
+                self.count += 1
+                return
+
+            # The new prefix and child diverge below node, join them
+            # with an empty node for their common prefix.
+            mask = ((1 << common) - 1) << (self.width - common)
+            middle = TrieNode(bits & mask, common)
+            middle.children[self.bit(child.bits, common)] = child
+            middle.children[self.bit(bits, common)] = TrieNode(bits, length, value)
+            node.children[branch] = middle
+            self.count += 1
+            return
+
+    def lookup(self, bits):
+        node = self.root
+        best = node.value
+        while node.length < self.width:
+            child = node.children[self.bit(bits, node.length)]
+            if child is None:
+                break
+            if (bits ^ child.bits) >> (self.width - child.length):
+                break
+            if child.value is not None:
+                best = child.value
+            node = child
+        return best
+
+class ClientIndex:
+    """Clients indexed by network, one trie each for IPv4 and IPv6."""
+
+    def __init__(self):
+        self.tries = {4: PrefixTrie(32), 6: PrefixTrie(128)}
+        # Every client in the index, a client with several networks
+        # is in the tries more than once.
+        self.clients = {}
+
+    def __len__(self):
+        return sum(len(trie) for trie in self.tries.values())
+
+    def add(self, network, client):
+        network = ipaddress.ip_network(network, strict = False)
+        self.tries[network.version].insert(int(network.network_address), network.prefixlen, client)
+        self.clients[id(client)] = client
+
+    def lookup(self, address):
+        address = ipaddress.ip_address(address)
+        if address.version == 6 and address.ipv4_mapped is not None:
+            address = address.ipv4_mapped
+        return self.tries[address.version].lookup(int(address))
+
+def templates_from_element(element, creators = None):
+    result = {}
+    if element is not None:
+        for child in element:
+            if isinstance(child.tag, str):
+                result[child.tag] = templates.template_from_element(child, creators)
+    return result
+
+def parse_clients(path, creators = None):
+    """Read clients.xml and return a ClientIndex.  Each <client> may
+    list several <address> elements, each either a single address or a
+    network in CIDR notation.  Templates are made with creators (see
+    templates.make_template_creators())."""
+    index = ClientIndex()
+    tree = etree.parse(path)
+    tree.xinclude()
+
+    for client_element in tree.xpath('/clients/client'):
+        secret = client_element.findtext('secret')
+        if secret is not None:
+            secret = secret.strip().encode('utf-8')
+
+        addresses = [address.strip() for address in client_element.xpath('address/text()')]
+        client = Client(address = addresses[0] if addresses else None,
+                        secret = secret,
+                        description = client_element.findtext('description'),
+                        group = client_element.findtext('group'),
+                        messages = templates_from_element(client_element.find('messages'), creators),
+                        prompts = templates_from_element(client_element.find('prompts'), creators))
+
+        for address in addresses:
+            index.add(address, client)
+
+    return index
+
 def find_client(address):
-    return defer.succeed(Client(address = address,
-                                secret = b'hello',
-                                description = None,
-                                messages = {},
-                                prompts = {}))
-
-# class find_client(defer.Deferred):
-#     log = Logger()
-
-#     def __init__(self, address):
-#         defer.Deferred.__init__(self)
-#         self.address = ipaddress.ip_address(address)
-#         self.server = paisley.CouchDB('127.0.0.1')
-
-#         network = ipaddress.ip_network(address)
-#         keys = []
-#         while True:
-#             keys.append(network.with_prefixlen)
-#             if network.prefixlen == 0:
-#                 break
-#             network = network.supernet()
-
-#         query_deferred = self.server.openView('clients',
-#                                               'clients_by_address',
-#                                               'clients_by_address',
-#                                               keys = keys)
-#         query_deferred.addCallback(self.parseResult)
-#         query_deferred.addErrback(self.errback)
-
-#     def parseResult(self, result):
-#         if len(result['rows']) == 0:
-#             self.errback('Couldn\'t find a matching client entry in the database!')
-
-#         else:
-#             if len(result['rows']) == 1:
-#                 self.log.debug('Found %i client entry for address %s' % (len(result['rows']), self.address))
-#             else:
-#                 self.log.debug('Found %i client entries for address %s' % (len(result['rows']), self.address))
-
-#             client = Client(address = self.address,
-#                             secret = result['rows'][0]['value'].get('secret', None),
-#                             description = result['rows'][0]['value'].get('description', None),
-#                             messages = result['rows'][0]['value'].get('messages', {}),
-#                             prompts = result['rows'][0]['value'].get('prompts', {}))
-#             self.callback(client)
+    """Return the Client with the longest network prefix that contains
+    address, or None if the address doesn't belong to any client."""
+    index = config.current.clients
+    if index is None:
+        return None
+    return index.lookup(address)
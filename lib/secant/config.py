@@ -19,89 +19,219 @@
 # along with Secant.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import types
 
 from lxml import etree
 from twisted.logger import Logger
 
+from secant import loglevel
+from secant import policy
+from secant import replies
+from secant import templates
+
 log = Logger()
 
 default_paths = {'users': ['./users.xml', '/etc/secant/users.xml'],
                  'clients': ['./clients.xml', '/etc/secant/clients.xml'],
                  'genshi_templates': ['.', '/etc/secant']}
 
-paths = {}
+default_globals = {'enable_password': None,
+                   'client_secret': None}
 
-globals = {'enable_password': None,
-           'client_secret': None}
+default_messages = {'banner': None}
 
-messages = {'banner': None}
-prompts = {'username': u'Username: ',
-           'password': u'Password: '}
+default_prompts = {'username': u'Username: ',
+                   'password': u'Password: ',
+                   'enable': u'Enable: ',
+                   'old_password': u'Old Password: ',
+                   'old_enable': u'Old Enable Password: ',
+                   'new_password': u'New Password: ',
+                   'new_enable': u'New Enable Password: ',
+                   'new_password_again': u'Re-enter New Password: ',
+                   'new_enable_again': u'Re-enter New Enable Password: '}
 
-log_formats = {}
+# Tunable numbers and switches from the <settings> section.  The type
+# of each default decides how the text from the configuration file is
+# converted.
+default_settings = {'max_inflight_requests': 32,
+                    'session_idle_timeout': 300.0,
+                    'max_sessions_per_connection': 1024,
+                    'max_sessions': 100000,
+                    'max_connections': 4096,
+                    'max_connections_per_address': 64,
+                    'max_body_length': 65536,
+                    'frame_read_timeout': 10.0,
+                    'connection_idle_timeout': 600.0,
+                    'session_rate': 1000.0,
+                    'session_burst': 2000.0,
+                    'authentication_rate': 100.0,
+                    'authentication_burst': 200.0,
+                    'user_authentication_rate': 1.0,
+                    'user_authentication_burst': 10.0,
+                    'rate_limit_table_size': 100000,
+                    'rate_limit_by': 'address',
+                    'hash_workers': 4,
+                    'hash_queue_limit': 64,
+                    'etcd_url': 'http://127.0.0.1:2379',
+                    'etcd_pool_size': 8,
+                    'etcd_timeout': 2.0,
+                    'etcd_retries': 2,
+                    'user_cache_size': 10000,
+                    'user_cache_ttl': 300.0,
+                    'user_cache_negative_ttl': 30.0,
+                    'user_cache_watch': True,
+                    'user_cache_retry_delay': 5.0,
+                    'reload_check_interval': 10.0,
+                    'log_level': 'info',
+                    'authorization_default': 'pass_add',
+                    'authorization_cache_size': 10000,
+                    'authorization_cache_ttl': 60.0,
+                    'accounting_spool': './spool',
+                    'accounting_fsync': True,
+                    'accounting_batch_size': 1024,
+                    'accounting_batch_delay': 0.005,
+                    'accounting_queue_limit': 65536,
+                    'accounting_segment_size': 67108864,
+                    'accounting_backend_url': '',
+                    'accounting_drain_interval': 1.0,
+                    'accounting_drain_batch': 1000,
+                    'listen_address': '',
+                    'listen_port': 49,
+                    'workers': 1,
+                    'worker_reuseport': False,
+                    'worker_drain_timeout': 30.0,
+                    'worker_stats_interval': 5.0,
+                    'metrics_address': '127.0.0.1',
+                    'metrics_port': 0,
+                    'worker_respawn_delay': 1.0}
 
-def load_config(config_paths=[]):
-    global paths
-    global globals
+def convert_setting(name, text):
+    default = default_settings.get(name)
+    text = text.strip()
+    if isinstance(default, bool):
+        return text.lower() in ['1', 'yes', 'true', 'on']
+    if default is not None:
+        return type(default)(text)
+    return text
 
-    if not config_paths:
-        config_paths.append('./config.xml')
-        config_paths.append('/etc/secant/config.xml')
+class Snapshot:
+    """Everything read from the configuration files at one point in
+    time: config.xml, the clients from clients.xml and the users, groups
+    and compiled authorization policy from users.xml.  The replies for
+    the prompts are packed when the snapshot is built.
+
+    A snapshot is never changed once it has been built.  Reloading the
+    configuration builds a new snapshot and install() swaps it in all at
+    once, so code that holds on to a snapshot (like a session that is
+    in the middle of being handled) keeps seeing a consistent view.
+    """
+
+    __slots__ = ['generation', 'config_paths', 'mtimes', 'paths', 'template_search_paths',
+                 'globals', 'messages', 'prompts', 'prompt_replies', 'log_formats', 'settings',
+                 'clients', 'users', 'groups', 'policy']
+
+    def __init__(self, **kw):
+        for name in self.__slots__:
+            object.__setattr__(self, name, kw.get(name))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('configuration snapshots are read-only')
+
+    def replace(self, **changes):
+        """Return a copy of this snapshot with some parts replaced."""
+        kw = {name: getattr(self, name) for name in self.__slots__}
+        kw.update({name: freeze(value) for name, value in changes.items()})
+        if 'prompts' in changes and 'prompt_replies' not in changes:
+            kw['prompt_replies'] = replies.PromptReplies(kw['prompts'])
+        return Snapshot(**kw)
+
+def freeze(value):
+    if isinstance(value, dict):
+        return types.MappingProxyType(dict(value))
+    return value
+
+def default_config_paths():
+    return ['./config.xml', '/etc/secant/config.xml']
+
+def parse_config(config_paths):
+    """Read the first config.xml that can be found in config_paths.
+    Returns a dictionary of the parts of the configuration and the
+    path of the file that was read (or None).  The templates are made
+    by a new set of template creators using the template search paths
+    from this config.xml, also returned in the dictionary, so that
+    the ones in use are not changed."""
+    paths = {}
+    template_search_paths = {}
+    creators = templates.make_template_creators()
+    globals = dict(default_globals)
+    messages = dict(default_messages)
+    prompts = dict(default_prompts)
+    log_formats = {}
+    settings = dict(default_settings)
+    loaded_path = None
 
     for config_path in config_paths:
         try:
             config_tree = etree.parse(config_path)
-            config_tree.xinclude()
+        except IOError as e:
+            log.debug('Unable to load configuration from "%s"' % config_path)
+            continue
 
-            config_file_elements = config_tree.xpath('/config/config-files/*')
+        config_tree.xinclude()
 
-            for config_file_element in config_file_elements:
-                config_file_type = config_file_element.tag
-                path_text_elements = config_file_element.xpath('path/text()')
-                paths[config_file_type] = map(lambda path: str(path).strip(), path_text_elements)
+        config_file_elements = config_tree.xpath('/config/config-files/*')
 
-            template_search_path_elements = config_tree.xpath('/config/template-search-paths/*')
-            
-            for template_search_path_element in template_search_path_elements:
-                template_creator_name = template_search_path_element.tag
-                template_search_path = map(lambda path: str(path).strip(),
-                                           template_search_path_element.xpath('path/text()'))
-                template_creator = templates.template_creators.get(template_creator_name)
-                if template_creator is not None:
-                    template_creator.update_search_path(template_search_path)
-                else:
-                    log.debug('Unknown template creator "%s"' % template_creator_name)
+        for config_file_element in config_file_elements:
+            config_file_type = config_file_element.tag
+            path_text_elements = config_file_element.xpath('path/text()')
+            paths[config_file_type] = [str(path).strip() for path in path_text_elements]
 
-            global_elements = config_tree.xpath('/config/globals/*')
+        template_search_path_elements = config_tree.xpath('/config/template-search-paths/*')
 
-            for global_element in global_elements:
-                global_name = global_element.tag
-                globals[global_name] = templates.template_from_element(global_element)
+        for template_search_path_element in template_search_path_elements:
+            template_creator_name = template_search_path_element.tag
+            template_search_path = [str(path).strip() for path in template_search_path_element.xpath('path/text()')]
+            if template_creator_name in creators:
+                template_search_paths[template_creator_name] = template_search_path
+            else:
+                log.debug('Unknown template creator "%s"' % template_creator_name)
 
-            message_elements = config_tree.xpath('/config/messages/*')
+        creators = templates.make_template_creators(template_search_paths)
 
-            for message_element in message_elements:
-                message_name = message_element.tag
-                messages[message_name] = templates.template_from_element(message_element)
+        global_elements = config_tree.xpath('/config/globals/*')
 
-            prompt_elements = config_tree.xpath('/config/prompts/*')
+        for global_element in global_elements:
+            global_name = global_element.tag
+            globals[global_name] = templates.template_from_element(global_element, creators)
 
-            for prompt_element in prompt_elements:
-                prompt_name = prompt_element.tag
-                prompts[prompt_name] = templates.template_from_element(prompt_element)
+        message_elements = config_tree.xpath('/config/messages/*')
 
-            log_format_elements = config_tree.xpath('/config/log-formats/*')
+        for message_element in message_elements:
+            message_name = message_element.tag
+            messages[message_name] = templates.template_from_element(message_element, creators)
 
-            for log_format_element in log_format_elements:
-                log_format_name = log_format_element.tag
-                log_formats[log_format_name] = templates.template_from_element(log_format_element)
-                
-            log.debug('Loaded configuration from "%s"' % os.path.realpath(config_path))
+        prompt_elements = config_tree.xpath('/config/prompts/*')
 
-            break
+        for prompt_element in prompt_elements:
+            prompt_name = prompt_element.tag
+            prompts[prompt_name] = templates.template_from_element(prompt_element, creators)
 
-        except IOError as e:
-            log.debug('Unable to load configuration from "%s"' % config_path)
+        setting_elements = config_tree.xpath('/config/settings/*')
+
+        for setting_element in setting_elements:
+            setting_name = setting_element.tag
+            settings[setting_name] = convert_setting(setting_name, setting_element.text or '')
+
+        log_format_elements = config_tree.xpath('/config/log-formats/*')
+
+        for log_format_element in log_format_elements:
+            log_format_name = log_format_element.tag
+            log_formats[log_format_name] = templates.template_from_element(log_format_element, creators)
+
+        log.debug('Loaded configuration from "%s"' % os.path.realpath(config_path))
+        loaded_path = config_path
+
+        break
 
     for key, value in paths.items():
         if not value and key in default_paths:
@@ -110,3 +240,168 @@ def load_config(config_paths=[]):
     for key, value in default_paths.items():
         if key not in paths:
             paths[key] = value
+
+    return {'paths': paths,
+            'template_search_paths': template_search_paths,
+            'template_creators': creators,
+            'globals': globals,
+            'messages': messages,
+            'prompts': prompts,
+            'log_formats': log_formats,
+            'settings': settings}, loaded_path
+
+class LocalUser:
+    """A user entry from users.xml."""
+
+    def __init__(self, username, groups = [], rules = []):
+        self.username = username
+        self.groups = groups
+        self.rules = rules
+
+class LocalGroup:
+    """A group entry from users.xml."""
+
+    def __init__(self, name, rules = []):
+        self.name = name
+        self.rules = rules
+
+def parse_users(path):
+    """Return the users and the groups from users.xml."""
+    users = {}
+    groups = {}
+    tree = etree.parse(path)
+    tree.xinclude()
+
+    for user_element in tree.xpath('/users/user'):
+        username = (user_element.findtext('username') or '').strip()
+        if not username:
+            continue
+        group_names = [str(group).strip() for group in user_element.xpath('groups/group/text()')]
+        users[username] = LocalUser(username, groups = group_names, rules = policy.parse_rules(user_element))
+
+    for group_element in tree.xpath('/users/group'):
+        name = (group_element.findtext('name') or '').strip()
+        if not name:
+            continue
+        groups[name] = LocalGroup(name, rules = policy.parse_rules(group_element))
+
+    return users, groups
+
+def load_first(paths, parse, what):
+    """Parse the first file in paths that can be read.  Returns the
+    result and the path that was used, or (None, None)."""
+    for path in paths:
+        try:
+            result = parse(path)
+        except IOError as e:
+            log.debug('Unable to load {what:} from "{p:}": {e:}', what = what, p = path, e = e)
+            continue
+        log.debug('Loaded {what:} from "{p:}"', what = what, p = os.path.realpath(path))
+        return result, path
+    log.warn('Unable to load any {what:}!', what = what)
+    return None, None
+
+def build_snapshot(config_paths = None):
+    """Read all of the configuration files and return a new Snapshot.
+    Nothing that is shared with the current configuration is changed
+    (templates are made by template creators of the snapshot's own),
+    so it is safe to call from a thread other than the reactor's."""
+    # Import here, clients imports config.
+    from secant import clients
+
+    if not config_paths:
+        config_paths = default_config_paths()
+
+    parts, config_path = parse_config(config_paths)
+
+    # Make sure the log level and the default authorization decision
+    # are valid before anything is installed.
+    loglevel.level_named(parts['settings']['log_level'])
+    policy.default_rule(parts['settings']['authorization_default'])
+
+    creators = parts['template_creators']
+    client_index, clients_path = load_first(parts['paths']['clients'],
+                                            lambda path: clients.parse_clients(path, creators),
+                                            'clients')
+    if client_index is None:
+        client_index = clients.ClientIndex()
+
+    users_and_groups, users_path = load_first(parts['paths']['users'], parse_users, 'users')
+    if users_and_groups is None:
+        users_and_groups = {}, {}
+    users, groups = users_and_groups
+
+    default_replies = replies.PromptReplies(parts['prompts'])
+    for client in client_index.clients.values():
+        if client.prompts:
+            client.prompt_replies = replies.PromptReplies(parts['prompts'], client)
+        else:
+            client.prompt_replies = default_replies
+
+    mtimes = {}
+    for path in [config_path, clients_path, users_path]:
+        if path is not None:
+            mtimes[path] = os.stat(path).st_mtime
+
+    return Snapshot(generation = None,
+                    config_paths = list(config_paths),
+                    mtimes = mtimes,
+                    paths = freeze(parts['paths']),
+                    template_search_paths = freeze(parts['template_search_paths']),
+                    globals = freeze(parts['globals']),
+                    messages = freeze(parts['messages']),
+                    prompts = freeze(parts['prompts']),
+                    prompt_replies = default_replies,
+                    log_formats = freeze(parts['log_formats']),
+                    settings = freeze(parts['settings']),
+                    clients = client_index,
+                    users = freeze(users),
+                    groups = freeze(groups),
+                    policy = policy.Policies(users, groups))
+
+current = None
+generation = 0
+
+def install(snapshot):
+    """Make snapshot the current configuration.  The module level
+    names paths, globals, messages, prompts, log_formats and settings
+    are pointed at the parts of the new snapshot."""
+    global current, generation
+    global paths, globals, messages, prompts, log_formats, settings
+
+    loglevel.set_level(snapshot.settings['log_level'])
+
+    generation += 1
+    object.__setattr__(snapshot, 'generation', generation)
+
+    paths = snapshot.paths
+    globals = snapshot.globals
+    messages = snapshot.messages
+    prompts = snapshot.prompts
+    log_formats = snapshot.log_formats
+    settings = snapshot.settings
+    current = snapshot
+
+    return snapshot
+
+def load_config(config_paths = None):
+    return install(build_snapshot(config_paths))
+
+# Until load_config() is called everything is at its default.  There
+# are no clients yet; clients imports this module so the empty index
+# can't be built here.
+install(Snapshot(generation = None,
+                 config_paths = [],
+                 mtimes = {},
+                 paths = freeze(default_paths),
+                 template_search_paths = freeze({}),
+                 globals = freeze(default_globals),
+                 messages = freeze(default_messages),
+                 prompts = freeze(default_prompts),
+                 prompt_replies = replies.PromptReplies(default_prompts),
+                 log_formats = freeze({}),
+                 settings = freeze(default_settings),
+                 clients = None,
+                 users = freeze({}),
+                 groups = freeze({}),
+                 policy = policy.Policies()))
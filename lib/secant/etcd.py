@@ -0,0 +1,239 @@
+# -*- mode: python; coding: utf-8 -*-
+
+# Copyright © 2008,2010 by Jeffrey C. Ollie
+#
+# This file is part of Secant.
+#
+# Secant is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Secant is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Secant.  If not, see <http://www.gnu.org/licenses/>.
+
+from twisted.internet import defer
+from twisted.internet import error
+from twisted.internet import task
+from twisted.logger import Logger
+from twisted.web.client import Agent
+from twisted.web.client import FileBodyProducer
+from twisted.web.client import HTTPConnectionPool
+from twisted.web.client import readBody
+from twisted.web.http_headers import Headers
+
+import io
+import json
+import random
+import urllib.parse
+
+from secant import config
+
+class EtcdError(Exception):
+    def __init__(self, errorCode = None, message = None, cause = None, index = None, **kw):
+        Exception.__init__(self, errorCode, message, cause)
+        self.code = errorCode
+        self.message = message
+        self.cause = cause
+        self.index = index
+
+class EtcdServerError(Exception):
+    def __init__(self, code, body):
+        Exception.__init__(self, code, body)
+        self.code = code
+        self.body = body
+
+class EtcdNode:
+    def __init__(self, key = None, value = None, dir = False, nodes = [],
+                 modifiedIndex = None, createdIndex = None, ttl = None, expiration = None, **kw):
+        self.key = key
+        self.value = value
+        self.dir = dir
+        self.nodes = [EtcdNode(**node) for node in nodes]
+        self.modifiedIndex = modifiedIndex
+        self.createdIndex = createdIndex
+        self.ttl = ttl
+        self.expiration = expiration
+
+class EtcdResponse:
+    def __init__(self, action = None, node = None, prevNode = None, index = None, **kw):
+        self.action = action
+        self.node = EtcdNode(**node) if node is not None else None
+        self.prevNode = EtcdNode(**prevNode) if prevNode is not None else None
+        self.index = index
+
+class EtcdClient:
+    """Client for the etcd v2 keys API.
+
+    All requests share one HTTPConnectionPool so connections to etcd
+    are kept alive and reused between lookups instead of being set up
+    for every authentication and authorization request.  At most
+    pool_size requests are sent at once, the rest wait their turn.
+    Requests that take longer than timeout seconds, counting the wait
+    for their turn and reading the whole response, are cancelled, and
+    requests that fail because of a connection problem, a timeout or
+    a server error are retried up to retries times with a randomized
+    exponential backoff.  Errors reported by etcd itself, like a key
+    that doesn't exist, are not retried.  Only requests that can safely
+    be repeated (reads and unconditional writes) are retried after a
+    failure that could have come after etcd acted on them; a
+    compare-and-swap or a delete is only sent again if the connection
+    to etcd could not be made at all.
+
+    Watches are long polls so they don't count against pool_size and
+    don't time out.
+    """
+
+    log = Logger()
+
+    retryable = (error.ConnectError,
+                 error.ConnectionLost,
+                 error.ConnectionClosed,
+                 error.TimeoutError,
+                 defer.TimeoutError,
+                 defer.CancelledError,
+                 EtcdServerError)
+
+    # Failures that mean the request never reached etcd.  (Not every
+    # ConnectError, a timeout is one too.)
+    not_sent = (error.ConnectionRefusedError,
+                error.DNSLookupError,
+                error.NoRouteError)
+
+    def __init__(self, reactor, url = 'http://127.0.0.1:2379', pool_size = 8,
+                 timeout = 2.0, retries = 2, retry_delay = 0.05):
+        self.reactor = reactor
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+        self.pool = HTTPConnectionPool(reactor, persistent = True)
+        self.pool.maxPersistentPerHost = pool_size
+        self.agent = Agent(reactor, pool = self.pool)
+        self.semaphore = defer.DeferredSemaphore(pool_size)
+
+        self.requests = 0
+        self.retried = 0
+        self.failures = 0
+
+    def close(self):
+        return self.pool.closeCachedConnections()
+
+    def key_url(self, key, params):
+        url = '{}/v2/keys/{}'.format(self.url, urllib.parse.quote(key.lstrip('/')))
+        if params:
+            url += '?' + urllib.parse.urlencode(params)
+        return url.encode('ascii')
+
+    def get(self, key, recursive = False):
+        params = {}
+        if recursive:
+            params['recursive'] = 'true'
+        return self.request(b'GET', self.key_url(key, params))
+
+    def set(self, key, value, prev_index = None, ttl = None):
+        form = {'value': value}
+        if prev_index is not None:
+            form['prevIndex'] = prev_index
+        if ttl is not None:
+            form['ttl'] = ttl
+        return self.request(b'PUT', self.key_url(key, {}), urllib.parse.urlencode(form).encode('ascii'),
+                            idempotent = prev_index is None)
+
+    def delete(self, key):
+        return self.request(b'DELETE', self.key_url(key, {}))
+
+    def watch(self, key, index = None, recursive = False):
+        params = {'wait': 'true'}
+        if recursive:
+            params['recursive'] = 'true'
+        if index is not None:
+            params['waitIndex'] = index
+        return self.send(b'GET', self.key_url(key, params), None)
+
+    def request(self, method, url, body = None, idempotent = None):
+        if idempotent is None:
+            idempotent = method == b'GET'
+        self.requests += 1
+        return self.attempt(method, url, body, idempotent, 0)
+
+    def attempt(self, method, url, body, idempotent, attempt):
+        # Cancelling while waiting for the semaphore takes the request
+        # out of the queue, and cancelling once it is sent aborts the
+        # connection; either way the semaphore is released.
+        d = self.semaphore.run(self.send, method, url, body)
+        d.addTimeout(self.timeout, self.reactor)
+        d.addErrback(self.attemptFailed, method, url, body, idempotent, attempt)
+        return d
+
+    def attemptFailed(self, failure, method, url, body, idempotent, attempt):
+        retryable = self.retryable if idempotent else self.not_sent
+        if not failure.check(*retryable) or attempt >= self.retries:
+            self.failures += 1
+            return failure
+
+        delay = self.retry_delay * (2 ** attempt) * random.uniform(0.5, 1.5)
+        self.log.debug('etcd request failed ({e:}), retrying in {d:.3f} seconds.', e = failure.value, d = delay)
+        self.retried += 1
+        return task.deferLater(self.reactor, delay, self.attempt, method, url, body, idempotent, attempt + 1)
+
+    def send(self, method, url, body):
+        headers = Headers()
+        producer = None
+        if body is not None:
+            headers.addRawHeader(b'Content-Type', b'application/x-www-form-urlencoded')
+            producer = FileBodyProducer(io.BytesIO(body))
+
+        d = self.agent.request(method, url, headers, producer)
+        d.addCallback(self.gotResponse)
+        return d
+
+    def gotResponse(self, response):
+        d = readBody(response)
+        d.addCallback(self.decodeResponse, response)
+        return d
+
+    def decodeResponse(self, body, response):
+        if response.code >= 500:
+            raise EtcdServerError(response.code, body)
+
+        result = json.loads(body.decode('utf-8'))
+        if 'errorCode' in result:
+            raise EtcdError(**result)
+
+        index = response.headers.getRawHeaders(b'X-Etcd-Index', [None])[0]
+        if index is not None:
+            result['index'] = int(index)
+
+        return EtcdResponse(**result)
+
+    @property
+    def stats(self):
+        return {'requests': self.requests,
+                'retried': self.retried,
+                'failures': self.failures}
+
+client = None
+
+def get_client(reactor = None):
+    """Return the etcd client shared by the whole server, creating it
+    from the settings the first time it is needed."""
+    global client
+
+    if client is None:
+        if reactor is None:
+            from twisted.internet import reactor
+        client = EtcdClient(reactor,
+                            url = config.settings['etcd_url'],
+                            pool_size = config.settings['etcd_pool_size'],
+                            timeout = config.settings['etcd_timeout'],
+                            retries = config.settings['etcd_retries'])
+        reactor.addSystemEventTrigger('before', 'shutdown', client.close)
+
+    return client
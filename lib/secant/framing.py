@@ -0,0 +1,182 @@
+# -*- mode: python; coding: utf-8 -*-
+
+# Copyright © 2008 by Jeffrey C. Ollie
+#
+# This file is part of Secant.
+#
+# Secant is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Secant is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Secant.  If not, see <http://www.gnu.org/licenses/>.
+
+import struct
+
+header_length = 12
+
+length_struct = struct.Struct('!I')
+
+class FrameTooLarge(Exception):
+    pass
+
+class ArenaPool:
+    """Receive buffers (arenas) of a fixed size that are handed back
+    when a connection closes and given to the next connection instead
+    of allocating a new one.  Up to limit free arenas are kept."""
+
+    def __init__(self, size = 16384, limit = 1024):
+        self.size = size
+        self.limit = limit
+        self.free = []
+        self.allocated = 0
+        self.reused = 0
+
+    def acquire(self):
+        if self.free:
+            self.reused += 1
+            return self.free.pop()
+        self.allocated += 1
+        return bytearray(self.size)
+
+    def release(self, arena):
+        # Arenas that were grown for a large frame are left to the
+        # garbage collector.
+        if len(arena) == self.size and len(self.free) < self.limit:
+            self.free.append(arena)
+
+    @property
+    def stats(self):
+        return {'free': len(self.free),
+                'allocated': self.allocated,
+                'reused': self.reused}
+
+arenas = ArenaPool()
+
+class FrameBuffer:
+    """Splits a TCP byte stream into TACACS+ frames.
+
+    Received data goes into an arena, a preallocated bytearray taken
+    from arenas the first time anything is received.  buffer[start:end]
+    holds the bytes that have not been consumed yet.  Data can either
+    be fed in, or received straight into the arena by asking for the
+    free space with get_buffer() and then reporting how much was
+    written with buffer_updated() (as an asyncio BufferedProtocol
+    does).  Consuming a frame only moves start; the unconsumed bytes
+    are moved to the front of the arena when more room is needed, and
+    the arena is only replaced by a larger one when a frame does not
+    fit in it.  The arena is never resized in place, so memoryviews of
+    it handed out earlier stay valid.
+
+    Iterating over a FrameBuffer yields (header, body) pairs for every
+    complete frame currently in the buffer.  The header is a 12 byte
+    bytes object and the body is a memoryview into the arena that is
+    only valid until the iteration advances or stops, so it must be
+    decrypted (which copies it) before then.
+
+    A header that advertises a body longer than max_length raises
+    FrameTooLarge as soon as it has been received, without waiting for
+    the body.
+
+    release() gives the arena back to the pool once the connection is
+    closed.
+    """
+
+    # Never offer less than this much room to receive into (or less
+    # than a whole arena if arenas are smaller).
+    min_receive = 2048
+
+    def __init__(self, max_length = None, pool = None):
+        self.pool = arenas if pool is None else pool
+        self.buffer = None
+        self.start = 0
+        self.end = 0
+        self.max_length = max_length
+
+    def __len__(self):
+        return self.end - self.start
+
+    def get_buffer(self, sizehint = -1):
+        """Return a writable memoryview of at least sizehint bytes (or
+        of whatever room there is if sizehint is negative) to receive
+        into."""
+        if self.buffer is None:
+            self.buffer = self.pool.acquire()
+
+        if self.start == self.end:
+            self.start = self.end = 0
+            if len(self.buffer) > self.pool.size and sizehint <= self.pool.size:
+                # Done with a large frame, go back to a normal arena.
+                self.buffer = self.pool.acquire()
+
+        needed = max(sizehint, min(self.min_receive, self.pool.size))
+        if len(self.buffer) - self.end < needed:
+            self.make_room(needed)
+        return memoryview(self.buffer)[self.end:]
+
+    def make_room(self, needed):
+        pending = self.end - self.start
+        if pending + needed <= len(self.buffer):
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+        else:
+            size = len(self.buffer)
+            while size < pending + needed:
+                size *= 2
+            buffer = bytearray(size)
+            buffer[:pending] = self.buffer[self.start:self.end]
+            self.pool.release(self.buffer)
+            self.buffer = buffer
+        self.start = 0
+        self.end = pending
+
+    def buffer_updated(self, nbytes):
+        self.end += nbytes
+
+    def feed(self, data):
+        length = len(data)
+        with self.get_buffer(length) as view:
+            view[:length] = data
+        self.buffer_updated(length)
+
+    def release(self):
+        if self.buffer is not None:
+            self.pool.release(self.buffer)
+            self.buffer = None
+        self.start = self.end = 0
+
+    def peek_length(self):
+        """Return the body length advertised by the next header or None
+        if a complete header has not been received yet."""
+        if len(self) < header_length:
+            return None
+        length = length_struct.unpack_from(self.buffer, self.start + 8)[0]
+        if self.max_length is not None and length > self.max_length:
+            raise FrameTooLarge(length)
+        return length
+
+    def __iter__(self):
+        while True:
+            length = self.peek_length()
+            if length is None:
+                return
+
+            start = self.start + header_length
+            end = start + length
+            if end > self.end:
+                return
+
+            with memoryview(self.buffer) as view:
+                header = bytes(view[self.start:start])
+                body = view[start:end]
+            self.start = end
+
+            try:
+                yield header, body
+            finally:
+                body.release()
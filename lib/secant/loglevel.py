@@ -0,0 +1,41 @@
+# -*- mode: python; coding: utf-8 -*-
+
+# Copyright © 2008,2010 by Jeffrey C. Ollie
+#
+# This file is part of Secant.
+#
+# Secant is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Secant is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Secant.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from twisted.logger import FilteringLogObserver
+from twisted.logger import LogLevel
+from twisted.logger import LogLevelFilterPredicate
+
+# The log level comes from the log_level setting.  Observers wrapped
+# with observer() drop anything below it, and code that is about to do
+# real work to build a log message can ask enabled() first.
+predicate = LogLevelFilterPredicate(defaultLogLevel = LogLevel.info)
+
+def level_named(name):
+    return LogLevel.levelWithName(name.strip().lower())
+
+def set_level(name):
+    predicate.setLogLevelForNamespace('', level_named(name))
+
+def enabled(logger, level):
+    """Will an event at level from logger get past the filter?"""
+    return level >= predicate.logLevelForNamespace(logger.namespace)
+
+def observer(observer):
+    return FilteringLogObserver(observer, [predicate])
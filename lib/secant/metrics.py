@@ -0,0 +1,305 @@
+# -*- mode: python; coding: utf-8 -*-
+
+# Copyright © 2008,2010 by Jeffrey C. Ollie
+#
+# This file is part of Secant.
+#
+# Secant is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Secant is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Secant.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Counters, gauges and latency histograms for the request pipeline,
+served over HTTP in the Prometheus text format.
+
+Nothing is recorded until the metrics endpoint is started.  Every
+place that records something checks enabled first, so with the
+endpoint switched off instrumentation costs a global lookup.  Timers
+are started with
+
+    started = metrics.enabled and metrics.clock()
+
+and only observed if started is set.
+"""
+
+from twisted.web import resource
+from twisted.web import server
+
+import bisect
+import time
+
+from secant import config
+from secant import packet
+
+enabled = False
+
+clock = time.perf_counter
+
+# Upper bounds of the latency histogram buckets in seconds, from a
+# cached authorization decision to an etcd timeout.
+latency_buckets = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labels = ()):
+        self.name = name
+        self.help = help
+        self.labels = list(labels)
+        self.values = {}
+
+    def inc(self, *labels):
+        self.values[labels] = self.values.get(labels, 0) + 1
+
+    def collect(self):
+        return {'name': self.name,
+                'kind': self.kind,
+                'help': self.help,
+                'labels': self.labels,
+                'samples': [[list(labels), value] for labels, value in self.values.items()]}
+
+class Gauge:
+    """A value that is worked out when it is collected.  function
+    returns a number, or with labels a dictionary of label value
+    tuples to numbers."""
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, function, labels = ()):
+        self.name = name
+        self.help = help
+        self.function = function
+        self.labels = list(labels)
+
+    def collect(self):
+        values = self.function()
+        if not self.labels:
+            values = {(): values}
+        return {'name': self.name,
+                'kind': self.kind,
+                'help': self.help,
+                'labels': self.labels,
+                'samples': [[list(labels), value] for labels, value in values.items()]}
+
+class Histogram:
+    """Counts of observations in each bucket, kept per combination of
+    label values.  The counts are not cumulative until rendered."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels = (), buckets = latency_buckets):
+        self.name = name
+        self.help = help
+        self.labels = list(labels)
+        self.buckets = list(buckets)
+        self.values = {}
+
+    def observe(self, value, *labels):
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def collect(self):
+        return {'name': self.name,
+                'kind': self.kind,
+                'help': self.help,
+                'labels': self.labels,
+                'buckets': self.buckets,
+                'samples': [[list(labels), list(counts), total] for labels, (counts, total) in self.values.items()]}
+
+class Registry:
+    """The metrics of one process, by name.  Registering a metric with
+    a name that is already taken replaces the old one."""
+
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels = ()):
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name, help, function, labels = ()):
+        return self.register(Gauge(name, help, function, labels))
+
+    def histogram(self, name, help, labels = (), buckets = latency_buckets):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def collect(self):
+        """Return every metric as a family, plain lists and
+        dictionaries that can be sent to the supervisor as JSON."""
+        return [metric.collect() for metric in self.metrics.values()]
+
+registry = Registry()
+
+stage_seconds = registry.histogram('secant_stage_seconds',
+                                   'Time spent in each stage of handling requests.',
+                                   ['stage'])
+request_seconds = registry.histogram('secant_request_seconds',
+                                     'Time from handing a request to its session to writing the reply.',
+                                     ['type', 'status'])
+connections = registry.counter('secant_connections_total',
+                               'Connections, by whether they were accepted or why they were rejected.',
+                               ['result'])
+dropped = registry.counter('secant_connections_dropped_total',
+                           'Connections dropped for an oversized body or a read or idle timeout.',
+                           ['reason'])
+rejections = registry.counter('secant_rejections_total',
+                              'Sessions and authentication attempts turned away by rate limits.',
+                              ['reason'])
+sessions = registry.counter('secant_sessions_total',
+                            'Sessions started.',
+                            ['type'])
+errors = registry.counter('secant_errors_total',
+                          'Requests whose session handler failed.',
+                          ['type'])
+
+def observe_stage(stage, started):
+    """Record the time since started for stage and return the time
+    now, which is where the next stage starts."""
+    now = clock()
+    stage_seconds.observe(now - started, stage)
+    return now
+
+def time_deferred(d, stage):
+    """Record the time until d fires for stage."""
+    started = clock()
+
+    def fired(result):
+        observe_stage(stage, started)
+        return result
+
+    d.addBoth(fired)
+    return d
+
+packet_types = {packet.TAC_PLUS_AUTHEN: 'authentication',
+                packet.TAC_PLUS_AUTHOR: 'authorization',
+                packet.TAC_PLUS_ACCT: 'accounting'}
+
+def status_names(prefix):
+    return {value: name[len(prefix):].lower() for name, value in vars(packet).items() if name.startswith(prefix)}
+
+reply_statuses = {packet.AuthenticationReply: ('authentication_status', status_names('TAC_PLUS_AUTHEN_STATUS_')),
+                  packet.AuthorizationResponse: ('authorization_status', status_names('TAC_PLUS_AUTHOR_STATUS_')),
+                  packet.AccountingReply: ('accounting_status', status_names('TAC_PLUS_ACCT_STATUS_'))}
+
+def packet_type(request):
+    return packet_types.get(request.packet_type, 'unknown')
+
+def reply_status(reply):
+    if reply is None:
+        return 'none'
+    attribute, names = reply_statuses[type(reply)]
+    status = getattr(reply, attribute)
+    return names.get(status, str(status))
+
+def observe_request(request, reply, started):
+    request_seconds.observe(clock() - started, packet_type(request), reply_status(reply))
+
+def stats_families(stats):
+    """Turn the stats dictionaries of collect_stats into families, one
+    per number."""
+    families = []
+    for section, values in sorted(stats.items()):
+        for key, value in sorted(values.items()):
+            if isinstance(value, (int, float)):
+                families.append({'name': 'secant_{}_{}'.format(section, key),
+                                 'kind': 'untyped',
+                                 'help': 'The {} {} statistic.'.format(section, key),
+                                 'labels': [],
+                                 'samples': [[[], value]]})
+    return families
+
+def add_label(families, name, value):
+    """Return families with a label added to every sample."""
+    return [dict(family,
+                 labels = [name] + family['labels'],
+                 samples = [[[value] + sample[0]] + sample[1:] for sample in family['samples']])
+            for family in families]
+
+def merge_families(families):
+    """Put the samples of families with the same name together, they
+    have to be next to each other in the output."""
+    merged = {}
+    for family in families:
+        existing = merged.get(family['name'])
+        if existing is None:
+            merged[family['name']] = dict(family, samples = list(family['samples']))
+        else:
+            existing['samples'].extend(family['samples'])
+    return list(merged.values())
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, escape(value)) for name, value in zip(names, values)) + '}'
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(int(value))
+
+def render(families):
+    """Return families in the Prometheus text exposition format."""
+    lines = []
+    for family in merge_families(families):
+        name = family['name']
+        names = family['labels']
+        lines.append('# HELP {} {}'.format(name, family['help']))
+        lines.append('# TYPE {} {}'.format(name, family['kind']))
+
+        if family['kind'] == 'histogram':
+            bounds = [repr(float(bound)) for bound in family['buckets']] + ['+Inf']
+            for values, counts, total in family['samples']:
+                cumulative = 0
+                for bound, count in zip(bounds, counts):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(name, format_labels(names + ['le'], values + [bound]), cumulative))
+                lines.append('{}_sum{} {}'.format(name, format_labels(names, values), format_value(float(total))))
+                lines.append('{}_count{} {}'.format(name, format_labels(names, values), cumulative))
+
+        else:
+            for values, value in family['samples']:
+                lines.append('{}{} {}'.format(name, format_labels(names, values), format_value(value)))
+
+    return '\n'.join(lines) + '\n'
+
+class MetricsResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, collect):
+        resource.Resource.__init__(self)
+        self.collect = collect
+
+    def render_GET(self, request):
+        request.setHeader(b'content-type', b'text/plain; version=0.0.4; charset=utf-8')
+        return render(self.collect()).encode('utf-8')
+
+def enable():
+    global enabled
+    enabled = True
+
+def listen(reactor, collect):
+    """Start recording and serve the families returned by collect on
+    the metrics_address and metrics_port settings."""
+    enable()
+    site = server.Site(MetricsResource(collect))
+    site.noisy = False
+    return reactor.listenTCP(config.settings['metrics_port'], site, interface = config.settings['metrics_address'])
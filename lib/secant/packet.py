@@ -19,8 +19,10 @@
 
 from twisted.logger import Logger
 
+import array
+import collections
 import hashlib
-import re
+import itertools
 import struct
 
 TAC_PLUS_MAJOR_VER               = 0x0c
@@ -128,21 +130,27 @@ class PacketError(Exception):
     def __init__(self, message):
         self.message = message
 
-argument_re = re.compile(r'^([^=*]+)([=*])(.*)$')
+def split_argument(argument):
+    """Split an AV pair at the first = or * into key, value and
+    whether the pair is optional (separated by *)."""
+    key, separator, value = argument.partition('=')
+    if '*' in key:
+        key, separator, value = argument.partition('*')
+
+    if not key or not separator:
+        raise PacketError('Argument does not match!')
+
+    return key, value, separator == '*'
 
 class Argument:
+    __slots__ = ('key', 'value', 'is_optional')
+
     def __init__(self, argument = None, key = None, value = None, is_optional = False):
         if isinstance(argument, (str, bytes)):
             if isinstance(argument, bytes):
                 argument = argument.decode('ascii')
 
-            argument_match = argument_re.match(argument)
-            if not argument_match:
-                raise PacketError('Argument does not match!')
-
-            self.key = argument_match.group(1)
-            self.value = argument_match.group(3)
-            self.is_optional = argument_match.group(2) == '*'
+            self.key, self.value, self.is_optional = split_argument(argument)
 
         elif key is not None and value is not None:
             if isinstance(key, bytes):
@@ -190,9 +198,123 @@ class Argument:
         value = self.value.encode('ascii')
         return len(key) + len(value) + 1
 
+class Arguments:
+    """The AV pairs of a received packet.  Rather than an Argument for
+    every pair only the plaintext body and where each pair lies within
+    it are kept, and a pair is only decoded when it is looked at.  The
+    pairs follow each other in the body, so pair i runs from bounds[i]
+    to bounds[i + 1].
+
+    Looking a pair up by key builds an index from keys to positions
+    the first time, which is all most requests ever need: the
+    authorization handler only asks for service, cmd and cmd-arg.
+
+    Pairs that run past the end of the body or that aren't ASCII are
+    rejected with PacketError as the packet is unpacked.  A pair with
+    no key or no separator is rejected the first time the pairs are
+    looked at, by key, one at a time or as raw pairs, before any of
+    them is used."""
+
+    __slots__ = ('body', 'bounds', 'index')
+
+    def __init__(self, body, index, lengths):
+        self.body = body
+        self.bounds = array.array('I', itertools.accumulate(lengths, initial = index))
+        self.index = None
+        if self.bounds[-1] > len(body):
+            raise PacketError('Arguments run past the end of the body!')
+        if not body[index:self.bounds[-1]].isascii():
+            raise PacketError('Argument is not ASCII!')
+
+    def __len__(self):
+        return len(self.bounds) - 1
+
+    def raw(self, item):
+        """Return pair item as it was received."""
+        if item < 0:
+            item += len(self)
+        if not 0 <= item < len(self):
+            raise IndexError('argument index out of range')
+        return self.body[self.bounds[item]:self.bounds[item + 1]]
+
+    def slices(self):
+        """Yield every pair as it was received, unchecked."""
+        body = self.body
+        bounds = self.bounds
+        for start, end in zip(bounds, itertools.islice(bounds, 1, None)):
+            yield body[start:end]
+
+    def raw_pairs(self):
+        """Yield every pair as it was received."""
+        for pair in self.slices():
+            # The first separator must come after at least one byte of
+            # key, as split_argument() requires.
+            if pair[:1] in b'=*' or (b'=' not in pair and b'*' not in pair):
+                raise PacketError('Argument does not match!')
+            yield pair
+
+    def __getitem__(self, item):
+        return Argument(self.raw(item))
+
+    def __iter__(self):
+        # Argument checks each pair itself.
+        for pair in self.slices():
+            yield Argument(pair)
+
+    def build_index(self):
+        # Only the keys are needed.  Latin-1 maps every byte to one
+        # character, so positions in text are positions in the body
+        # and the whole body is decoded in a single call.  Each pair
+        # is checked the way split_argument() would check it.
+        text = self.body.decode('latin-1')
+        bounds = self.bounds
+        index = {}
+        for position in range(len(bounds) - 1):
+            start = bounds[position]
+            end = bounds[position + 1]
+            separator = text.find('=', start, end)
+            star = text.find('*', start, separator if separator >= 0 else end)
+            if star >= 0:
+                separator = star
+            if separator <= start:
+                raise PacketError('Argument does not match!')
+            index.setdefault(text[start:separator], []).append(position)
+        self.index = index
+
+    def positions(self, key):
+        if self.index is None:
+            self.build_index()
+        return self.index.get(key, ())
+
+    def __contains__(self, key):
+        return bool(self.positions(key))
+
+    def get(self, key, default = None):
+        """Return the value of the first pair with the given key."""
+        positions = self.positions(key)
+        if not positions:
+            return default
+        return self.value_at(positions[0], key)
+
+    def get_all(self, key):
+        """Return the values of every pair with the given key, in the
+        order they were received."""
+        return [self.value_at(position, key) for position in self.positions(key)]
+
+    def value_at(self, position, key):
+        # The key is known from the index, so the value is simply
+        # everything after it and the separator.
+        return self.body[self.bounds[position] + len(key) + 1:self.bounds[position + 1]].decode('ascii')
+
+    def __repr__(self):
+        return repr(list(self))
+
 def pseudo_pad(header, secret_key):
     """Generate pseudo pad that is used to encrypt the packet body.
     Algotithm is described in section 5 of the TACACS+ Internet Draft.
+
+    This yields the pad one byte at a time and is kept as the
+    reference implementation for pseudo_pad_block().
     """
     md5_1 = hashlib.md5()
     md5_1.update(header[4:8]) # session_id
@@ -209,40 +331,177 @@ def pseudo_pad(header, secret_key):
         md5_n.update(hash)
         hash = md5_n.digest()
 
+def pseudo_pad_seed(header, secret_key):
+    """Return the MD5 state that every step of the pseudo pad chain
+    starts from: MD5(session_id, key, version, seq_no)."""
+    md5_1 = hashlib.md5()
+    md5_1.update(header[4:8]) # session_id
+    md5_1.update(secret_key)
+    md5_1.update(header[:1])  # version
+    md5_1.update(header[2:3]) # seq_no
+    return md5_1
+
+def extend_pad(md5_1, pad, length):
+    """Continue the MD5 chain of a partially generated pad until it is
+    at least length bytes long.  pad must be empty or a whole number
+    of 16 byte digests."""
+    if len(pad) >= length:
+        return pad
+
+    if pad:
+        hash = pad[-16:]
+        hashes = [pad]
+    else:
+        hash = None
+        hashes = []
+
+    for i in range(len(pad) // 16, (length + 15) // 16):
+        if hash is None:
+            hash = md5_1.digest()
+        else:
+            md5_n = md5_1.copy()
+            md5_n.update(hash)
+            hash = md5_n.digest()
+        hashes.append(hash)
+
+    return b''.join(hashes)
+
+def pseudo_pad_block(header, secret_key, length):
+    """Generate the first length bytes of the pseudo pad as a single
+    byte string.  The output is identical to pseudo_pad() but the
+    MD5 chain is computed one 16 byte digest at a time instead of
+    yielding one byte at a time.
+    """
+    return extend_pad(pseudo_pad_seed(header, secret_key), b'', length)[:length]
+
+def xor_bytes(data, pad):
+    """XOR data with the start of pad in a single integer operation.
+    pad must be at least as long as data."""
+    length = len(data)
+    if length == 0:
+        return b''
+    result = int.from_bytes(data, 'big') ^ int.from_bytes(pad[:length], 'big')
+    return result.to_bytes(length, 'big')
+
+def crypt_body(header, secret_key, body):
+    """Encrypt or decrypt (the operation is symmetric) a packet body."""
+    return xor_bytes(body, pseudo_pad_block(header, secret_key, len(body)))
+
+class PadCache:
+    """Bounded LRU cache of pseudo pads keyed by (session_id, secret
+    key, version, seq_no).
+
+    The server always answers a request with seq_no + 1 under the same
+    session_id and secret key, so the pad for a reply can be computed
+    with prefetch() while the request is still being handled (waiting
+    for a user lookup or a password hash, for example).  A pad is
+    removed from the cache once it has been used since a sequence
+    number is never reused within a session.  If a cached pad is
+    shorter than the packet that needs it the MD5 chain is continued
+    from the cached prefix instead of being started over.
+
+    The cache is bounded by the approximate number of bytes held and
+    evicts the least recently used pads first.
+    """
+
+    # Rough per-entry overhead of the key tuple, the MD5 object and
+    # the dictionary slot, used when accounting for memory.
+    entry_overhead = 256
+
+    def __init__(self, max_bytes = 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.prefetches = 0
+        self.evictions = 0
+
+    def key(self, header, secret_key):
+        return (header[4:8], secret_key, header[0], header[2])
+
+    def prefetch(self, header, secret_key, length):
+        """Compute and cache at least length bytes of the pad for the
+        packet with the given header."""
+        key = self.key(header, secret_key)
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            md5_1 = pseudo_pad_seed(header, secret_key)
+            pad = b''
+        else:
+            md5_1, pad = entry
+            self.size -= len(pad) + self.entry_overhead
+
+        pad = extend_pad(md5_1, pad, length)
+        self.entries[key] = (md5_1, pad)
+        self.size += len(pad) + self.entry_overhead
+        self.prefetches += 1
+
+        while self.size > self.max_bytes and self.entries:
+            old_key, (old_md5_1, old_pad) = self.entries.popitem(last = False)
+            self.size -= len(old_pad) + self.entry_overhead
+            self.evictions += 1
+
+    def get(self, header, secret_key, length):
+        """Return at least length bytes of the pad for the packet with
+        the given header, taking it out of the cache if it is there."""
+        entry = self.entries.pop(self.key(header, secret_key), None)
+        if entry is None:
+            self.misses += 1
+            return extend_pad(pseudo_pad_seed(header, secret_key), b'', length)
+
+        self.hits += 1
+        md5_1, pad = entry
+        self.size -= len(pad) + self.entry_overhead
+        return extend_pad(md5_1, pad, length)
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    @property
+    def stats(self):
+        return {'entries': len(self.entries),
+                'bytes': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'prefetches': self.prefetches,
+                'evictions': self.evictions}
+
+pad_cache = PadCache()
+
+header_struct = struct.Struct('!BBBBII')
+
 class Packet:
+    """A TACACS+ packet.  Requests from clients are built by
+    parse_request() straight into the class for their type; replies
+    are created from the request they answer with get_reply()."""
+
+    __slots__ = ('header', 'ciphertext_body', 'plaintext_body', 'secret_key',
+                 'major_version', 'minor_version', 'packet_type', 'seq_no',
+                 'header_flags', 'session_id', 'length')
+
     log = Logger()
-    
-    def __init__(self, secret_key = None, reply_to = None, copy_of = None):
 
-        assert reply_to is None or copy_of is None
+    # The packet type of a new packet that is not a reply.
+    default_packet_type = 0
 
+    def __init__(self, secret_key = None, reply_to = None):
         self.header = None
         self.ciphertext_body = None
         self.plaintext_body = None
-        self.secret_key = secret_key
         self.major_version = 0xc
         self.minor_version = 0
-        self.packet_type = 0
-        self.seq_no = 0
-        self.header_flags = 0
-        self.session_id = 0
         self.length = 0
 
-        if copy_of is not None:
-            self.header = copy_of.header
-            self.ciphertext_body = copy_of.ciphertext_body
-            self.plaintext_body = copy_of.plaintext_body
-            self.secret_key = copy_of.secret_key
-            self.major_version = copy_of.major_version
-            self.minor_version = copy_of.minor_version
-            self.packet_type = copy_of.packet_type
-            self.seq_no = copy_of.seq_no
-            self.header_flags = copy_of.header_flags
-            self.session_id = copy_of.session_id
-            self.length = copy_of.length
-            self.unpack_body()
-
-        if reply_to is not None:
+        if reply_to is None:
+            self.secret_key = secret_key
+            self.packet_type = self.default_packet_type
+            self.seq_no = 0
+            self.header_flags = 0
+            self.session_id = 0
+
+        else:
             self.session_id   = reply_to.session_id
             self.seq_no       = reply_to.seq_no + 1
             self.secret_key   = reply_to.secret_key
@@ -254,44 +513,54 @@ class Packet:
         self.unpack_header()
 
     def set_body(self, ciphertext_body):
+        # The body is usually a memoryview into the connection's frame
+        # buffer, which is released once the frame has been decoded,
+        # so only the decrypted copy is kept.
         self.ciphertext_body = ciphertext_body
         self.decrypt_body()
+        self.ciphertext_body = None
         self.unpack_body()
 
     def unpack_header(self):
-        version, self.packet_type, self.seq_no, self.header_flags, self.session_id, self.length = struct.unpack('!BBBBII',
-                                                                                                                self.header)
+        version, self.packet_type, self.seq_no, self.header_flags, self.session_id, self.length = header_struct.unpack(self.header)
         self.major_version = (version >> 4) & 0xf
         self.minor_version = version & 0xf
 
     def decrypt_body(self):
         if (self.header_flags & TAC_PLUS_UNENCRYPTED_FLAG) and (self.secret_key is not None):
-            self.plaintext_body = self.ciphertext_body
+            self.plaintext_body = bytes(self.ciphertext_body[:self.length])
 
         else:
-            self.plaintext_body = bytes([data ^ pad for data, pad in zip(self.ciphertext_body[:self.length],
-                                                                         pseudo_pad(self.header, self.secret_key))])
+            body = self.ciphertext_body[:self.length]
+            self.plaintext_body = xor_bytes(body, pad_cache.get(self.header, self.secret_key, len(body)))
 
     def encrypt_body(self):
         if (self.header_flags & TAC_PLUS_UNENCRYPTED_FLAG) and (self.secret_key is not None):
             self.ciphertext_body = self.plaintext_body
 
         else:
-            self.ciphertext_body = bytes([data ^ pad for data, pad in zip(self.plaintext_body[:self.length],
-                                                                          pseudo_pad(self.header, self.secret_key))])
+            body = self.plaintext_body[:self.length]
+            self.ciphertext_body = xor_bytes(body, pad_cache.get(self.header, self.secret_key, len(body)))
+
+    def prefetch_reply_pad(self, length = 64):
+        """Warm the pad cache for the reply to this packet so that
+        encrypting the reply does not have to wait on MD5."""
+        if (self.header_flags & TAC_PLUS_UNENCRYPTED_FLAG) and (self.secret_key is not None):
+            return
+        reply = Packet(reply_to = self)
+        reply.pack_header()
+        pad_cache.prefetch(reply.header, self.secret_key, length)
 
     def unpack_body(self):
         pass
 
     def pack_header(self):
-        self.header = struct.pack('!BBBBII',
-                                  ((self.major_version & 0xf) << 4) | (self.minor_version & 0xf),
-                                  self.packet_type,
-                                  self.seq_no,
-                                  self.header_flags,
-                                  self.session_id,
-                                  self.length)
-
+        self.header = header_struct.pack(((self.major_version & 0xf) << 4) | (self.minor_version & 0xf),
+                                         self.packet_type,
+                                         self.seq_no,
+                                         self.header_flags,
+                                         self.session_id,
+                                         self.length)
 
     def pack_body(self):
         pass
@@ -302,9 +571,14 @@ class Packet:
         self.encrypt_body()
         return self.header + self.ciphertext_body
 
+
 class AuthenticationStart(Packet):
-    def __init__(self, secret_key = None, copy_of = None):
-        self.packet_type = TAC_PLUS_AUTHEN
+    __slots__ = ('action', 'priv_lvl', 'authen_type', 'service', 'user', 'port', 'rem_addr', 'data')
+
+    default_packet_type = TAC_PLUS_AUTHEN
+
+    def __init__(self, secret_key = None):
+        Packet.__init__(self, secret_key = secret_key)
 
         self.action = None
         self.priv_lvl = None
@@ -315,15 +589,10 @@ class AuthenticationStart(Packet):
         self.rem_addr = ''
         self.data = b''
 
-        Packet.__init__(self, secret_key = secret_key, copy_of = copy_of)
-
     def get_reply(self):
         return AuthenticationReply(reply_to = self)
 
     def unpack_body(self):
-        if self.plaintext_body is None:
-            raise 'error'
-
         (self.action,
          self.priv_lvl,
          self.authen_type,
@@ -348,7 +617,7 @@ class AuthenticationStart(Packet):
         index += data_len
 
     def pack_body(self):
-        if isinstance(self.data, bytes):
+        if not isinstance(self.data, bytes):
             raise PacketError('data must be a byte string')
         if not isinstance(self.user, str):
             raise PacketError('user must be a unicode string')
@@ -378,16 +647,39 @@ class AuthenticationStart(Packet):
         self.plaintext_body = body
         self.length = len(self.plaintext_body)
 
+
+def authentication_reply_body(status, flags, server_msg, data):
+    if not isinstance(data, bytes):
+        raise PacketError('data must be a byte string')
+    if not isinstance(server_msg, str):
+        raise PacketError('server_msg must be a unicode string')
+
+    try:
+        server_msg = server_msg.encode('ascii')
+    except UnicodeEncodeError:
+        raise PacketError('server_msg must be ASCII text')
+
+    return struct.pack('!BBHH', status, flags, len(server_msg), len(data)) + server_msg + data
+
 class AuthenticationReply(Packet):
-    def __init__(self, reply_to):
+    __slots__ = ('authentication_status', 'authentication_flags', 'server_msg', 'data', 'template')
+
+    def __init__(self, reply_to, template = None):
         assert isinstance(reply_to, (AuthenticationStart, AuthenticationContinue))
 
         Packet.__init__(self, reply_to = reply_to)
 
-        self.authentication_status = None
-        self.authentication_flags = None
-        self.server_msg = ''
-        self.data = b''
+        if template is None:
+            self.authentication_status = None
+            self.authentication_flags = None
+            self.server_msg = ''
+            self.data = b''
+        else:
+            self.authentication_status = template.authentication_status
+            self.authentication_flags = template.authentication_flags
+            self.server_msg = template.server_msg
+            self.data = template.data
+        self.template = template
 
     def unpack_body(self):
         (self.authentication_status,
@@ -404,33 +696,47 @@ class AuthenticationReply(Packet):
         index += data_len
 
     def pack_body(self):
-        if not isinstance(self.data, bytes):
-            raise PacketError('data must be a byte string')
-        if not isinstance(self.server_msg, str):
-            raise PacketError('server_msg must be a unicode string')
+        # A reply made from a template sends the template's body as
+        # it is, the fields only mirror it for logging.
+        if self.template is not None:
+            self.plaintext_body = self.template.body
+        else:
+            self.plaintext_body = authentication_reply_body(self.authentication_status,
+                                                            self.authentication_flags,
+                                                            self.server_msg,
+                                                            self.data)
+        self.length = len(self.plaintext_body)
 
-        server_msg = self.server_msg.encode('ascii')
+class ReplyTemplate:
+    """An authentication reply that is the same every time it is sent,
+    such as a prompt.  The plaintext body is packed once, each reply
+    made from the template only needs its header packed and the body
+    encrypted."""
 
-        body = struct.pack('!BBHH',
-                           self.authentication_status,
-                           self.authentication_flags,
-                           len(server_msg),
-                           len(self.data))
+    __slots__ = ('authentication_status', 'authentication_flags', 'server_msg', 'data', 'body')
 
-        body += server_msg
-        body += self.data
+    def __init__(self, authentication_status, authentication_flags, server_msg, data = b''):
+        self.authentication_status = authentication_status
+        self.authentication_flags = authentication_flags
+        self.server_msg = server_msg
+        self.data = data
+        self.body = authentication_reply_body(authentication_status, authentication_flags, server_msg, data)
 
-        self.plaintext_body = body
-        self.length = len(self.plaintext_body)
+    def reply(self, request):
+        return AuthenticationReply(reply_to = request, template = self)
 
 class AuthenticationContinue(Packet):
-    def __init__(self, secret_key=None, copy_of=None):
+    __slots__ = ('authentication_flags', 'user_msg', 'data')
+
+    default_packet_type = TAC_PLUS_AUTHEN
+
+    def __init__(self, secret_key = None):
+        Packet.__init__(self, secret_key = secret_key)
+
         self.authentication_flags = None
         self.user_msg = ''
         self.data = b''
 
-        Packet.__init__(self, secret_key = secret_key, copy_of = copy_of)
-
     def get_reply(self):
         return AuthenticationReply(reply_to=self)
 
@@ -462,7 +768,12 @@ class AuthenticationContinue(Packet):
         self.length = len(self.plaintext_body)
 
 class AuthorizationRequest(Packet):
-    def __init__(self, secret_key=None, copy_of=None):
+    __slots__ = ('authen_method', 'priv_lvl', 'authen_type', 'authen_service', 'user', 'port', 'rem_addr', 'args')
+
+    default_packet_type = TAC_PLUS_AUTHOR
+
+    def __init__(self, secret_key = None):
+        Packet.__init__(self, secret_key = secret_key)
 
         self.authen_method = None
         self.priv_lvl = None
@@ -473,8 +784,6 @@ class AuthorizationRequest(Packet):
         self.rem_addr = ''
         self.args = []
 
-        Packet.__init__(self, secret_key = secret_key, copy_of = copy_of)
-
     def unpack_body(self):
         (self.authen_method,
          self.priv_lvl,
@@ -499,10 +808,7 @@ class AuthorizationRequest(Packet):
         self.rem_addr = self.plaintext_body[index:index+rem_addr_len].decode('ascii')
         index += rem_addr_len
 
-        self.args = []
-        for arg_length in arg_lengths:
-            self.args.append(Argument(self.plaintext_body[index:index+arg_length]))
-            index += arg_length
+        self.args = Arguments(self.plaintext_body, index, arg_lengths)
 
     def pack_body(self):
         if not isinstance(self.user, str):
@@ -526,14 +832,16 @@ class AuthorizationRequest(Packet):
                            len(rem_addr),
                            len(self.args))
 
-        body += bytes([len(arg) for arg in self.args])
+        args = [bytes(arg) for arg in self.args]
+
+        body += bytes([len(arg) for arg in args])
 
         body += user
         body += port
         body += rem_addr
 
         for arg in args:
-            body += bytes(arg)
+            body += arg
 
         self.plaintext_body = body
         self.length = len(self.plaintext_body)
@@ -542,6 +850,8 @@ class AuthorizationRequest(Packet):
         return AuthorizationResponse(reply_to=self)
 
 class AuthorizationResponse(Packet):
+    __slots__ = ('authorization_status', 'args', 'server_msg', 'data')
+
     def __init__(self, reply_to):
         assert isinstance(reply_to, AuthorizationRequest)
 
@@ -569,10 +879,7 @@ class AuthorizationResponse(Packet):
         self.data = self.plaintext_body[index:index+data_len]
         index += data_len
 
-        self.args = []
-        for arg_length in arg_lengths:
-            self.args.append(Argument(self.plaintext_body[index:index+arg_length]))
-            index += arg_length
+        self.args = Arguments(self.plaintext_body, index, arg_lengths)
 
     def pack_body(self):
         if not isinstance(self.data, bytes):
@@ -601,7 +908,14 @@ class AuthorizationResponse(Packet):
         self.length = len(self.plaintext_body)
 
 class AccountingRequest(Packet):
-    def __init__(self, secret_key = None, copy_of = None):
+    __slots__ = ('accounting_flags', 'authen_method', 'priv_lvl', 'authen_type', 'authen_service',
+                 'user', 'port', 'rem_addr', 'args')
+
+    default_packet_type = TAC_PLUS_ACCT
+
+    def __init__(self, secret_key = None):
+        Packet.__init__(self, secret_key = secret_key)
+
         self.accounting_flags = None
         self.authen_method = None
         self.priv_lvl = None
@@ -612,8 +926,6 @@ class AccountingRequest(Packet):
         self.rem_addr = ''
         self.args = []
 
-        Packet.__init__(self, secret_key=secret_key, copy_of=copy_of)
-
     def unpack_body(self):
         (self.accounting_flags,
          self.authen_method,
@@ -639,10 +951,7 @@ class AccountingRequest(Packet):
         self.rem_addr = self.plaintext_body[index:index+rem_addr_len].decode('ascii')
         index += rem_addr_len
 
-        self.args = []
-        for arg_length in arg_lengths:
-            self.args.append(Argument(self.plaintext_body[index:index+arg_length]))
-            index += arg_length
+        self.args = Arguments(self.plaintext_body, index, arg_lengths)
 
     def pack_body(self):
         if not isinstance(self.user, str):
@@ -667,17 +976,16 @@ class AccountingRequest(Packet):
                            len(rem_addr),
                            len(self.args))
 
+        args = [bytes(arg) for arg in self.args]
+
+        body += bytes([len(arg) for arg in args])
+
         body += user
         body += port
         body += rem_addr
 
-        body += bytes([len(bytes(arg)) for arg in self.args])
-
-        body += server_msg
-        body += self.data
-
-        for arg in self.args:
-            body += bytes(arg)
+        for arg in args:
+            body += arg
 
         self.plaintext_body = body
         self.length = len(self.plaintext_body)
@@ -686,6 +994,8 @@ class AccountingRequest(Packet):
         return AccountingReply(reply_to=self)
 
 class AccountingReply(Packet):
+    __slots__ = ('accounting_status', 'server_msg', 'data')
+
     def __init__(self, reply_to):
         assert isinstance(reply_to, AccountingRequest)
 
@@ -724,3 +1034,23 @@ class AccountingReply(Packet):
 
         self.plaintext_body = body
         self.length = len(self.plaintext_body)
+
+request_types = {TAC_PLUS_AUTHOR: AuthorizationRequest,
+                 TAC_PLUS_ACCT:   AccountingRequest}
+
+def parse_request(header, ciphertext_body, secret_key):
+    """Decode a request from a client directly into the packet class
+    for its type.  An authentication session starts with an
+    AuthenticationStart (sequence number 1) and carries on with
+    AuthenticationContinue packets.  Requests of an unknown type are
+    returned as a plain Packet."""
+    packet_type = header[1]
+    if packet_type == TAC_PLUS_AUTHEN:
+        packet_class = AuthenticationStart if header[2] == 1 else AuthenticationContinue
+    else:
+        packet_class = request_types.get(packet_type, Packet)
+
+    request = packet_class(secret_key)
+    request.set_header(header)
+    request.set_body(ciphertext_body)
+    return request
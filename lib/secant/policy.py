@@ -0,0 +1,240 @@
+# -*- mode: python; coding: utf-8 -*-
+
+# Copyright © 2008,2010 by Jeffrey C. Ollie
+#
+# This file is part of Secant.
+#
+# Secant is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Secant is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Secant.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+
+from twisted.logger import Logger
+
+from secant import packet
+
+# Authorization rules come from users.xml, for users and for groups:
+#
+#   <rule service="shell" cmd="show" status="pass_add">
+#     <cmd-args>ip (route|bgp).*</cmd-args>
+#     <av-pair name="priv-lvl">1</av-pair>
+#   </rule>
+#
+# A missing service or cmd (or "*") matches anything, and cmd-args is
+# a regular expression that has to match all of the command's
+# arguments joined by spaces (without the trailing <cr> that clients
+# send).  The first rule that matches decides, with a user's own rules
+# tried before those of the groups the user is in, in the order the
+# groups are listed.
+
+log = Logger()
+
+statuses = {'pass_add': packet.TAC_PLUS_AUTHOR_STATUS_PASS_ADD,
+            'pass_repl': packet.TAC_PLUS_AUTHOR_STATUS_PASS_REPL,
+            'fail': packet.TAC_PLUS_AUTHOR_STATUS_FAIL}
+
+class PolicyError(Exception):
+    pass
+
+class Rule:
+    __slots__ = ('service', 'command', 'arguments', 'status', 'av_pairs')
+
+    def __init__(self, service = None, command = None, arguments = None, status = 'pass_add', av_pairs = ()):
+        if status not in statuses:
+            raise PolicyError('Unknown authorization status "{}"'.format(status))
+
+        if arguments is not None:
+            try:
+                re.compile(arguments)
+            except re.error as e:
+                raise PolicyError('Bad cmd-args pattern "{}": {}'.format(arguments, e))
+
+        self.service = service
+        self.command = command
+        self.arguments = arguments
+        self.status = status
+        self.av_pairs = tuple(av_pairs)
+
+def wildcard(value):
+    if value is None or value.strip() in ['', '*']:
+        return None
+    return value.strip()
+
+def parse_rules(element):
+    """Return the rules in the <authorization> section of a user or
+    group element."""
+    rules = []
+    for rule_element in element.xpath('authorization/rule'):
+        av_pairs = []
+        for av_pair_element in rule_element.xpath('av-pair'):
+            av_pairs.append(packet.Argument(key = av_pair_element.get('name', '').strip(),
+                                            value = (av_pair_element.text or '').strip(),
+                                            is_optional = av_pair_element.get('optional', '').strip().lower() in ['1', 'yes', 'true', 'on']))
+
+        arguments = rule_element.findtext('cmd-args')
+        if arguments is not None:
+            arguments = arguments.strip()
+
+        rules.append(Rule(service = wildcard(rule_element.get('service')),
+                          command = wildcard(rule_element.get('cmd')),
+                          arguments = arguments,
+                          status = rule_element.get('status', 'pass_add').strip(),
+                          av_pairs = av_pairs))
+    return rules
+
+def normalize_arguments(arguments):
+    """Return the cmd-args of a command without surrounding space or
+    the <cr> that clients add to mark the end of the command."""
+    arguments = tuple(argument.strip() for argument in arguments)
+    if arguments and arguments[-1] == '<cr>':
+        arguments = arguments[:-1]
+    return arguments
+
+def make_default_rule(status):
+    # Passing adds priv-lvl=15, which is what every request was given
+    # before there were rules.
+    if status == 'fail':
+        return Rule(status = status)
+    return Rule(status = status, av_pairs = [packet.Argument(key = 'priv-lvl', value = '15')])
+
+default_rules = {status: make_default_rule(status) for status in statuses}
+
+def default_rule(status):
+    """The rule used when no other rule matches, as chosen by the
+    authorization_default setting."""
+    rule = default_rules.get(status)
+    if rule is None:
+        raise PolicyError('Unknown authorization status "{}"'.format(status))
+    return rule
+
+# Patterns that can't go into a combined expression: they refer to
+# groups by number or name (which change once the pattern is one
+# alternative of many), name groups of their own, or set inline
+# flags, which Python only allows at the start of a whole expression.
+# Escaped backslashes may make this match patterns that would have
+# been fine, which only costs them a regex of their own.
+uncombinable = re.compile(r'\\[1-9]|\(\?P[<=]|\(\?\(|\(\?[aiLmsux]')
+
+def combinable(rule):
+    return rule.arguments is None or uncombinable.search(rule.arguments) is None
+
+class Matcher:
+    """The rules that may apply to one service and command, in order.
+    Each run of rules whose cmd-args patterns can be combined shares a
+    single regular expression; alternatives are tried left to right,
+    so the group that matches belongs to the first rule that matches.
+    Any other rule gets a regular expression of its own."""
+
+    __slots__ = ('rules', 'parts')
+
+    def __init__(self, rules):
+        self.rules = rules
+        # (regex, rules) pairs, tried in order.
+        self.parts = []
+        run = []
+        for rule in rules:
+            if combinable(rule):
+                run.append(rule)
+                continue
+            self.add_run(run)
+            run = []
+            self.add_single(rule)
+        self.add_run(run)
+
+    def add_single(self, rule):
+        self.parts.append((re.compile('.*' if rule.arguments is None else rule.arguments, re.DOTALL), (rule,)))
+
+    def add_run(self, rules):
+        if not rules:
+            return
+        try:
+            regex = re.compile('|'.join('(?P<r{}>{})'.format(i, '.*' if rule.arguments is None else rule.arguments)
+                                        for i, rule in enumerate(rules)),
+                               re.DOTALL)
+        except re.error:
+            for rule in rules:
+                self.add_single(rule)
+            return
+        self.parts.append((regex, tuple(rules)))
+
+    def match(self, arguments):
+        for regex, rules in self.parts:
+            match = regex.fullmatch(arguments)
+            if match is None:
+                continue
+            if len(rules) == 1:
+                return rules[0]
+            return rules[int(match.lastgroup[1:])]
+        return None
+
+def matcher(rules):
+    if not rules:
+        return None
+    return Matcher(rules)
+
+def compile_commands(rules):
+    """Sort the rules for one service by command.  Returns a Matcher
+    for every command named in the rules and one for any other."""
+    commands = {rule.command for rule in rules if rule.command is not None}
+    return ({command: matcher([rule for rule in rules if rule.command in (None, command)]) for command in commands},
+            matcher([rule for rule in rules if rule.command is None]))
+
+class Policy:
+    """The compiled rules of one user, as a trie of services and then
+    commands with a Matcher at each leaf.  A decision is two dictionary
+    lookups and, unless some patterns can't be combined, one run of the
+    combined pattern over the arguments, however many rules there
+    are."""
+
+    __slots__ = ('services', 'other_services')
+
+    def __init__(self, rules):
+        services = {rule.service for rule in rules if rule.service is not None}
+        self.services = {service: compile_commands([rule for rule in rules if rule.service in (None, service)])
+                         for service in services}
+        self.other_services = compile_commands([rule for rule in rules if rule.service is None])
+
+    def decide(self, service, command, arguments):
+        """Return the first rule that matches, or None."""
+        commands, other_commands = self.services.get(service, self.other_services)
+        match = commands.get(command, other_commands)
+        if match is None:
+            return None
+
+        return match.match(' '.join(normalize_arguments(arguments)))
+
+class Policies:
+    """A Policy for every user in users.xml.  Users with the same rules
+    (no rules of their own and the same groups, say) share one."""
+
+    def __init__(self, users = {}, groups = {}):
+        self.empty = Policy([])
+        self.users = {}
+        shared = {}
+
+        for username, user in users.items():
+            rules = list(user.rules)
+            for group_name in user.groups:
+                group = groups.get(group_name)
+                if group is None:
+                    log.warn('User "{u:}" is in unknown group "{g:}"', u = username, g = group_name)
+                    continue
+                rules.extend(group.rules)
+
+            key = tuple(map(id, rules))
+            if key not in shared:
+                shared[key] = Policy(rules)
+            self.users[username] = shared[key]
+
+    def for_user(self, username):
+        return self.users.get(username, self.empty)
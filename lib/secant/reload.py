@@ -0,0 +1,125 @@
+# -*- mode: python; coding: utf-8 -*-
+
+# Copyright © 2008,2010 by Jeffrey C. Ollie
+#
+# This file is part of Secant.
+#
+# Secant is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Secant is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Secant.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import signal
+
+from twisted.internet import task
+from twisted.internet import threads
+from twisted.logger import Logger
+
+from secant import config
+
+class Reloader:
+    """Reload the configuration when the process gets SIGHUP or when
+    one of the configuration files changes.
+
+    The files are parsed in a thread so that a large clients.xml
+    doesn't hold up the reactor, the new snapshot is then installed in
+    one step from the reactor thread.  If the new files can't be parsed
+    the current configuration stays in place.
+    """
+
+    log = Logger()
+
+    def __init__(self, reactor, config_paths = None):
+        self.reactor = reactor
+        self.config_paths = config_paths
+        self.checker = None
+        self.busy = False
+        self.pending = False
+        self.reloads = 0
+        self.failures = 0
+
+    @property
+    def stats(self):
+        return {'generation': config.current.generation,
+                'reloads': self.reloads,
+                'failures': self.failures}
+
+    def start(self):
+        signal.signal(signal.SIGHUP, self.signalled)
+
+        interval = config.settings['reload_check_interval']
+        if interval > 0:
+            self.checker = task.LoopingCall(self.check)
+            self.checker.clock = self.reactor
+            self.checker.start(interval, now = False)
+
+    def stop(self):
+        if self.checker is not None and self.checker.running:
+            self.checker.stop()
+        self.checker = None
+
+    def signalled(self, signum, frame):
+        # Signal handlers can run at awkward moments, do the work from
+        # the reactor.
+        self.reactor.callFromThread(self.reload)
+
+    def changed(self):
+        for path, mtime in config.current.mtimes.items():
+            try:
+                if os.stat(path).st_mtime != mtime:
+                    return True
+            except OSError:
+                return True
+        return False
+
+    def check(self):
+        if self.changed():
+            self.log.info('Configuration files have changed, reloading.')
+            self.reload()
+
+    def buildSnapshot(self, config_paths):
+        return threads.deferToThreadPool(self.reactor,
+                                         self.reactor.getThreadPool(),
+                                         config.build_snapshot,
+                                         config_paths)
+
+    def reload(self):
+        # Only one reload at a time.  Asking again while one is running
+        # means the files may have changed after they were read, so
+        # read them once more when the current reload is done.
+        if self.busy:
+            self.pending = True
+            return
+
+        self.busy = True
+        self.pending = False
+
+        d = self.buildSnapshot(self.config_paths or config.current.config_paths)
+        d.addCallback(self.reloadSucceeded)
+        d.addErrback(self.reloadFailed)
+        d.addBoth(self.reloadFinished)
+
+    def reloadSucceeded(self, snapshot):
+        snapshot = config.install(snapshot)
+        self.reloads += 1
+        self.log.info('Loaded configuration generation {generation:} with {count:} clients.',
+                      generation = snapshot.generation, count = len(snapshot.clients))
+
+    def reloadFailed(self, reason):
+        self.failures += 1
+        self.log.failure('Reloading the configuration failed, keeping the current configuration.', reason)
+
+    def reloadFinished(self, result):
+        self.busy = False
+        if self.pending:
+            self.reload()
@@ -0,0 +1,70 @@
+# -*- mode: python; coding: utf-8 -*-
+
+# Copyright © 2008,2010 by Jeffrey C. Ollie
+#
+# This file is part of Secant.
+#
+# Secant is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Secant is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Secant.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Prompts sent while authenticating.  The prompts don't change
+between replies, so the reply bodies for each are packed when the
+configuration is loaded."""
+
+from secant import packet
+
+# The kind of reply sent with each prompt.
+kinds = {'username': (packet.TAC_PLUS_AUTHEN_STATUS_GETUSER, 0),
+         'password': (packet.TAC_PLUS_AUTHEN_STATUS_GETPASS, packet.TAC_PLUS_REPLY_FLAG_NOECHO),
+         'enable': (packet.TAC_PLUS_AUTHEN_STATUS_GETPASS, packet.TAC_PLUS_REPLY_FLAG_NOECHO),
+         'old_password': (packet.TAC_PLUS_AUTHEN_STATUS_GETPASS, packet.TAC_PLUS_REPLY_FLAG_NOECHO),
+         'old_enable': (packet.TAC_PLUS_AUTHEN_STATUS_GETPASS, packet.TAC_PLUS_REPLY_FLAG_NOECHO),
+         'new_password': (packet.TAC_PLUS_AUTHEN_STATUS_GETPASS, packet.TAC_PLUS_REPLY_FLAG_NOECHO),
+         'new_enable': (packet.TAC_PLUS_AUTHEN_STATUS_GETPASS, packet.TAC_PLUS_REPLY_FLAG_NOECHO),
+         'new_password_again': (packet.TAC_PLUS_AUTHEN_STATUS_GETPASS, packet.TAC_PLUS_REPLY_FLAG_NOECHO),
+         'new_enable_again': (packet.TAC_PLUS_AUTHEN_STATUS_GETPASS, packet.TAC_PLUS_REPLY_FLAG_NOECHO)}
+
+def render(prompt, client = None):
+    if prompt is None:
+        return ''
+    if isinstance(prompt, str):
+        return prompt
+    return prompt.render(client = client)
+
+class PromptReplies:
+    """Reply templates for every prompt, either for a client, with its
+    own prompts taking the place of the global ones, or for clients
+    that don't have any."""
+
+    def __init__(self, prompts, client = None):
+        self.templates = {}
+        for name, (status, flags) in kinds.items():
+            if client is None:
+                prompt = prompts.get(name)
+            else:
+                prompt = client.get_prompt(name, prompts)
+            self.templates[name] = packet.ReplyTemplate(status, flags, render(prompt, client))
+
+    def reply(self, name, request):
+        return self.templates[name].reply(request)
+
+def for_client(client, snapshot):
+    """Return the PromptReplies to use for a client.  Clients that
+    weren't loaded with the configuration get theirs the first time
+    they are needed."""
+    if client is None or not client.prompts:
+        return snapshot.prompt_replies
+    if client.prompt_replies is None:
+        client.prompt_replies = PromptReplies(snapshot.prompts, client)
+    return client.prompt_replies
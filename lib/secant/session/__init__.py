@@ -17,14 +17,26 @@
 # You should have received a copy of the GNU General Public License
 # along with Secant.  If not, see <http://www.gnu.org/licenses/>.
 
-__all__ = ['authentication', 'authorization', 'accounting', 'SessionHandler']
+__all__ = ['authentication', 'authorization', 'accounting', 'table', 'SessionHandler']
+
+from secant import config
 
 class SessionHandler:
-    def __init__(self, client, session_id):
+    def __init__(self, client, session_id, peer = None):
         self.client = client
         self.session_id = session_id
+        # The address the session's connection came from.
+        self.peer = peer
         self.last_seq = 0
+        self.finished = False
+        # A session sees the configuration as it was when the session
+        # started, even if it is reloaded while the session is running.
+        self.snapshot = config.current
 
     def process_request(self, request):
         pass
 
+    def reply_sent(self, reply):
+        # Most sessions are a single request and reply.
+        self.finished = True
+
@@ -20,22 +20,20 @@
 from twisted.logger import Logger
 from twisted.internet import defer
 
+from secant import metrics
 from secant import session
 from secant import packet
+from secant import spool
 
 import time
-#import paisley
 
 class AccountingSessionHandler(session.SessionHandler):
     log = Logger()
     
-    def __init__(self, client, session_id):
-        session.SessionHandler.__init__(self, client, session_id)
-        #self.server = paisley.CouchDB('127.0.0.1')
+    def __init__(self, client, session_id, peer = None):
+        session.SessionHandler.__init__(self, client, session_id, peer)
 
     def process_request(self, request):
-        request = packet.AccountingRequest(copy_of = request)
-
         doc = {'record_type':      'http://fedorahosted.org/secant/accounting_record',
                'time':             time.time(),
                'session_id':       self.session_id,
@@ -46,19 +44,43 @@ class AccountingSessionHandler(session.SessionHandler):
                'user':             request.user,
                'port':             request.port,
                'rem_addr':         request.rem_addr,
-               'arguments':        {}}
+               'arguments':        {},
+               'av_pairs':         []}
 
         for flag in map(lambda power: pow(2, power), range(0,8)):
             if request.accounting_flags & flag:
                 doc['accounting_flags'][request.accounting_flags & flag] = packet.acct_flag_map.get(request.accounting_flags & flag, '')
 
-        for argument in request.args:
+        # Keep the pairs as they were received as well, the arguments
+        # map only has room for one value per key.
+        for pair in request.args.raw_pairs():
+            argument = packet.Argument(pair)
             doc['arguments'][argument.key] = {'value': argument.value,
                                               'is_optional': argument.is_optional}
+            doc['av_pairs'].append(pair.decode('ascii'))
 
         self.log.debug('{d:}', d = doc)
-        
+
+        # Only tell the client the record was accepted once it is
+        # safely in the spool.
+        d = spool.sink.submit(doc)
+        if metrics.enabled:
+            metrics.time_deferred(d, 'spool')
+        d.addCallbacks(self.recordSucceeded, self.recordFailed,
+                       callbackArgs = (request,), errbackArgs = (request,))
+        return d
+
+    def recordSucceeded(self, result, request):
         reply = request.get_reply()
         reply.accounting_status = packet.TAC_PLUS_ACCT_STATUS_SUCCESS
+        return reply
 
-        return defer.succeed(reply) #self.server.saveDoc('secant', doc).addCallback(lambda x: reply)
+    def recordFailed(self, reason, request):
+        reply = request.get_reply()
+        reply.accounting_status = packet.TAC_PLUS_ACCT_STATUS_ERROR
+        if reason.check(spool.AccountingBusy):
+            reply.server_msg = 'Server busy, try again later.'
+        else:
+            self.log.failure('Unable to record accounting request.', reason)
+            reply.server_msg = 'Unable to record accounting request.'
+        return reply
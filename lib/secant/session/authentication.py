@@ -20,16 +20,18 @@
 from twisted.logger import Logger
 from twisted.internet import defer
 
+from secant import admission
 from secant import session
 from secant import packet
 from secant import config
+from secant import replies
 from secant import users
 
 class AuthenticationSessionHandler(session.SessionHandler):
     log = Logger()
 
-    def __init__(self, client, session_id):
-        session.SessionHandler.__init__(self, client, session_id)
+    def __init__(self, client, session_id, peer = None):
+        session.SessionHandler.__init__(self, client, session_id, peer)
         self.reset()
         self.banner_shown = False
 
@@ -48,10 +50,27 @@ class AuthenticationSessionHandler(session.SessionHandler):
         self.rem_addr = None
         self.data = None
     
+    def reply_sent(self, reply):
+        # The session carries on for as long as we are asking the
+        # client for more information.
+        self.finished = reply is None or reply.authentication_status not in [packet.TAC_PLUS_AUTHEN_STATUS_GETDATA,
+                                                                              packet.TAC_PLUS_AUTHEN_STATUS_GETUSER,
+                                                                              packet.TAC_PLUS_AUTHEN_STATUS_GETPASS]
+
     def process_request(self, request):
+        # A session starts with the only packet that has sequence
+        # number 1, anything else is out of step with the session.
+        if isinstance(request, packet.AuthenticationStart) != (self.state == 0):
+            self.log.debug('authentication packet out of sequence')
+            reply = request.get_reply()
+            reply.authentication_status = packet.TAC_PLUS_AUTHEN_STATUS_ERROR
+            reply.authentication_flags = 0
+            reply.server_msg = 'Authentication packet out of sequence.'
+            reply.data = b''
+            return defer.succeed(reply)
+
         if self.state == 0:
             self.log.debug('authentication start')
-            request = packet.AuthenticationStart(copy_of = request)
 
             self.action = request.action
             self.priv_lvl = request.priv_lvl
@@ -64,21 +83,24 @@ class AuthenticationSessionHandler(session.SessionHandler):
             if self.action != packet.TAC_PLUS_AUTHEN_LOGIN:
                 reply = request.get_reply()
                 reply.authentication_status = packet.TAC_PLUS_AUTHEN_STATUS_ERROR
-                reply.user_msg = 'Only LOGIN authentication action is supported.'
+                reply.authentication_flags = 0
+                reply.server_msg = 'Only LOGIN authentication action is supported.'
                 reply.data = b''
                 return defer.succeed(reply)
 
             if self.authen_type != packet.TAC_PLUS_AUTHEN_TYPE_ASCII:
                 reply = request.get_reply()
                 reply.authentication_status = packet.TAC_PLUS_AUTHEN_STATUS_ERROR
-                reply.user_msg = 'Only ASCII authentication type is supported.'
+                reply.authentication_flags = 0
+                reply.server_msg = 'Only ASCII authentication type is supported.'
                 reply.data = b''
                 return defer.succeed(reply)
 
             if self.service not in [ packet.TAC_PLUS_AUTHEN_SVC_LOGIN, packet.TAC_PLUS_AUTHEN_SVC_ENABLE ]:
                 reply = request.get_reply()
                 reply.authentication_status = packet.TAC_PLUS_AUTHEN_STATUS_ERROR
-                reply.user_msg = 'Only LOGIN or ENABLE authentication service is supported.'
+                reply.authentication_flags = 0
+                reply.server_msg = 'Only LOGIN or ENABLE authentication service is supported.'
                 reply.data = b''
                 return defer.succeed(reply)
             
@@ -91,7 +113,6 @@ class AuthenticationSessionHandler(session.SessionHandler):
         
         else:
             self.log.debug('authentication continue')
-            request = packet.AuthenticationContinue(copy_of = request)
 
             if request.authentication_flags & packet.TAC_PLUS_CONTINUE_FLAG_ABORT:
                 self.log.debug('Remote requested abort!')
@@ -158,103 +179,37 @@ class AuthenticationSessionHandler(session.SessionHandler):
                 reply.data = b''
                 return defer.succeed(reply)
 
+    def prompt(self, name, state, request):
+        self.state = state
+        return defer.succeed(replies.for_client(self.client, self.snapshot).reply(name, request))
+
     def request_username(self, request):
         self.log.debug('Requesting username...')
-        reply = request.get_reply()
-        reply.authentication_status = packet.TAC_PLUS_AUTHEN_STATUS_GETUSER
-        reply.authentication_flags = 0
-        
-        # TODO: re-add ability to add a banner and customize prompt
-        reply.server_msg = 'Username: '
-        reply.data = b''
-
-        self.state = 1
-        
-        return defer.succeed(reply)
+        return self.prompt('username', 1, request)
 
     def request_password(self, request):
         self.log.debug('Requesting password...')
-        reply = request.get_reply()
-        reply.authentication_status = packet.TAC_PLUS_AUTHEN_STATUS_GETPASS
-        reply.authentication_flags = packet.TAC_PLUS_REPLY_FLAG_NOECHO
-        
-        if self.service == packet.TAC_PLUS_AUTHEN_SVC_LOGIN:
-            # TODO: re-add ability to customize prompt
-            password_prompt = 'Password: '
-
-        elif self.service == packet.TAC_PLUS_AUTHEN_SVC_ENABLE:
-            # TODO: re-add ability to customize prompt
-            password_prompt = 'Enable: '
-            
-        else:
-            password_prompt = 'Password: '
-
-        reply.server_msg = password_prompt
-        reply.data = b''
-        
-        self.state = 2
-        
-        return defer.succeed(reply)
+        if self.service == packet.TAC_PLUS_AUTHEN_SVC_ENABLE:
+            return self.prompt('enable', 2, request)
+        return self.prompt('password', 2, request)
 
     def request_old_password(self, request):
         self.log.debug('Requesting old password...')
-        reply = request.get_reply()
-        reply.authentication_status = packet.TAC_PLUS_AUTHEN_STATUS_GETPASS
-        reply.authentication_flags = packet.TAC_PLUS_REPLY_FLAG_NOECHO
-        
-        # TODO: re-add ability to customize prompt
-        password_prompt = 'Old Password: '
-
         if self.service == packet.TAC_PLUS_AUTHEN_SVC_ENABLE:
-            # TODO: re-add ability to customize prompt
-            password_prompt = 'Old Enable Password: '
-
-        reply.server_msg = password_prompt
-        reply.data = b''
-        
-        self.state = 3
-        
-        return defer.succeed(reply)
+            return self.prompt('old_enable', 3, request)
+        return self.prompt('old_password', 3, request)
 
     def request_new_password_1(self, request):
         self.log.debug('Requesting new password 1...')
-        reply = request.get_reply()
-        reply.authentication_status = packet.TAC_PLUS_AUTHEN_STATUS_GETPASS
-        reply.authentication_flags = packet.TAC_PLUS_REPLY_FLAG_NOECHO
-        
-        # TODO: re-add ability to customize prompt
-        password_prompt = 'New Password: '
-
         if self.service == packet.TAC_PLUS_AUTHEN_SVC_ENABLE:
-            # TODO: re-add ability to customize prompt
-            password_prompt = 'New Enable Password: '
-
-        reply.server_msg = password_prompt
-        reply.data = b''
-        
-        self.state = 4
-        
-        return defer.succeed(reply)
+            return self.prompt('new_enable', 4, request)
+        return self.prompt('new_password', 4, request)
 
     def request_new_password_2(self, request):
         self.log.debug('Requesting new password 2...')
-        reply = request.get_reply()
-        reply.authentication_status = packet.TAC_PLUS_AUTHEN_STATUS_GETPASS
-        reply.authentication_flags = packet.TAC_PLUS_REPLY_FLAG_NOECHO
-        
-        # TODO: re-add ability to customize prompt
-        password_prompt = 'Re-enter New Password: '
-
         if self.service == packet.TAC_PLUS_AUTHEN_SVC_ENABLE:
-            # TODO: re-add ability to customize prompt
-            password_prompt = 'Re-enter New Enable Password: '
-
-        reply.server_msg = password_prompt
-        reply.data = b''
-        
-        self.state = 5
-        
-        return defer.succeed(reply)
+            return self.prompt('new_enable_again', 5, request)
+        return self.prompt('new_password_again', 5, request)
     
     def process_authentication(self, request):
         if self.username is None:
@@ -265,6 +220,17 @@ class AuthenticationSessionHandler(session.SessionHandler):
             reply.server_msg = 'State machine having problems!'
             reply.data = b''
             return defer.succeed(reply)
+
+        # Fail attempts over the rate limits without looking at the
+        # password, so that guessing can't go any faster.
+        if not admission.control.allow_authentication(self.client, self.username, self.peer):
+            self.log.info('Too many authentication attempts for user "{u:}", failing.', u = self.username)
+            reply = request.get_reply()
+            reply.authentication_status = packet.TAC_PLUS_AUTHEN_STATUS_FAIL
+            reply.authentication_flags = 0
+            reply.server_msg = 'Too many authentication attempts, try again later.'
+            reply.data = b''
+            return defer.succeed(reply)
         
         self.log.debug('looking up user "{u:}"', u = self.username)
         d = users.find_user(self.username)
@@ -326,6 +292,7 @@ class AuthenticationSessionHandler(session.SessionHandler):
         reply = request.get_reply()
 
         self.log.debug('Authentication failed: {r:}!', r = reason)
+        admission.control.authentication_failed(self.username)
         reply.authentication_status = packet.TAC_PLUS_AUTHEN_STATUS_FAIL
         reply.authentication_flags = 0
         reply.server_msg = 'Authentication failed!!!'
@@ -341,6 +308,7 @@ class AuthenticationSessionHandler(session.SessionHandler):
             
         else:
             self.log.debug('Authentication failed!')
+            admission.control.authentication_failed(self.username)
             reply.authentication_status = packet.TAC_PLUS_AUTHEN_STATUS_FAIL
 
         reply.authentication_flags = 0
@@ -350,9 +318,18 @@ class AuthenticationSessionHandler(session.SessionHandler):
         return reply
 
     def authenticationFailed(self, failure, succeeded, password_type, request):
+        reply = request.get_reply()
+
+        if failure.check(users.HashPoolBusy):
+            self.log.debug('Too busy to check the password!')
+            reply.authentication_status = packet.TAC_PLUS_AUTHEN_STATUS_ERROR
+            reply.authentication_flags = 0
+            reply.server_msg = 'Server busy, try again later.'
+            reply.data = b''
+            return reply
+
         self.log.debug('Authentication failed: {r:}!', r = failure)
 
-        reply = request.get_reply()
         reply.authentication_status = packet.TAC_PLUS_AUTHEN_STATUS_FAIL
         reply.authentication_flags = 0
         reply.server_msg = 'Authentication failed!!!'
@@ -375,9 +352,18 @@ class AuthenticationSessionHandler(session.SessionHandler):
         return reply
 
     def changePasswordFailed(self, failure, succeeded, password_type, request):
+        reply = request.get_reply()
+
+        if failure.check(users.HashPoolBusy):
+            self.log.debug('Too busy to check the old password!')
+            reply.authentication_status = packet.TAC_PLUS_AUTHEN_STATUS_ERROR
+            reply.authentication_flags = 0
+            reply.server_msg = 'Server busy, try again later.'
+            reply.data = b''
+            return reply
+
         self.log.debug('Change password failed: {r:}!', r = failure)
 
-        reply = request.get_reply()
         reply.authentication_status = packet.TAC_PLUS_AUTHEN_STATUS_FAIL
         reply.authentication_flags = 0
         reply.server_msg = 'Change password failed!!!'
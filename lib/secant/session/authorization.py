@@ -18,34 +18,133 @@
 # along with Secant.  If not, see <http://www.gnu.org/licenses/>.
 
 from twisted.logger import Logger
+from twisted.logger import LogLevel
 from twisted.internet import defer
+from twisted.internet import reactor
 
-from secant import config
+from secant import cache
+from secant import loglevel
+from secant import metrics
 from secant import session
 from secant import packet
+from secant import policy
 from secant import users
 
+import time
+
 #import paisley
 
+class DecisionCache:
+    """Recent authorization decisions, so that the same command from
+    the same user (automation running show commands on every device,
+    say) is answered without looking the user up or consulting the
+    policy again.
+
+    Decisions are keyed on the configuration generation, the user, the
+    service, the command, its normalized arguments and the group of the
+    client, and are kept for at most authorization_cache_ttl seconds.
+    A new configuration starts a new, empty cache, and the decisions
+    for a user are dropped when the user changes in etcd.  Setting
+    authorization_cache_size to 0 turns the cache off.
+
+    A decision that was being reached while users changed is not
+    stored, it may be based on the old record: every change moves
+    self.epoch on, and store() is given the epoch from when the
+    decision was started.  Each decision also remembers the
+    modifiedIndex of the user record it was reached with.  Without
+    user_cache_watch nothing tells us when a user changes, so a
+    decision is then only used while that is still the record in the
+    user cache.
+    """
+
+    def __init__(self, reactor = reactor):
+        self.reactor = reactor
+        self.generation = 0
+        self.cache = None
+        self.decisions = 0
+        self.decision_time = 0.0
+        self.invalidations = 0
+        self.epoch = 0
+        users.user_cache.listeners.append(self.userChanged)
+
+    def configure(self, snapshot):
+        self.generation = snapshot.generation
+        self.cache = cache.LRUCache(maxsize = snapshot.settings['authorization_cache_size'],
+                                    ttl = snapshot.settings['authorization_cache_ttl'],
+                                    clock = self.reactor)
+
+    def enabled(self, snapshot):
+        # Sessions that started before a reload carry on with their own
+        # snapshot, only a newer one replaces the cache.
+        if self.cache is None or snapshot.generation > self.generation:
+            self.configure(snapshot)
+        return snapshot.settings['authorization_cache_size'] > 0
+
+    def get(self, snapshot, key):
+        if not self.enabled(snapshot):
+            return None
+        entry = self.cache.get(key)
+        if entry is None:
+            return None
+
+        decision, index = entry
+        if not snapshot.settings['user_cache_watch'] and users.user_cache.cached_index(key[1]) != index:
+            self.cache.pop(key)
+            return None
+        return decision
+
+    def store(self, snapshot, key, decision, elapsed, epoch, index):
+        """Remember a decision that took elapsed seconds to reach,
+        started at epoch with the user record at modifiedIndex
+        index."""
+        self.decisions += 1
+        self.decision_time += elapsed
+        if epoch != self.epoch:
+            return
+        if self.enabled(snapshot):
+            self.cache.set(key, (decision, index))
+
+    def userChanged(self, username):
+        self.epoch += 1
+        if self.cache is None:
+            return
+        if username is None:
+            self.cache.clear()
+        else:
+            for key in [key for key in self.cache.entries if key[1] == username]:
+                self.cache.pop(key)
+        self.invalidations += 1
+
+    @property
+    def stats(self):
+        stats = self.cache.stats if self.cache is not None else {'entries': 0, 'hits': 0, 'misses': 0}
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = stats['hits'] / lookups if lookups else 0.0
+        # What the hits would have cost if each had taken as long as
+        # an average decision that was not in the cache.
+        stats['saved_seconds'] = stats['hits'] * self.decision_time / self.decisions if self.decisions else 0.0
+        stats['invalidations'] = self.invalidations
+        return stats
+
+decisions = DecisionCache()
+
 class AuthorizationSessionHandler(session.SessionHandler):
     log = Logger()
 
-    def __init__(self, client, session_id):
-        session.SessionHandler.__init__(self, client, session_id)
-    
-        #self.server = paisley.CouchDB('127.0.0.1')
+    def __init__(self, client, session_id, peer = None):
+        session.SessionHandler.__init__(self, client, session_id, peer)
 
         self.user = None
         self.service = None
         self.command = None
-        self.command_arguments = None
+        self.command_arguments = []
 
     def process_request(self, request):
-        request = packet.AuthorizationRequest(copy_of = request)
+        started = time.monotonic()
 
-        log_message = config.log_formats.get('authorization')
-        if log_message is not None:
-            self.log.debug(log_message.render(session = self, request = request))
+        log_message = self.snapshot.log_formats.get('authorization')
+        if log_message is not None and loglevel.enabled(self.log, LogLevel.debug):
+            self.log.debug('{text:}', text = log_message.render(session = self, request = request))
 
         if request.user == '':
             reply = request.get_reply()
@@ -53,52 +152,61 @@ class AuthorizationSessionHandler(session.SessionHandler):
             reply.server_msg = 'No username supplied!'
             return defer.succeed(reply)
 
+        if loglevel.enabled(self.log, LogLevel.debug):
+            for argument in request.args:
+                self.log.debug('"{k:}" "{v:}"', k = argument.key, v = argument.value)
+
+        # Only the pairs that are asked for get decoded.
+        self.service = request.args.get('service')
+        self.command = request.args.get('cmd')
+        self.command_arguments = request.args.get_all('cmd-arg')
+
+        key = (self.snapshot.generation,
+               request.user,
+               self.service,
+               self.command,
+               policy.normalize_arguments(self.command_arguments),
+               self.client.group if self.client is not None else None)
+
+        decision = decisions.get(self.snapshot, key)
+        if decision is not None:
+            return defer.succeed(self.reply(request, *decision))
+
         d = users.find_user(request.user)
-        d.addCallback(self.findUserSucceeded, request)
+        d.addCallback(self.findUserSucceeded, request, key, started, decisions.epoch)
+        d.addErrback(self.findUserFailed, request)
         return d
 
-    def findUserSucceeded(self, user, request):
+    def findUserSucceeded(self, user, request, key, started, epoch):
         self.user = user
-        
-        for argument in request.args:
-            self.log.debug('"{k:}" "{v:}"', k = argument.key, v = argument.value)
-            if argument.key == 'service':
-                self.service = argument.value
-            if argument.key == 'cmd':
-                self.command = argument.value
-            if argument.key == 'cmd-arg':
-                self.command_arguments.append(argument.value)
-
-        #print service, command, command_arguments
-        #print user.authorization_rules
 
+        # The policy is the one that was current when the session
+        # started.
+        deciding = metrics.enabled and metrics.clock()
+        rule = self.snapshot.policy.for_user(request.user).decide(self.service, self.command, self.command_arguments)
+        if deciding:
+            metrics.observe_stage('authorize', deciding)
+        if rule is None:
+            rule = policy.default_rule(self.snapshot.settings['authorization_default'])
+
+        decision = (policy.statuses[rule.status], rule.av_pairs)
+        decisions.store(self.snapshot, key, decision, time.monotonic() - started,
+                        epoch, user.passwords_index if user is not None else None)
+        return self.reply(request, *decision)
+
+    def findUserFailed(self, reason, request):
+        reply = request.get_reply()
+        reply.args = []
+        if reason.check(users.UnknownUser):
+            self.log.debug('Authorization failed, unknown user "{user:}".', user = request.user)
+            reply.authorization_status = packet.TAC_PLUS_AUTHOR_STATUS_FAIL
+        else:
+            self.log.failure('Error looking up user "{user:}".', reason, user = request.user)
+            reply.authorization_status = packet.TAC_PLUS_AUTHOR_STATUS_ERROR
+        return reply
+
+    def reply(self, request, status, av_pairs):
         reply = request.get_reply()
-        reply.authorization_status = packet.TAC_PLUS_AUTHOR_STATUS_PASS_ADD
-
-        # for authorization_rule in user.authorization_rules:
-        #     if authorization_rule['service'] == self.service and authorization_rule['command'] == self.command:
-        #         if authorization_rule.has_key('status'):
-        #             if authorization_rule['status'] == 'fail':
-        #                 reply.authorization_status = packet.TAC_PLUS_AUTHOR_STATUS_FAIL
-        #             elif authorization_rule['status'] == 'pass_repl':
-        #                 reply.authorization_status = packet.TAC_PLUS_AUTHOR_STATUS_PASS_ADD
-        #             elif authorization_rule['status'] == 'pass_add':
-        #                 reply.authorization_status = packet.TAC_PLUS_AUTHOR_STATUS_PASS_ADD
-        #             else:
-        #                 reply.authorization_status = packet.TAC_PLUS_AUTHOR_STATUS_PASS_ADD
-        #         else:
-        #             reply.authorization_status = packet.TAC_PLUS_AUTHOR_STATUS_PASS_ADD
-        #         if authorization_rule.has_key('arguments'):
-        #             for key in authorization_rule['arguments']:
-        #                 if isinstance(authorization_rule['arguments'][key], dict):
-        #                     value = authorization_rule['arguments'][key].get('value')
-        #                     is_optional = authorization_rule['arguments'][key].get('is_optional', False)
-        #                 else:
-        #                     value = authorization_rule['arguments'][key]
-        #                     is_optional = False
-
-        #                 reply.args.append(packet.Argument(key = key, value = value, is_optional = is_optional))
-        #         break
-        reply.args.append(packet.Argument(key = 'priv-lvl', value = '15', is_optional = False))
-        reply.authorization_status = packet.TAC_PLUS_AUTHOR_STATUS_PASS_ADD
+        reply.authorization_status = status
+        reply.args = list(av_pairs)
         return reply
@@ -0,0 +1,223 @@
+# -*- mode: python; coding: utf-8 -*-
+
+# Copyright © 2008,2010 by Jeffrey C. Ollie
+#
+# This file is part of Secant.
+#
+# Secant is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Secant is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Secant.  If not, see <http://www.gnu.org/licenses/>.
+
+from twisted.logger import Logger
+
+import collections
+import heapq
+
+from secant import config
+from secant import timers
+
+class SessionRegistry:
+    """Keeps track of the live sessions of every connection so that a
+    global limit can be enforced.  Sessions are kept in least recently
+    used order across all connections."""
+
+    log = Logger()
+
+    def __init__(self):
+        self.sessions = collections.OrderedDict()
+        self.completions = 0
+        self.expirations = 0
+        self.evictions = 0
+        self.rejections = 0
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def add(self, table, session_id):
+        self.sessions[(table, session_id)] = None
+
+    def touch(self, table, session_id):
+        self.sessions.move_to_end((table, session_id))
+
+    def discard(self, table, session_id):
+        self.sessions.pop((table, session_id), None)
+
+    def evict(self):
+        """Evict the least recently used idle session from any
+        connection.  Returns False if there is no session that can be
+        evicted."""
+        for table, session_id in self.sessions:
+            if not table.is_busy(session_id):
+                self.log.debug('Evicting least recently used session {session_id:}.', session_id = session_id)
+                table.remove(session_id, 'evicted')
+                return True
+        return False
+
+    @property
+    def stats(self):
+        return {'sessions': len(self.sessions),
+                'completions': self.completions,
+                'expirations': self.expirations,
+                'evictions': self.evictions,
+                'rejections': self.rejections}
+
+registry = SessionRegistry()
+
+class SessionTable:
+    """The session handlers of one connection, keyed by session_id.
+
+    Sessions are removed when their handler reports that it is
+    finished, when they have been idle for longer than the
+    session_idle_timeout setting, or to make room when the connection
+    or the whole server reaches its session limit.  Finished sessions
+    are removed as soon as their reply is sent, so the sessions that
+    are left are waiting for the client (an authentication waiting
+    for a password, say) or for us.  The least recently used of the
+    ones waiting for the client is evicted to make room; sessions with
+    a request outstanding are never expired or evicted, and a new
+    session is only turned away when every session has one.
+
+    Idle expiry uses a heap of deadlines and a single timer on the
+    shared timers.wheel for the earliest one.  Each session has one
+    live entry in the heap, the one whose deadline is in
+    self.deadline_of; an entry that comes due for a session that has
+    been used since it was pushed is simply pushed again with the
+    session's new deadline.  Any other entry (left behind by a session
+    that has been removed, perhaps with its session_id reused since)
+    is skipped.
+    """
+
+    log = Logger()
+
+    def __init__(self, inflight = None, wheel = None, registry = registry):
+        if inflight is None:
+            inflight = {}
+        if wheel is None:
+            wheel = timers.wheel
+        self.wheel = wheel
+        self.clock = wheel.clock
+        self.registry = registry
+        self.inflight = inflight
+        self.handlers = collections.OrderedDict()
+        self.last_used = {}
+        self.deadlines = []
+        self.deadline_of = {}
+        self.timer = None
+
+    def __len__(self):
+        return len(self.handlers)
+
+    def __contains__(self, session_id):
+        return session_id in self.handlers
+
+    def is_busy(self, session_id):
+        return session_id in self.inflight
+
+    def get(self, session_id):
+        handler = self.handlers.get(session_id)
+        if handler is not None:
+            self.handlers.move_to_end(session_id)
+            self.registry.touch(self, session_id)
+            self.last_used[session_id] = self.clock.seconds()
+        return handler
+
+    def add(self, session_id, handler):
+        """Add a new session, evicting idle sessions if a limit has been
+        reached.  Returns False if there was no room for it."""
+        if not self.make_room():
+            self.log.info('Too many sessions, rejecting session {session_id:}.', session_id = session_id)
+            self.registry.rejections += 1
+            return False
+
+        now = self.clock.seconds()
+        self.handlers[session_id] = handler
+        self.last_used[session_id] = now
+        self.registry.add(self, session_id)
+        self.push(now + config.settings['session_idle_timeout'], session_id)
+        self.schedule()
+        return True
+
+    def push(self, deadline, session_id):
+        self.deadline_of[session_id] = deadline
+        heapq.heappush(self.deadlines, (deadline, session_id))
+
+    def make_room(self):
+        while len(self.handlers) >= config.settings['max_sessions_per_connection']:
+            session_id = next((session_id for session_id in self.handlers if not self.is_busy(session_id)), None)
+            if session_id is None:
+                return False
+            self.log.debug('Evicting least recently used session {session_id:}.', session_id = session_id)
+            self.remove(session_id, 'evicted')
+
+        while len(self.registry) >= config.settings['max_sessions']:
+            if not self.registry.evict():
+                return False
+
+        return True
+
+    def remove(self, session_id, reason = 'completed'):
+        if self.handlers.pop(session_id, None) is None:
+            return
+        del self.last_used[session_id]
+        del self.deadline_of[session_id]
+        self.registry.discard(self, session_id)
+
+        if reason == 'completed':
+            self.registry.completions += 1
+        elif reason == 'expired':
+            self.registry.expirations += 1
+        elif reason == 'evicted':
+            self.registry.evictions += 1
+
+    def schedule(self):
+        if not self.deadlines:
+            return
+        deadline = self.deadlines[0][0]
+        if self.timer is not None:
+            if self.timer.deadline <= deadline:
+                return
+            self.wheel.cancel(self.timer)
+        self.timer = self.wheel.schedule(deadline, self.expire)
+
+    def expire(self):
+        self.timer = None
+        now = self.clock.seconds()
+        idle_timeout = config.settings['session_idle_timeout']
+
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, session_id = heapq.heappop(self.deadlines)
+
+            if self.deadline_of.get(session_id) != deadline:
+                # Left behind by a session that has been removed.
+                continue
+
+            if self.is_busy(session_id):
+                self.push(now + idle_timeout, session_id)
+                continue
+
+            last_used = self.last_used[session_id]
+            if last_used + idle_timeout > now:
+                self.push(last_used + idle_timeout, session_id)
+                continue
+
+            self.log.debug('Session {session_id:} has been idle too long, expiring.', session_id = session_id)
+            self.remove(session_id, 'expired')
+
+        self.schedule()
+
+    def clear(self):
+        for session_id in list(self.handlers):
+            self.remove(session_id, 'closed')
+        self.deadlines = []
+        if self.timer is not None:
+            self.wheel.cancel(self.timer)
+        self.timer = None
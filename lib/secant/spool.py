@@ -0,0 +1,418 @@
+# -*- mode: python; coding: utf-8 -*-
+
+# Copyright © 2008,2010 by Jeffrey C. Ollie
+#
+# This file is part of Secant.
+#
+# Secant is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Secant is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Secant.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.internet import task
+from twisted.internet import threads
+from twisted.logger import Logger
+from twisted.python.threadpool import ThreadPool
+from twisted.web.client import Agent
+from twisted.web.client import FileBodyProducer
+from twisted.web.client import HTTPConnectionPool
+from twisted.web.client import readBody
+from twisted.web.http_headers import Headers
+
+import io
+import json
+import os
+import time
+
+from secant import config
+
+class AccountingBusy(Exception):
+    pass
+
+class BackendError(Exception):
+    def __init__(self, code, body):
+        Exception.__init__(self, code, body)
+        self.code = code
+        self.body = body
+
+class Spool:
+    """A directory of append-only segment files holding accounting
+    records, one JSON document per line.  Segments are numbered and a
+    new one is started once the current one grows past segment_size
+    bytes.  Only the sink's writer thread appends, and the drainer
+    reads on the same thread, so there is no locking.
+    """
+
+    suffix = '.jsonl'
+
+    def __init__(self, directory, segment_size = 64 * 1024 * 1024, fsync = True):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self.fd = None
+        self.current = None
+        self.size = 0
+
+    def path(self, number):
+        return os.path.join(self.directory, '%016d%s' % (number, self.suffix))
+
+    def segments(self):
+        result = []
+        for name in os.listdir(self.directory):
+            if name.endswith(self.suffix) and name[:-len(self.suffix)].isdigit():
+                result.append(int(name[:-len(self.suffix)]))
+        return sorted(result)
+
+    def open(self):
+        os.makedirs(self.directory, exist_ok = True)
+        # Always start a new segment, the last one may end with half a
+        # record if the server died while writing it.
+        segments = self.segments()
+        self.openSegment(segments[-1] + 1 if segments else 0)
+
+    def openSegment(self, number):
+        self.fd = os.open(self.path(number), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        self.current = number
+        self.size = os.fstat(self.fd).st_size
+        if self.fsync:
+            # Make sure the new file itself survives a crash.
+            dir_fd = os.open(self.directory, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def append(self, data):
+        """Write data (complete lines) to the current segment, and
+        fsync it if asked to.  Called on the writer thread."""
+        if self.size >= self.segment_size:
+            os.close(self.fd)
+            self.openSegment(self.current + 1)
+
+        view = memoryview(data)
+        while view:
+            written = os.write(self.fd, view)
+            view = view[written:]
+        self.size += len(data)
+
+        if self.fsync:
+            os.fsync(self.fd)
+
+    def read(self, number, offset, limit):
+        """Read up to limit complete records from segment number
+        starting at offset.  Returns the records and the offset just
+        past the last one."""
+        records = []
+        try:
+            f = open(self.path(number), 'rb')
+        except FileNotFoundError:
+            return records, offset
+        with f:
+            f.seek(offset)
+            while len(records) < limit:
+                line = f.readline()
+                if not line.endswith(b'\n'):
+                    # A write that hasn't finished yet.
+                    break
+                records.append(json.loads(line))
+                offset += len(line)
+        return records, offset
+
+    def remove(self, number):
+        try:
+            os.unlink(self.path(number))
+        except FileNotFoundError:
+            pass
+
+class AccountingSink:
+    """Collects accounting records and writes them to the spool in
+    groups.
+
+    submit() queues a record and returns a Deferred that fires once
+    the record has been written (and fsynced, if accounting_fsync is
+    on).  Records are written when accounting_batch_size of them are
+    waiting or accounting_batch_delay seconds after the first one
+    arrived, whichever comes first.  Only one write is outstanding at a
+    time; whatever queues up behind it goes out together in the next
+    one (up to accounting_batch_size records per write), so a busy
+    server does one write and one fsync for many records instead of
+    one for each.
+    """
+
+    log = Logger()
+
+    def __init__(self, reactor = reactor):
+        self.reactor = reactor
+        self.pool = None
+        self.spool = None
+        self.queue = []
+        self.timer = None
+        self.writing = False
+        self.submitted = 0
+        self.committed = 0
+        self.batches = 0
+        self.rejected = 0
+        self.failed = 0
+        self.commit_time = 0.0
+
+    def start(self, directory = None):
+        if directory is None:
+            directory = config.settings['accounting_spool']
+        self.spool = Spool(directory,
+                           segment_size = config.settings['accounting_segment_size'],
+                           fsync = config.settings['accounting_fsync'])
+        self.spool.open()
+        if self.pool is None:
+            self.pool = ThreadPool(minthreads = 1, maxthreads = 1, name = 'secant-spool')
+            self.pool.start()
+        self.reactor.addSystemEventTrigger('during', 'shutdown', self.stop)
+
+    def stop(self):
+        if self.pool is not None:
+            self.pool.stop()
+        self.pool = None
+        if self.spool is not None:
+            self.spool.close()
+
+    def defer(self, f, *a, **kw):
+        """Run f on the writer thread."""
+        return threads.deferToThreadPool(self.reactor, self.pool, f, *a, **kw)
+
+    def submit(self, record):
+        if len(self.queue) >= config.settings['accounting_queue_limit']:
+            self.rejected += 1
+            return defer.fail(AccountingBusy())
+
+        if self.spool is None:
+            self.start()
+
+        d = defer.Deferred()
+        self.queue.append((json.dumps(record, separators = (',', ':')).encode('utf-8') + b'\n', d))
+        self.submitted += 1
+
+        if len(self.queue) >= config.settings['accounting_batch_size']:
+            self.flush()
+        elif self.timer is None:
+            self.timer = self.reactor.callLater(config.settings['accounting_batch_delay'], self.flush)
+
+        return d
+
+    def flush(self):
+        if self.timer is not None:
+            if self.timer.active():
+                self.timer.cancel()
+            self.timer = None
+
+        if self.writing or not self.queue:
+            return
+
+        size = config.settings['accounting_batch_size']
+        batch = self.queue[:size]
+        del self.queue[:size]
+        self.writing = True
+
+        d = self.defer(self.write, b''.join(data for data, ignored in batch))
+        d.addCallbacks(self.writeSucceeded, self.writeFailed,
+                       callbackArgs = (batch,), errbackArgs = (batch,))
+
+    def write(self, data):
+        started = time.monotonic()
+        self.spool.append(data)
+        return time.monotonic() - started
+
+    def writeSucceeded(self, elapsed, batch):
+        self.batches += 1
+        self.committed += len(batch)
+        self.commit_time += elapsed
+        self.writeFinished()
+        for ignored, d in batch:
+            d.callback(None)
+
+    def writeFailed(self, reason, batch):
+        self.log.failure('Writing {count:} accounting records to the spool failed.', reason, count = len(batch))
+        self.failed += len(batch)
+        self.writeFinished()
+        for ignored, d in batch:
+            d.errback(reason)
+
+    def writeFinished(self):
+        self.writing = False
+        if len(self.queue) >= config.settings['accounting_batch_size']:
+            self.flush()
+        elif self.queue and self.timer is None:
+            self.timer = self.reactor.callLater(config.settings['accounting_batch_delay'], self.flush)
+
+    @property
+    def stats(self):
+        return {'queued': len(self.queue),
+                'submitted': self.submitted,
+                'committed': self.committed,
+                'batches': self.batches,
+                'rejected': self.rejected,
+                'failed': self.failed,
+                'commit_seconds': self.commit_time}
+
+class BulkDocsBackend:
+    """Sends accounting records to a CouchDB style _bulk_docs URL."""
+
+    def __init__(self, reactor, url):
+        self.reactor = reactor
+        self.url = url.encode('utf-8')
+        self.pool = HTTPConnectionPool(reactor, persistent = True)
+        self.agent = Agent(reactor, pool = self.pool)
+
+    def send(self, records):
+        body = FileBodyProducer(io.BytesIO(json.dumps({'docs': records}).encode('utf-8')))
+        d = self.agent.request(b'POST', self.url,
+                               Headers({b'Content-Type': [b'application/json']}),
+                               body)
+        d.addCallback(self.checkResponse)
+        return d
+
+    def checkResponse(self, response):
+        d = readBody(response)
+        if response.code >= 300:
+            d.addCallback(lambda body: defer.fail(BackendError(response.code, body)))
+        return d
+
+    def close(self):
+        return self.pool.closeCachedConnections()
+
+class SpoolDrainer:
+    """Forwards spooled records to a backend in the background.
+
+    The position reached so far is kept in a file in the spool
+    directory so nothing is sent twice after a restart unless the
+    process dies between a successful send and saving the position.
+    Segments are removed once everything in them has been sent and the
+    sink has moved on to a newer one.
+    """
+
+    log = Logger()
+
+    def __init__(self, sink, backend, reactor = reactor):
+        self.sink = sink
+        self.backend = backend
+        self.reactor = reactor
+        self.checker = None
+        self.busy = False
+        self.segment = None
+        self.offset = 0
+        self.sent = 0
+        self.failures = 0
+
+    @property
+    def position_path(self):
+        return os.path.join(self.sink.spool.directory, 'position')
+
+    def start(self):
+        if self.sink.spool is None:
+            self.sink.start()
+
+        try:
+            with open(self.position_path) as f:
+                position = json.load(f)
+            self.segment = position['segment']
+            self.offset = position['offset']
+        except FileNotFoundError:
+            segments = self.sink.spool.segments()
+            self.segment = segments[0] if segments else 0
+            self.offset = 0
+
+        self.checker = task.LoopingCall(self.drain)
+        self.checker.clock = self.reactor
+        self.checker.start(config.settings['accounting_drain_interval'])
+
+    def stop(self):
+        if self.checker is not None and self.checker.running:
+            self.checker.stop()
+        self.checker = None
+
+    def drain(self):
+        if self.busy:
+            return
+        self.busy = True
+
+        d = self.sink.defer(self.sink.spool.read, self.segment, self.offset,
+                            config.settings['accounting_drain_batch'])
+        d.addCallback(self.readSucceeded)
+        d.addErrback(self.drainFailed)
+        d.addBoth(self.drainFinished)
+        return d
+
+    def readSucceeded(self, result):
+        records, offset = result
+
+        if not records:
+            if self.segment < self.sink.spool.current:
+                # Everything in this segment has been sent and the
+                # sink has started a newer one.
+                return self.sink.defer(self.nextSegment)
+            return
+
+        d = self.backend.send(records)
+        d.addCallback(self.sendSucceeded, len(records), offset)
+        return d
+
+    def sendSucceeded(self, ignored, count, offset):
+        self.sent += count
+        return self.sink.defer(self.savePosition, self.segment, offset)
+
+    def nextSegment(self):
+        finished = self.segment
+        self.savePosition(finished + 1, 0)
+        self.sink.spool.remove(finished)
+
+    def savePosition(self, segment, offset):
+        path = self.position_path
+        with open(path + '.new', 'w') as f:
+            json.dump({'segment': segment, 'offset': offset}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.new', path)
+        self.segment = segment
+        self.offset = offset
+
+    def drainFailed(self, reason):
+        self.failures += 1
+        self.log.failure('Sending spooled accounting records failed, will try again.', reason)
+
+    def drainFinished(self, result):
+        self.busy = False
+
+    @property
+    def stats(self):
+        return {'segment': self.segment,
+                'offset': self.offset,
+                'sent': self.sent,
+                'failures': self.failures}
+
+sink = AccountingSink()
+
+def start(reactor = reactor, directory = None):
+    """Start the sink, and the drainer if a backend is configured."""
+    sink.start(directory)
+    url = config.settings['accounting_backend_url']
+    if url:
+        backend = BulkDocsBackend(reactor, url)
+        drainer = SpoolDrainer(sink, backend, reactor = reactor)
+        drainer.start()
+        reactor.addSystemEventTrigger('before', 'shutdown', drainer.stop)
+        reactor.addSystemEventTrigger('before', 'shutdown', backend.close)
+        return drainer
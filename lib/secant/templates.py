@@ -17,14 +17,18 @@
 # You should have received a copy of the GNU General Public License
 # along with Secant.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
+
+import genshi.core
 import genshi.template
+import genshi.template.base
 from twisted.logger import Logger
 
 log = Logger()
 
 # DO NOT IMPORT secant.config BECAUSE IT WILL CAUSE CIRCULAR IMPORTS!
 
-class SecantTemplateError:
+class SecantTemplateError(Exception):
     pass
 
 class GenshiTemplate(object):
@@ -35,9 +39,56 @@ class GenshiTemplate(object):
         result = self.template.generate(*a, **kw).render(encoding=None)
         return result
 
+def text_of(value):
+    # The same conversion Genshi applies to the result of an expression.
+    if value is None:
+        return ''
+    if isinstance(value, str):
+        return value
+    if hasattr(value, '__iter__'):
+        return ''.join(text_of(item) for item in value)
+    return str(value)
+
+class FormatTemplate(object):
+    """A text template that is nothing but literal text and ${...}
+    substitutions.  These don't need the Genshi stream machinery, the
+    expressions (already compiled by Genshi, with its lookup rules for
+    names, attributes and items) are evaluated against a Genshi context
+    and the results are dropped into a str.format() string."""
+
+    def __init__(self, stream, filename = None):
+        parts = []
+        self.expressions = []
+        for kind, data, pos in stream:
+            if kind == genshi.core.TEXT:
+                parts.append(data.replace('{', '{{').replace('}', '}}'))
+            else:
+                parts.append('{}')
+                self.expressions.append(data)
+        self.format = ''.join(parts)
+
+    def render(self, *a, **kw):
+        if a and isinstance(a[0], genshi.template.base.Context):
+            context = a[0]
+        else:
+            context = genshi.template.base.Context(**kw)
+        return self.format.format(*[text_of(expression.evaluate(context)) for expression in self.expressions])
+
+    @classmethod
+    def from_genshi(cls, template):
+        """Return a FormatTemplate that renders the same as the Genshi
+        template, or None if the template uses anything other than
+        text and expressions."""
+        stream = template.stream
+        for kind, data, pos in stream:
+            if kind not in [genshi.core.TEXT, genshi.template.base.EXPR]:
+                return None
+        return cls(stream, template.filepath)
+
 class GenshiTemplateCreator(object):
-    def __init__(self, cls):
+    def __init__(self, cls, fast = False):
         self.cls = cls
+        self.fast = fast
         self.loader = genshi.template.TemplateLoader(search_path = [],
                                                      default_encoding = 'utf-8',
                                                      default_class = cls,
@@ -48,15 +99,22 @@ class GenshiTemplateCreator(object):
 
     def create_template(self, source = None, filename = None):
         if source is not None:
-            return GenshiTemplate(self.cls(source,
-                                           encoding = 'utf-8',
-                                           loader = self.loader))
-        if filename is not None:
-            return GenshiTemplate(self.loader.load(filename,
-                                                   cls = self.cls,
-                                                   encoding = 'utf-8'))
-        
-        raise SecantTemplateError()
+            template = self.cls(source,
+                                encoding = 'utf-8',
+                                loader = self.loader)
+        elif filename is not None:
+            template = self.loader.load(filename,
+                                        cls = self.cls,
+                                        encoding = 'utf-8')
+        else:
+            raise SecantTemplateError()
+
+        if self.fast:
+            fast_template = FormatTemplate.from_genshi(template)
+            if fast_template is not None:
+                return fast_template
+
+        return GenshiTemplate(template)
 
 class PlainTemplate(object):
     def __init__(self, source):
@@ -76,35 +134,49 @@ class PlainTemplateCreator(object):
         if source is None and filename is not None:
             if os.path.isabs(filename):
                 try:
-                    source = file(filename, 'rb').read().decode('utf-8')
+                    source = open(filename, 'rb').read().decode('utf-8')
                 except IOError:
                     pass
             else:
                 for search_path in self.search_path:
                     try:
-                        source = file(os.path.join(search_path, filename), 'rb').read().decode('utf-8')
+                        source = open(os.path.join(search_path, filename), 'rb').read().decode('utf-8')
+                        break
                     except IOError:
                         pass
-        assert isinstance(source, unicode)
         if source is None:
             raise SecantTemplateError()
+        assert isinstance(source, str)
 
         return PlainTemplate(source)
 
-template_creators = {'genshi-newtext': GenshiTemplateCreator(cls = genshi.template.NewTextTemplate),
-                     'genshi-oldtext': GenshiTemplateCreator(cls = genshi.template.OldTextTemplate),
-                     'genshi-markup':  GenshiTemplateCreator(cls = genshi.template.MarkupTemplate),
-                     'plain':          PlainTemplateCreator()}
-
-def template_from_element(element):
-    global template_creators
+def make_template_creators(search_paths = {}):
+    """Return a new set of template creators, using the search path in
+    search_paths for each of them that has one.  Every configuration
+    that is loaded gets its own set, so templates that are still being
+    rendered never see the search path of a later configuration."""
+    creators = {'genshi-newtext': GenshiTemplateCreator(cls = genshi.template.NewTextTemplate, fast = True),
+                'genshi-oldtext': GenshiTemplateCreator(cls = genshi.template.OldTextTemplate),
+                'genshi-markup':  GenshiTemplateCreator(cls = genshi.template.MarkupTemplate),
+                'plain':          PlainTemplateCreator()}
+    for name, search_path in search_paths.items():
+        creators[name].update_search_path(list(search_path))
+    return creators
+
+# The creators with no search path, for templates that don't come from
+# a configuration file.
+template_creators = make_template_creators()
+
+def template_from_element(element, creators = None):
+    if creators is None:
+        creators = template_creators
     template_creator_name = element.get('template', 'plain')
-    template_creator = template_creators.get(template_creator_name)
+    template_creator = creators.get(template_creator_name)
     if template_creator is not None:
         log.debug('Using template creator "%s"' % (template_creator_name))
         filename = element.get('filename')
         if filename is None:
-            text = element.xpath('text()')[0].decode()
+            text = element.text or ''
             template = template_creator.create_template(source = text)
         else:
             template = template_creator.create_template(filename = filename)
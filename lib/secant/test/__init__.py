@@ -18,4 +18,30 @@
 # You should have received a copy of the GNU General Public License
 # along with Secant.  If not, see <http://www.gnu.org/licenses/>.
 
-__all__ = ['test_packet', 'test_users']
+__all__ = ['test_packet', 'test_pack', 'test_users', 'test_cipher', 'test_framing', 'test_protocol', 'test_sessions', 'test_etcd', 'test_clients', 'test_reload', 'test_templates', 'test_policy', 'test_spool', 'test_workers', 'test_metrics', 'test_admission', 'test_timers', 'test_aio']
+
+from secant import config
+
+class Installed:
+    """Install a configuration snapshot for the duration of a with
+    block, putting the previous one back afterwards."""
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+    def __enter__(self):
+        self.saved = config.current
+        return config.install(self.snapshot)
+
+    def __exit__(self, *a):
+        config.install(self.saved)
+
+class Settings(Installed):
+    """Override some settings for the duration of a with block."""
+
+    def __init__(self, **kw):
+        self.overrides = kw
+
+    def __enter__(self):
+        self.snapshot = config.current.replace(settings = dict(config.current.settings, **self.overrides))
+        return Installed.__enter__(self)
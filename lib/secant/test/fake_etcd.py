@@ -0,0 +1,175 @@
+#!/usr/bin/python
+# -*- mode: python; coding: utf-8 -*-
+
+# Copyright © 2008 by Jeffrey C. Ollie
+#
+# This file is part of Secant.
+#
+# Secant is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Secant is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Secant.  If not, see <http://www.gnu.org/licenses/>.
+
+# A small in-memory stand-in for the parts of the etcd v2 keys API
+# that Secant uses, so that tests and benchmarks don't need a real
+# etcd server.
+
+from twisted.web import resource
+from twisted.web import server
+
+import json
+import urllib.parse
+
+class FakeEtcd(resource.Resource):
+    isLeaf = True
+
+    def __init__(self):
+        resource.Resource.__init__(self)
+        self.index = 0
+        self.values = {}
+        self.events = []
+        self.waiters = []
+        self.requests = 0
+
+    def node(self, key):
+        value, created_index, modified_index = self.values[key]
+        return {'key': key, 'value': value, 'createdIndex': created_index, 'modifiedIndex': modified_index}
+
+    def directory(self, key, recursive):
+        prefix = key.rstrip('/') + '/'
+        children = {}
+        for child_key in sorted(self.values):
+            if child_key.startswith(prefix):
+                name = child_key[len(prefix):].split('/')[0]
+                children.setdefault(prefix + name, child_key == prefix + name)
+
+        nodes = []
+        for child_key, is_leaf in children.items():
+            if is_leaf:
+                nodes.append(self.node(child_key))
+            elif recursive:
+                nodes.append(self.directory(child_key, True))
+            else:
+                nodes.append({'key': child_key, 'dir': True})
+
+        return {'key': key, 'dir': True, 'nodes': nodes}
+
+    def set(self, key, value):
+        self.index += 1
+        created_index = self.values.get(key, (None, self.index, None))[1]
+        self.values[key] = (value, created_index, self.index)
+        self.notify({'action': 'set', 'node': self.node(key)})
+        return self.index
+
+    def delete(self, key):
+        self.index += 1
+        del self.values[key]
+        self.notify({'action': 'delete', 'node': {'key': key, 'modifiedIndex': self.index}})
+
+    def notify(self, event):
+        self.events.append(event)
+        for waiter in list(self.waiters):
+            request, key, recursive, wait_index = waiter
+            if self.matches(event, key, recursive, wait_index):
+                self.waiters.remove(waiter)
+                request.write(self.encode(request, event))
+                request.finish()
+
+    def matches(self, event, key, recursive, wait_index):
+        event_key = event['node']['key']
+        if event['node']['modifiedIndex'] < wait_index:
+            return False
+        return event_key == key or (recursive and event_key.startswith(key.rstrip('/') + '/'))
+
+    def encode(self, request, result):
+        request.setHeader(b'Content-Type', b'application/json')
+        request.setHeader(b'X-Etcd-Index', str(self.index).encode('ascii'))
+        return json.dumps(result).encode('utf-8')
+
+    def error(self, request, code, error_code, message, key):
+        request.setResponseCode(code)
+        return self.encode(request, {'errorCode': error_code, 'message': message, 'cause': key, 'index': self.index})
+
+    def key(self, request):
+        path = request.path.decode('utf-8')
+        if not path.startswith('/v2/keys'):
+            return None
+        return path[len('/v2/keys'):] or '/'
+
+    def arg(self, request, name, default = None):
+        values = request.args.get(name.encode('ascii'))
+        if not values:
+            return default
+        return values[0].decode('utf-8')
+
+    def render_GET(self, request):
+        self.requests += 1
+        key = self.key(request)
+        if key is None:
+            request.setResponseCode(404)
+            return b''
+
+        recursive = self.arg(request, 'recursive') == 'true'
+
+        if self.arg(request, 'wait') == 'true':
+            wait_index = int(self.arg(request, 'waitIndex', self.index + 1))
+            for event in self.events:
+                if self.matches(event, key, recursive, wait_index):
+                    return self.encode(request, event)
+            waiter = (request, key, recursive, wait_index)
+            self.waiters.append(waiter)
+            request.notifyFinish().addErrback(lambda failure: waiter in self.waiters and self.waiters.remove(waiter))
+            return server.NOT_DONE_YET
+
+        if key in self.values:
+            return self.encode(request, {'action': 'get', 'node': self.node(key)})
+
+        prefix = key.rstrip('/') + '/'
+        if key == '/' or any(child_key.startswith(prefix) for child_key in self.values):
+            return self.encode(request, {'action': 'get', 'node': self.directory(key, recursive)})
+
+        return self.error(request, 404, 100, 'Key not found', key)
+
+    def render_PUT(self, request):
+        self.requests += 1
+        # twisted.web only parses form bodies for POST.
+        request.args.update(urllib.parse.parse_qs(request.content.read()))
+        key = self.key(request)
+        value = self.arg(request, 'value')
+        prev_index = self.arg(request, 'prevIndex')
+        if prev_index is not None and (key not in self.values or self.values[key][2] != int(prev_index)):
+            return self.error(request, 412, 101, 'Compare failed', key)
+        self.set(key, value)
+        return self.encode(request, {'action': 'set', 'node': self.node(key)})
+
+    def render_DELETE(self, request):
+        self.requests += 1
+        key = self.key(request)
+        if key not in self.values:
+            return self.error(request, 404, 100, 'Key not found', key)
+        self.delete(key)
+        return self.encode(request, {'action': 'delete', 'node': {'key': key, 'modifiedIndex': self.index}})
+
+class FakeEtcdSite(server.Site):
+    """Site that counts the TCP connections made to it, to show whether
+    clients are reusing connections."""
+
+    def __init__(self, etcd = None):
+        if etcd is None:
+            etcd = FakeEtcd()
+        self.etcd = etcd
+        self.connections = 0
+        server.Site.__init__(self, etcd)
+        self.noisy = False
+
+    def buildProtocol(self, address):
+        self.connections += 1
+        return server.Site.buildProtocol(self, address)
@@ -0,0 +1,161 @@
+# -*- mode: python; coding: utf-8 -*-
+
+# Copyright © 2008,2010 by Jeffrey C. Ollie
+#
+# This file is part of Secant.
+#
+# Secant is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Secant is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Secant.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from twisted.internet import defer
+from twisted.internet import error
+from twisted.internet.address import IPv4Address
+from twisted.internet.task import Clock
+from twisted.python import failure
+
+from secant import admission
+from secant import clients
+from secant import packet
+from secant import users
+from secant import TacacsProtocolFactory
+from secant.session.authentication import AuthenticationSessionHandler
+from secant.test import Installed
+from secant.test import Settings
+from secant.test.test_protocol import TCPTransport
+from secant.test.test_protocol import accounting_request
+from secant.test.test_protocol import client_snapshot
+from secant.test.test_protocol import connect
+from secant.test.test_protocol import replies
+
+def peer(host):
+    return IPv4Address('TCP', host, 12345)
+
+class TestRateLimiter:
+    def test_1(self):
+        clock = Clock()
+        limiter = admission.RateLimiter('session', clock)
+        with Settings(session_rate = 2.0, session_burst = 3.0):
+            assert [limiter.allow('a') for i in range(4)] == [True, True, True, False]
+            assert limiter.allow('b')
+            clock.advance(0.5)
+            assert limiter.allow('a')
+            assert not limiter.allow('a')
+            assert limiter.rejected == 2
+
+    def test_2(self):
+        limiter = admission.RateLimiter('session', Clock())
+        with Settings(session_rate = 0.0, session_burst = 1.0):
+            assert all(limiter.allow('a') for i in range(100))
+
+    def test_3(self):
+        clock = Clock()
+        limiter = admission.RateLimiter('session', clock)
+        with Settings(session_rate = 1.0, session_burst = 1.0):
+            assert limiter.allow('a')
+            assert not limiter.allow('a')
+        # New limits start again with full buckets.
+        with Settings(session_rate = 1.0, session_burst = 2.0):
+            assert limiter.allow('a')
+
+class TestFactory:
+    def test_1(self):
+        factory = TacacsProtocolFactory()
+        with Installed(client_snapshot()):
+            assert factory.buildProtocol(peer('192.0.2.1')) is None
+            assert factory.buildProtocol(peer('127.0.0.1')) is not None
+
+    def test_2(self):
+        factory = TacacsProtocolFactory()
+        with Installed(client_snapshot().replace(settings = dict(client_snapshot().settings,
+                                                                 max_connections_per_address = 2,
+                                                                 max_connections = 3))):
+            first = factory.buildProtocol(peer('127.0.0.1'))
+            first.makeConnection(TCPTransport())
+            factory.buildProtocol(peer('127.0.0.1')).makeConnection(TCPTransport())
+            assert factory.buildProtocol(peer('127.0.0.1')) is None
+            factory.buildProtocol(peer('127.0.0.2')).makeConnection(TCPTransport())
+            assert factory.buildProtocol(peer('127.0.0.3')) is None
+
+            first.connectionLost(failure.Failure(error.ConnectionDone()))
+            assert factory.addresses['127.0.0.1'] == 1
+            assert factory.buildProtocol(peer('127.0.0.1')) is not None
+
+class TestSessionRate:
+    def test_1(self, monkeypatch):
+        monkeypatch.setattr(admission, 'control', admission.AdmissionControl(Clock()))
+        protocol, transport = connect()
+        with Settings(session_rate = 1.0, session_burst = 2.0):
+            protocol.dataReceived(b''.join(accounting_request(session_id) for session_id in range(1, 4)))
+        result = replies(transport)
+        assert [reply.session_id for reply in result] == [1, 2, 3]
+        assert [reply.plaintext_body[4] for reply in result] == [packet.TAC_PLUS_ACCT_STATUS_SUCCESS,
+                                                                 packet.TAC_PLUS_ACCT_STATUS_SUCCESS,
+                                                                 packet.TAC_PLUS_ACCT_STATUS_ERROR]
+        assert len(protocol.sessions) == 0
+        assert admission.control.stats['session_rate'] == 1
+
+class TestAuthenticationRate:
+    def attempt(self, username):
+        request = packet.AuthenticationContinue(secret_key = b'hello')
+        request.seq_no = 3
+        handler = AuthenticationSessionHandler(None, 1)
+        handler.username = username
+        handler.password = 'secret'
+        handler.service = packet.TAC_PLUS_AUTHEN_SVC_LOGIN
+        result = []
+        handler.process_authentication(request).addCallback(result.append)
+        return result[0].authentication_status
+
+    def test_1(self, monkeypatch):
+        monkeypatch.setattr(admission, 'control', admission.AdmissionControl(Clock()))
+        monkeypatch.setattr('secant.users.find_user', lambda username: defer.succeed(users.AlwaysSucceedUser(username)))
+        # Successful logins don't count against the user.
+        with Settings(user_authentication_rate = 1.0, user_authentication_burst = 2.0):
+            assert [self.attempt('alice') for i in range(5)] == [packet.TAC_PLUS_AUTHEN_STATUS_PASS] * 5
+        assert 'user_authentication_rate' not in admission.control.stats
+
+    def test_2(self, monkeypatch):
+        monkeypatch.setattr(admission, 'control', admission.AdmissionControl(Clock()))
+        monkeypatch.setattr('secant.users.find_user', lambda username: defer.succeed(users.AlwaysSucceedUser(username)))
+        with Settings(authentication_rate = 1.0, authentication_burst = 1.0):
+            assert self.attempt('alice') == packet.TAC_PLUS_AUTHEN_STATUS_PASS
+            assert self.attempt('bob') == packet.TAC_PLUS_AUTHEN_STATUS_FAIL
+        assert admission.control.stats['authentication_rate'] == 1
+
+    def test_3(self, monkeypatch):
+        # Failed ones do, until the user's bucket is empty and even the
+        # right password is turned away.
+        monkeypatch.setattr(admission, 'control', admission.AdmissionControl(Clock()))
+        monkeypatch.setattr('secant.users.find_user', lambda username: defer.succeed(users.AlwaysFailUser(username)))
+        with Settings(user_authentication_rate = 1.0, user_authentication_burst = 2.0):
+            assert [self.attempt('alice') for i in range(3)] == [packet.TAC_PLUS_AUTHEN_STATUS_FAIL] * 3
+            assert admission.control.stats['user_authentication_rate'] == 1
+            monkeypatch.setattr('secant.users.find_user', lambda username: defer.succeed(users.AlwaysSucceedUser(username)))
+            assert self.attempt('alice') == packet.TAC_PLUS_AUTHEN_STATUS_FAIL
+            assert self.attempt('bob') == packet.TAC_PLUS_AUTHEN_STATUS_PASS
+        assert admission.control.stats['user_authentication_rate'] == 2
+
+class TestClientKey:
+    def test_1(self, monkeypatch):
+        # Devices in a network that is one client each get their own
+        # bucket, unless the buckets are per client.
+        monkeypatch.setattr(admission, 'control', admission.AdmissionControl(Clock()))
+        client = clients.Client('10.0.0.0/8', secret = b'hello')
+        with Settings(session_rate = 1.0, session_burst = 1.0):
+            assert admission.control.allow_session(client, '10.0.0.1')
+            assert not admission.control.allow_session(client, '10.0.0.1')
+            assert admission.control.allow_session(client, '10.0.0.2')
+        with Settings(session_rate = 1.0, session_burst = 1.0, rate_limit_by = 'client'):
+            assert admission.control.allow_session(client, '10.0.0.3')
+            assert not admission.control.allow_session(client, '10.0.0.4')
@@ -0,0 +1,158 @@
+#!/usr/bin/python
+# -*- mode: python; coding: utf-8 -*-
+
+# Copyright © 2008 by Jeffrey C. Ollie
+#
+# This file is part of Secant.
+#
+# Secant is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Secant is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Secant.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import socket
+
+from twisted.internet import defer
+from twisted.internet.task import Clock
+
+from secant import aio
+from secant import timers
+from secant import TacacsProtocolFactory
+from secant.test.test_protocol import accounting_request
+from secant.test.test_protocol import connect
+from secant.test.test_protocol import replies
+from secant.test.test_protocol import TCPTransport
+
+class FakeTransport(asyncio.Transport):
+    def __init__(self, peer):
+        super().__init__()
+        self.peer = peer
+        self.written = TCPTransport()
+        self.aborted = False
+        self.closed = False
+        self.reading = True
+
+    def get_extra_info(self, name, default = None):
+        return {'peername': self.peer}.get(name, default)
+
+    def write(self, data):
+        self.written.write(data)
+
+    def close(self):
+        self.closed = True
+
+    def abort(self):
+        self.aborted = True
+
+    def pause_reading(self):
+        self.reading = False
+
+    def resume_reading(self):
+        self.reading = True
+
+def receive(connection, data):
+    view = connection.get_buffer(len(data))
+    assert len(view) >= len(data)
+    view[:len(data)] = data
+    connection.buffer_updated(len(data))
+
+class TestAsDeferred:
+    def test_1(self):
+        result = []
+        aio.as_deferred('reply').addCallback(result.append)
+        d = defer.Deferred()
+        aio.as_deferred(d).addCallback(result.append)
+        d.callback('later')
+        assert result == ['reply', 'later']
+
+    def test_2(self):
+        d = defer.Deferred()
+
+        async def handler():
+            value = await d
+            return value + ' reply'
+
+        result = []
+        aio.as_deferred(handler()).addCallback(result.append)
+        assert result == []
+        d.callback('coroutine')
+        assert result == ['coroutine reply']
+
+class TestConnection:
+    def connection(self, monkeypatch, peer):
+        monkeypatch.setattr(timers, 'wheel', timers.TimerWheel(clock = Clock()))
+        connect()
+        factory = TacacsProtocolFactory()
+        connection = aio.Connection(factory)
+        transport = FakeTransport(peer)
+        connection.connection_made(transport)
+        return factory, connection, transport
+
+    def test_1(self, monkeypatch):
+        factory, connection, transport = self.connection(monkeypatch, ('192.0.2.1', 12345))
+        assert transport.aborted
+        assert connection.protocol is None
+        receive(connection, accounting_request(1))
+        assert transport.written.value() == b''
+
+    def test_2(self, monkeypatch):
+        factory, connection, transport = self.connection(monkeypatch, ('127.0.0.1', 12345))
+        data = accounting_request(1) + accounting_request(2)
+        receive(connection, data[:10])
+        receive(connection, data[10:])
+        assert [reply.session_id for reply in replies(transport.written)] == [1, 2]
+        assert len(factory.connections) == 1
+        frames = connection.protocol.frames
+        arena = frames.buffer
+        connection.connection_lost(None)
+        assert len(factory.connections) == 0
+        assert connection.protocol is None
+        assert frames.buffer is None
+        assert frames.pool.free[-1] is arena
+
+    def test_3(self, monkeypatch):
+        factory, connection, transport = self.connection(monkeypatch, ('127.0.0.1', 12345))
+        connection.protocol.transport.loseConnection()
+        assert transport.closed and not transport.aborted
+        connection.protocol.transport.pauseProducing()
+        assert not transport.reading
+        connection.protocol.transport.resumeProducing()
+        assert transport.reading
+
+class TestPort:
+    def test_1(self, monkeypatch):
+        monkeypatch.setattr(timers, 'wheel', timers.TimerWheel(clock = Clock()))
+        connect()
+        factory = TacacsProtocolFactory()
+
+        async def exchange():
+            sock = socket.socket()
+            sock.bind(('127.0.0.1', 0))
+            port = aio.Port(sock, factory, loop = asyncio.get_running_loop())
+            server = await port.starting
+            reader, writer = await asyncio.open_connection(*sock.getsockname())
+            writer.write(accounting_request(1) + accounting_request(2))
+            data = b''
+            while len(data) < 2 * 17:
+                chunk = await reader.read(1024)
+                if not chunk:
+                    break
+                data += chunk
+            writer.close()
+            await writer.wait_closed()
+            server.close()
+            await server.wait_closed()
+            return data
+
+        transport = TCPTransport()
+        transport.write(asyncio.run(exchange()))
+        assert [reply.session_id for reply in replies(transport)] == [1, 2]
@@ -0,0 +1,97 @@
+#!/usr/bin/python
+# -*- mode: python; coding: utf-8 -*-
+
+# Copyright © 2008 by Jeffrey C. Ollie
+#
+# This file is part of Secant.
+#
+# Secant is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Secant is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Secant.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+
+from secant.packet import *
+
+header = b'\xc1\x01\x03\x00\x12\x34\x56\x78\x00\x00\x00\x00'
+secret = b'secret'
+
+def reference_crypt(header, secret_key, body):
+    return bytes([data ^ pad for data, pad in zip(body, pseudo_pad(header, secret_key))])
+
+class TestPseudoPadBlock:
+    def test_1(self):
+        for length in [0, 1, 15, 16, 17, 31, 32, 33, 1000]:
+            pad = pseudo_pad_block(header, secret, length)
+            assert len(pad) == length
+            assert pad == bytes(b for b, i in zip(pseudo_pad(header, secret), range(length)))
+
+class TestCryptBody:
+    def test_1(self):
+        for length in [0, 1, 16, 64, 255, 4096, 65536]:
+            body = os.urandom(length)
+            assert crypt_body(header, secret, body) == reference_crypt(header, secret, body)
+
+    def test_2(self):
+        body = b'\x00' * 7 + os.urandom(100)
+        assert crypt_body(header, secret, crypt_body(header, secret, body)) == body
+
+    def test_3(self):
+        body = bytearray(os.urandom(50))
+        assert crypt_body(header, secret, memoryview(body)) == reference_crypt(header, secret, bytes(body))
+
+class TestPacketCrypt:
+    def test_1(self):
+        p = Packet(secret_key = secret)
+        p.set_header(header[:8] + b'\x00\x00\x00\x20')
+        body = os.urandom(32)
+        p.ciphertext_body = body
+        p.decrypt_body()
+        assert p.plaintext_body == reference_crypt(p.header, secret, body)
+
+class TestPadCache:
+    def test_1(self):
+        cache = PadCache()
+        assert cache.get(header, secret, 40)[:40] == pseudo_pad_block(header, secret, 40)
+        assert cache.misses == 1
+        assert cache.hits == 0
+
+    def test_2(self):
+        cache = PadCache()
+        cache.prefetch(header, secret, 16)
+        pad = cache.get(header, secret, 100)
+        assert pad[:100] == pseudo_pad_block(header, secret, 100)
+        assert cache.hits == 1
+        assert len(cache.entries) == 0
+        assert cache.size == 0
+
+    def test_3(self):
+        cache = PadCache(max_bytes = 2 * (PadCache.entry_overhead + 64))
+        for seq_no in range(5):
+            h = header[:2] + bytes([seq_no]) + header[3:]
+            cache.prefetch(h, secret, 64)
+        assert len(cache.entries) == 2
+        assert cache.evictions == 3
+        assert cache.size <= cache.max_bytes
+
+    def test_4(self):
+        request = Packet(secret_key = secret)
+        request.set_header(header)
+        request.prefetch_reply_pad(32)
+        reply = Packet(reply_to = request)
+        reply.plaintext_body = os.urandom(20)
+        reply.length = 20
+        reply.pack_header()
+        hits = pad_cache.hits
+        reply.encrypt_body()
+        assert pad_cache.hits == hits + 1
+        assert reply.ciphertext_body == reference_crypt(reply.header, secret, reply.plaintext_body)
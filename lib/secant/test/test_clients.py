@@ -0,0 +1,126 @@
+#!/usr/bin/python
+# -*- mode: python; coding: utf-8 -*-
+
+# Copyright © 2008 by Jeffrey C. Ollie
+#
+# This file is part of Secant.
+#
+# Secant is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Secant is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Secant.  If not, see <http://www.gnu.org/licenses/>.
+
+import ipaddress
+import random
+
+from secant import config
+from secant.clients import *
+from secant.test import Installed
+
+config_xml = """<?xml version="1.0" encoding="UTF-8"?>
+<config>
+  <config-files>
+    <clients>
+      <path>%s</path>
+      <path>%s</path>
+    </clients>
+  </config-files>
+</config>
+"""
+
+clients_xml = b"""<?xml version="1.0" encoding="UTF-8"?>
+<clients>
+  <client>
+    <address>10.0.0.0/8</address>
+    <secret>wide</secret>
+  </client>
+  <client>
+    <address>10.1.2.3</address>
+    <address>2001:db8::/32</address>
+    <secret>narrow</secret>
+    <group>core</group>
+    <prompts>
+      <username>Login: </username>
+    </prompts>
+  </client>
+</clients>
+"""
+
+def brute_force(networks, address):
+    address = ipaddress.ip_address(address)
+    best = None
+    for network, value in networks:
+        if address.version == network.version and address in network:
+            if best is None or network.prefixlen >= best[0].prefixlen:
+                best = (network, value)
+    return best and best[1]
+
+class TestPrefixTrie:
+    def test_1(self):
+        index = ClientIndex()
+        index.add('10.0.0.0/8', 'a')
+        index.add('10.1.0.0/16', 'b')
+        index.add('10.1.2.3', 'c')
+        index.add('0.0.0.0/0', 'default')
+        assert index.lookup('10.1.2.3') == 'c'
+        assert index.lookup('10.1.2.4') == 'b'
+        assert index.lookup('10.2.0.1') == 'a'
+        assert index.lookup('192.0.2.1') == 'default'
+        assert index.lookup('::1') is None
+        assert index.lookup('::ffff:10.1.2.3') == 'c'
+        assert len(index) == 4
+
+    def test_2(self):
+        index = ClientIndex()
+        index.add('10.1.2.3', 'c')
+        index.add('10.0.0.0/8', 'a')
+        index.add('10.1.0.0/16', 'b')
+        assert index.lookup('10.1.2.3') == 'c'
+        assert index.lookup('10.1.9.9') == 'b'
+        assert index.lookup('10.200.0.1') == 'a'
+        assert index.lookup('11.0.0.1') is None
+
+    def test_3(self):
+        rng = random.Random(49)
+        networks = []
+        index = ClientIndex()
+        for i in range(2000):
+            version = rng.choice([4, 6])
+            width = 32 if version == 4 else 128
+            prefixlen = rng.choice([0, 1, 8, 12, 16, 24, 28, 31, width]) if rng.random() < 0.1 else rng.randint(1, width)
+            bits = rng.getrandbits(width) & (rng.getrandbits(1) and 0xffff << (width - 16) or (1 << width) - 1)
+            network = ipaddress.ip_network((bits, prefixlen), strict = False)
+            networks = [(n, v) for n, v in networks if n != network]
+            networks.append((network, i))
+            index.add(str(network), i)
+
+        for network, value in networks[:200]:
+            address = network.network_address + rng.randint(0, network.num_addresses - 1)
+            assert index.lookup(address) == brute_force(networks, address)
+
+        for i in range(500):
+            address = ipaddress.ip_address(rng.getrandbits(32)) if i % 2 else ipaddress.ip_address(rng.getrandbits(128))
+            assert index.lookup(address) == brute_force(networks, address)
+
+class TestParseClients:
+    def test_1(self, tmp_path):
+        path = tmp_path / 'clients.xml'
+        path.write_bytes(clients_xml)
+        config_path = tmp_path / 'config.xml'
+        config_path.write_text(config_xml % (tmp_path / 'missing.xml', path))
+        with Installed(config.build_snapshot([str(config_path)])):
+            assert find_client('10.9.9.9').get_secret() == b'wide'
+            client = find_client('10.1.2.3')
+            assert client.get_secret() == b'narrow'
+            assert client.group == 'core'
+            assert client.get_prompt('username').render() == 'Login: '
+            assert find_client('2001:db8::1') is client
+            assert find_client('192.0.2.1') is None
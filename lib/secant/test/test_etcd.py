@@ -0,0 +1,159 @@
+#!/usr/bin/python
+# -*- mode: python; coding: utf-8 -*-
+
+# Copyright © 2008 by Jeffrey C. Ollie
+#
+# This file is part of Secant.
+#
+# Secant is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Secant is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Secant.  If not, see <http://www.gnu.org/licenses/>.
+
+from twisted.internet import defer
+from twisted.internet import error
+from twisted.internet.task import Clock
+
+from secant.etcd import *
+
+class ScriptedClient(EtcdClient):
+    def __init__(self, clock, results, **kw):
+        EtcdClient.__init__(self, clock, **kw)
+        self.results = list(results)
+        self.sent = []
+
+    def send(self, method, url, body):
+        self.sent.append((method, url, body))
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            return defer.fail(result)
+        return defer.succeed(result)
+
+class StalledClient(EtcdClient):
+    def __init__(self, clock, **kw):
+        EtcdClient.__init__(self, clock, **kw)
+        self.sent = []
+        self.cancelled = []
+
+    def send(self, method, url, body):
+        # Stands in for a request whose response or body never comes.
+        self.sent.append(url)
+        return defer.Deferred(lambda d: self.cancelled.append(url))
+
+class TestEtcdClient:
+    def test_1(self):
+        clock = Clock()
+        client = ScriptedClient(clock, [error.ConnectionRefusedError(), error.TimeoutError(), 'ok'], retries = 2)
+        result = []
+        client.get('/secant/users/test/passwords').addBoth(result.append)
+        assert result == []
+        clock.pump([1] * 10)
+        assert result == ['ok']
+        assert client.retried == 2
+        assert len(client.sent) == 3
+
+    def test_2(self):
+        clock = Clock()
+        client = ScriptedClient(clock, [error.ConnectionRefusedError()] * 3, retries = 2)
+        result = []
+        client.get('/a').addBoth(result.append)
+        clock.pump([1] * 10)
+        assert result[0].check(error.ConnectionRefusedError)
+        assert client.failures == 1
+
+    def test_3(self):
+        client = ScriptedClient(Clock(), [EtcdError(errorCode = 100, message = 'Key not found')])
+        result = []
+        client.get('/a').addBoth(result.append)
+        assert result[0].check(EtcdError)
+        assert result[0].value.code == 100
+        assert client.retried == 0
+
+    def test_4(self):
+        client = EtcdClient(Clock(), url = 'http://etcd:2379/')
+        assert client.key_url('/secant/users/a b/passwords', {'recursive': 'true'}) == \
+            b'http://etcd:2379/v2/keys/secant/users/a%20b/passwords?recursive=true'
+
+    def test_5(self):
+        # A compare-and-swap that timed out may have been applied, so it
+        # is not sent again.  One that never got a connection is.
+        clock = Clock()
+        client = ScriptedClient(clock, [error.TimeoutError(), 'ok'], retries = 2)
+        result = []
+        client.set('/a', 'value', prev_index = 7).addBoth(result.append)
+        clock.pump([1] * 10)
+        assert result[0].check(error.TimeoutError)
+        assert len(client.sent) == 1
+
+        client = ScriptedClient(clock, [error.ConnectionRefusedError(), 'ok'], retries = 2)
+        result = []
+        client.set('/a', 'value', prev_index = 7).addBoth(result.append)
+        clock.pump([1] * 10)
+        assert result == ['ok']
+
+        client = ScriptedClient(clock, [error.TimeoutError(), 'ok'], retries = 2)
+        result = []
+        client.set('/a', 'value').addBoth(result.append)
+        clock.pump([1] * 10)
+        assert result == ['ok']
+
+    def test_6(self):
+        # The timeout covers the wait for a connection as well as the
+        # request, and a request that times out gives its turn up.
+        clock = Clock()
+        client = StalledClient(clock, pool_size = 1, timeout = 2.0, retries = 0)
+        first = []
+        second = []
+        client.get('/a').addBoth(first.append)
+        clock.advance(1)
+        client.get('/b').addBoth(second.append)
+        assert len(client.sent) == 1
+        clock.advance(1)
+        assert first[0].check(defer.TimeoutError)
+        assert len(client.sent) == 2
+        assert second == []
+        clock.advance(1)
+        assert second[0].check(defer.TimeoutError)
+        assert len(client.cancelled) == 2
+        assert client.semaphore.tokens == 1
+
+    def test_7(self):
+        # A request still waiting for its turn when it times out is
+        # never sent.
+        clock = Clock()
+        client = StalledClient(clock, pool_size = 1, timeout = 2.0, retries = 0)
+        client.semaphore.acquire()
+        result = []
+        client.get('/a').addBoth(result.append)
+        clock.advance(2)
+        assert result[0].check(defer.TimeoutError)
+        assert client.sent == []
+        assert client.semaphore.waiting == []
+
+    def test_8(self):
+        # Timed out reads are tried again.
+        clock = Clock()
+        client = StalledClient(clock, timeout = 2.0, retries = 1)
+        result = []
+        client.get('/a').addBoth(result.append)
+        clock.pump([1] * 10)
+        assert result[0].check(defer.TimeoutError)
+        assert len(client.sent) == 2
+        assert client.retried == 1
+
+class TestEtcdResponse:
+    def test_1(self):
+        response = EtcdResponse(action = 'get',
+                                node = {'key': '/secant/users', 'dir': True,
+                                        'nodes': [{'key': '/secant/users/a', 'value': 'x', 'modifiedIndex': 4}]})
+        assert response.node.dir
+        assert response.node.nodes[0].value == 'x'
+        assert response.node.nodes[0].modifiedIndex == 4
@@ -0,0 +1,117 @@
+#!/usr/bin/python
+# -*- mode: python; coding: utf-8 -*-
+
+# Copyright © 2008 by Jeffrey C. Ollie
+#
+# This file is part of Secant.
+#
+# Secant is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Secant is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Secant.  If not, see <http://www.gnu.org/licenses/>.
+
+import struct
+
+import pytest
+
+from secant import packet
+from secant.framing import *
+from secant.test.test_protocol import accounting_request
+
+def frame(seq_no, body):
+    return struct.pack('!BBBBII', 0xc0, 1, seq_no, 0, 1234, len(body)) + body
+
+class TestFrameBuffer:
+    def test_1(self):
+        frames = FrameBuffer()
+        frames.feed(frame(1, b'abc') + frame(3, b'defg') + frame(5, b''))
+        result = [(header[2], bytes(body)) for header, body in frames]
+        assert result == [(1, b'abc'), (3, b'defg'), (5, b'')]
+        assert len(frames) == 0
+
+    def test_2(self):
+        data = frame(1, b'hello') + frame(3, b'world')
+        frames = FrameBuffer()
+        result = []
+        for byte in data:
+            frames.feed(bytes([byte]))
+            result.extend(bytes(body) for header, body in frames)
+        assert result == [b'hello', b'world']
+
+    def test_3(self):
+        frames = FrameBuffer()
+        frames.feed(frame(1, b'abc') + frame(3, b'def'))
+        for header, body in frames:
+            assert bytes(body) == b'abc'
+            break
+        frames.feed(frame(5, b'ghi'))
+        assert [bytes(body) for header, body in frames] == [b'def', b'ghi']
+
+    def test_4(self):
+        frames = FrameBuffer()
+        frames.feed(frame(1, b'abcdef')[:10])
+        assert frames.peek_length() is None
+        frames.feed(frame(1, b'abcdef')[10:14])
+        assert frames.peek_length() == 6
+        assert list(frames) == []
+
+    def test_5(self):
+        frames = FrameBuffer(max_length = 4)
+        frames.feed(frame(1, b'abcd') + frame(3, b'abcdef')[:12])
+        result = []
+        with pytest.raises(FrameTooLarge):
+            for header, body in frames:
+                result.append(bytes(body))
+        assert result == [b'abcd']
+
+    def test_6(self):
+        pool = ArenaPool(size = 64)
+        frames = FrameBuffer(pool = pool)
+        view = frames.get_buffer(-1)
+        data = frame(1, b'abc') + frame(3, b'de')
+        view[:len(data)] = data
+        frames.buffer_updated(len(data))
+        assert [bytes(body) for header, body in frames] == [b'abc', b'de']
+        arena = frames.buffer
+        frames.release()
+        assert FrameBuffer(pool = pool).get_buffer(10).obj is arena
+        assert pool.stats == {'free': 0, 'allocated': 1, 'reused': 1}
+
+    def test_7(self):
+        pool = ArenaPool(size = 64)
+        frames = FrameBuffer(pool = pool)
+        frames.min_receive = 16
+        # Partial frames are moved to the front of the arena to make
+        # room, and the arena is only replaced when a frame won't fit.
+        frames.feed(frame(1, b'a' * 20) + frame(3, b'b' * 20)[:20])
+        assert [bytes(body) for header, body in frames] == [b'a' * 20]
+        arena = frames.buffer
+        frames.feed(frame(3, b'b' * 20)[20:] + frame(5, b'c' * 100)[:30])
+        assert frames.buffer is arena
+        assert [bytes(body) for header, body in frames] == [b'b' * 20]
+        frames.feed(frame(5, b'c' * 100)[30:])
+        assert len(frames.buffer) == 128
+        assert [bytes(body) for header, body in frames] == [b'c' * 100]
+        # Back to an arena from the pool once the large frame is done.
+        frames.feed(frame(7, b'd'))
+        assert len(frames.buffer) == 64
+        assert [bytes(body) for header, body in frames] == [b'd']
+
+    def test_8(self):
+        # A request decoded from a frame doesn't hold on to the frame
+        # buffer once the frame has been released.
+        data = accounting_request(1)
+        frames = FrameBuffer()
+        frames.feed(data)
+        decoded = [packet.parse_request(header, body, b'hello') for header, body in frames]
+        assert decoded[0].ciphertext_body is None
+        decoded[0].encrypt_body()
+        assert decoded[0].header + decoded[0].ciphertext_body == data
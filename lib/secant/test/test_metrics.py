@@ -0,0 +1,102 @@
+# -*- mode: python; coding: utf-8 -*-
+
+# Copyright © 2008,2010 by Jeffrey C. Ollie
+#
+# This file is part of Secant.
+#
+# Secant is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Secant is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Secant.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from twisted.web.test.requesthelper import DummyRequest
+
+from secant import metrics
+from secant.test.test_protocol import accounting_request
+from secant.test.test_protocol import connect
+
+def count(histogram, *labels):
+    entry = histogram.values.get(labels)
+    return sum(entry[0]) if entry is not None else 0
+
+class TestRender:
+    def test_1(self):
+        registry = metrics.Registry()
+        histogram = registry.histogram('h', 'A histogram.', ['stage'], buckets = [0.1, 1.0])
+        for value in [0.05, 0.1, 0.5, 5.0]:
+            histogram.observe(value, 'decode')
+        assert metrics.render(registry.collect()).splitlines() == ['# HELP h A histogram.',
+                                                                  '# TYPE h histogram',
+                                                                  'h_bucket{stage="decode",le="0.1"} 2',
+                                                                  'h_bucket{stage="decode",le="1.0"} 3',
+                                                                  'h_bucket{stage="decode",le="+Inf"} 4',
+                                                                  'h_sum{stage="decode"} 5.65',
+                                                                  'h_count{stage="decode"} 4']
+
+    def test_2(self):
+        registry = metrics.Registry()
+        counter = registry.counter('c', 'A counter.', ['result'])
+        counter.inc('say "hi"')
+        counter.inc('say "hi"')
+        registry.gauge('g', 'A gauge.', lambda: 1.5)
+        assert metrics.render(registry.collect()).splitlines() == ['# HELP c A counter.',
+                                                                  '# TYPE c counter',
+                                                                  'c{result="say \\"hi\\""} 2',
+                                                                  '# HELP g A gauge.',
+                                                                  '# TYPE g gauge',
+                                                                  'g 1.5']
+
+    def test_3(self):
+        registry = metrics.Registry()
+        registry.counter('c', 'A counter.').inc()
+        families = metrics.add_label(registry.collect(), 'worker', '0')
+        families += metrics.add_label(registry.collect(), 'worker', '1')
+        families += metrics.stats_families({'hash_pool': {'pending': 2, 'name': 'x'}})
+        assert metrics.render(families).splitlines() == ['# HELP c A counter.',
+                                                        '# TYPE c counter',
+                                                        'c{worker="0"} 1',
+                                                        'c{worker="1"} 1',
+                                                        '# HELP secant_hash_pool_pending The hash_pool pending statistic.',
+                                                        '# TYPE secant_hash_pool_pending untyped',
+                                                        'secant_hash_pool_pending 2']
+
+    def test_4(self):
+        registry = metrics.Registry()
+        registry.gauge('g', 'A gauge.', lambda: 3)
+        request = DummyRequest([b''])
+        body = metrics.MetricsResource(registry.collect).render_GET(request)
+        assert body == b'# HELP g A gauge.\n# TYPE g gauge\ng 3\n'
+        assert request.responseHeaders.getRawHeaders(b'content-type')[0].startswith(b'text/plain; version=0.0.4')
+
+class TestInstrumentation:
+    def test_1(self, monkeypatch):
+        monkeypatch.setattr(metrics, 'enabled', True)
+        requests = count(metrics.request_seconds, 'accounting', 'success')
+        decodes = count(metrics.stage_seconds, 'decode')
+        spooled = count(metrics.stage_seconds, 'spool')
+        sessions = metrics.sessions.values.get(('accounting',), 0)
+
+        protocol, transport = connect()
+        protocol.dataReceived(accounting_request(1) + accounting_request(2))
+
+        assert count(metrics.request_seconds, 'accounting', 'success') == requests + 2
+        assert count(metrics.stage_seconds, 'decode') == decodes + 2
+        assert count(metrics.stage_seconds, 'spool') == spooled + 2
+        assert metrics.sessions.values[('accounting',)] == sessions + 2
+
+    def test_2(self):
+        # Nothing is recorded until the endpoint is started.
+        assert not metrics.enabled
+        requests = count(metrics.request_seconds, 'accounting', 'success')
+        protocol, transport = connect()
+        protocol.dataReceived(accounting_request(1))
+        assert count(metrics.request_seconds, 'accounting', 'success') == requests
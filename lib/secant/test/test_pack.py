@@ -0,0 +1,239 @@
+#!/usr/bin/python
+# -*- mode: python; coding: utf-8 -*-
+
+# Copyright © 2008 by Jeffrey C. Ollie
+#
+# This file is part of Secant.
+#
+# Secant is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Secant is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Secant.  If not, see <http://www.gnu.org/licenses/>.
+
+from secant.packet import *
+
+def round_trip(request):
+    request.secret_key = b'secret'
+    request.session_id = 1234
+    request.seq_no = 1
+    data = request.pack()
+    decoded = type(request)(secret_key = b'secret')
+    decoded.set_header(data[:12])
+    decoded.set_body(data[12:])
+    return decoded
+
+def args_of(packet):
+    return [str(arg) for arg in packet.args]
+
+class TestAuthenticationStart:
+    def test_1(self):
+        request = AuthenticationStart()
+        assert request.packet_type == TAC_PLUS_AUTHEN
+
+    def test_2(self):
+        request = AuthenticationStart()
+        request.action = TAC_PLUS_AUTHEN_LOGIN
+        request.priv_lvl = TAC_PLUS_PRIV_LVL_USER
+        request.authen_type = TAC_PLUS_AUTHEN_TYPE_ASCII
+        request.service = TAC_PLUS_AUTHEN_SVC_LOGIN
+        request.user = 'alice'
+        request.port = 'tty0'
+        request.rem_addr = '192.0.2.1'
+        decoded = round_trip(request)
+        assert decoded.packet_type == TAC_PLUS_AUTHEN
+        assert decoded.action == TAC_PLUS_AUTHEN_LOGIN
+        assert decoded.authen_type == TAC_PLUS_AUTHEN_TYPE_ASCII
+        assert (decoded.user, decoded.port, decoded.rem_addr) == ('alice', 'tty0', '192.0.2.1')
+
+class TestAuthorizationRequest:
+    def test_1(self):
+        request = AuthorizationRequest()
+        assert request.packet_type == TAC_PLUS_AUTHOR
+
+    def test_2(self):
+        request = AuthorizationRequest()
+        request.authen_method = TAC_PLUS_AUTHEN_METH_TACACSPLUS
+        request.priv_lvl = TAC_PLUS_PRIV_LVL_USER
+        request.authen_type = TAC_PLUS_AUTHEN_TYPE_ASCII
+        request.authen_service = TAC_PLUS_AUTHEN_SVC_LOGIN
+        request.user = 'alice'
+        request.port = 'tty0'
+        request.rem_addr = '192.0.2.1'
+        request.args = [Argument('service=shell'), Argument('cmd=show'), Argument('cmd-arg=version')]
+        decoded = round_trip(request)
+        assert decoded.packet_type == TAC_PLUS_AUTHOR
+        assert (decoded.user, decoded.port, decoded.rem_addr) == ('alice', 'tty0', '192.0.2.1')
+        assert args_of(decoded) == ['service=shell', 'cmd=show', 'cmd-arg=version']
+
+class TestAccountingRequest:
+    def test_1(self):
+        request = AccountingRequest()
+        assert request.packet_type == TAC_PLUS_ACCT
+
+    def test_2(self):
+        request = AccountingRequest()
+        request.accounting_flags = TAC_PLUS_ACCT_FLAG_START
+        request.authen_method = TAC_PLUS_AUTHEN_METH_TACACSPLUS
+        request.priv_lvl = TAC_PLUS_PRIV_LVL_USER
+        request.authen_type = TAC_PLUS_AUTHEN_TYPE_ASCII
+        request.authen_service = TAC_PLUS_AUTHEN_SVC_LOGIN
+        request.user = 'alice'
+        request.port = 'tty0'
+        request.rem_addr = '192.0.2.1'
+        request.args = [Argument('task_id=1'), Argument('service=shell')]
+        decoded = round_trip(request)
+        assert decoded.packet_type == TAC_PLUS_ACCT
+        assert decoded.accounting_flags == TAC_PLUS_ACCT_FLAG_START
+        assert decoded.user == 'alice'
+        assert args_of(decoded) == ['task_id=1', 'service=shell']
+
+def authorization_request(args):
+    request = AuthorizationRequest()
+    request.authen_method = TAC_PLUS_AUTHEN_METH_TACACSPLUS
+    request.priv_lvl = TAC_PLUS_PRIV_LVL_USER
+    request.authen_type = TAC_PLUS_AUTHEN_TYPE_ASCII
+    request.authen_service = TAC_PLUS_AUTHEN_SVC_LOGIN
+    request.user = 'alice'
+    request.args = [Argument(arg) for arg in args]
+    return request
+
+class TestArguments:
+    def test_1(self):
+        decoded = round_trip(authorization_request(['service=shell', 'cmd=show', 'cmd-arg*version']))
+        assert isinstance(decoded.args, Arguments)
+        assert len(decoded.args) == 3
+        assert str(decoded.args[0]) == 'service=shell'
+        assert str(decoded.args[-1]) == 'cmd-arg*version'
+        assert decoded.args[2].is_optional
+
+    def test_2(self):
+        decoded = round_trip(authorization_request([]))
+        assert len(decoded.args) == 0
+        assert list(decoded.args) == []
+        try:
+            decoded.args[0]
+        except IndexError:
+            pass
+        else:
+            assert False
+
+    def test_3(self):
+        decoded = round_trip(authorization_request(['service=shell']))
+        assert not hasattr(decoded, '__dict__')
+        assert not hasattr(decoded.args[0], '__dict__')
+
+    def test_4(self):
+        decoded = round_trip(authorization_request(['service=shell', 'cmd=show', 'cmd-arg=a', 'cmd-arg*b=c']))
+        assert decoded.args.index is None
+        assert decoded.args.get('cmd') == 'show'
+        assert decoded.args.get_all('cmd-arg') == ['a', 'b=c']
+        assert decoded.args.get('priv-lvl') is None
+        assert decoded.args.get('priv-lvl', '1') == '1'
+        assert 'service' in decoded.args
+        assert 'priv-lvl' not in decoded.args
+
+    def test_5(self):
+        decoded = round_trip(authorization_request(['service=shell', 'cmd-arg*b=c']))
+        assert decoded.args.raw(1) == b'cmd-arg*b=c'
+        assert list(decoded.args.raw_pairs()) == [b'service=shell', b'cmd-arg*b=c']
+
+    def test_6(self):
+        # Pairs that don't fit in the body or aren't ASCII are rejected
+        # when the packet is unpacked.
+        request = authorization_request(['service=shell', 'cmd=show'])
+        request.pack_body()
+        body = request.plaintext_body
+        for bad in [body[:-1], body.replace(b'show', b'sh\xf6w')]:
+            decoded = AuthorizationRequest()
+            decoded.plaintext_body = bad
+            try:
+                decoded.unpack_body()
+            except PacketError:
+                pass
+            else:
+                assert False
+
+    def test_7(self):
+        # Pairs that Argument would reject are rejected as soon as the
+        # pairs are looked at, however that is.
+        request = authorization_request(['service=shell', 'cmd=show'])
+        request.pack_body()
+        for bad in [b'cmd:', b'=md=', b'*md=']:
+            decoded = AuthorizationRequest()
+            decoded.plaintext_body = request.plaintext_body.replace(b'cmd=', bad)
+            decoded.unpack_body()
+            for look in [lambda args: args.get('service'), lambda args: list(args.raw_pairs()), list]:
+                try:
+                    look(decoded.args)
+                except PacketError:
+                    pass
+                else:
+                    assert False
+
+class TestSplitArgument:
+    def test_1(self):
+        assert split_argument('a=b*c') == ('a', 'b*c', False)
+
+    def test_2(self):
+        assert split_argument('a*b=c') == ('a', 'b=c', True)
+
+    def test_3(self):
+        assert split_argument('timezone=') == ('timezone', '', False)
+
+    def test_4(self):
+        for argument in ['', '=a', '*a', 'novalue']:
+            try:
+                split_argument(argument)
+            except PacketError:
+                pass
+            else:
+                assert False
+
+class TestParseRequest:
+    def parse(self, request, seq_no = 1):
+        request.secret_key = b'secret'
+        request.session_id = 99
+        request.seq_no = seq_no
+        data = request.pack()
+        return parse_request(data[:12], data[12:], b'secret')
+
+    def test_1(self):
+        request = AuthenticationStart()
+        request.action = TAC_PLUS_AUTHEN_LOGIN
+        request.priv_lvl = TAC_PLUS_PRIV_LVL_USER
+        request.authen_type = TAC_PLUS_AUTHEN_TYPE_ASCII
+        request.service = TAC_PLUS_AUTHEN_SVC_LOGIN
+        request.user = 'alice'
+        decoded = self.parse(request)
+        assert type(decoded) is AuthenticationStart
+        assert decoded.user == 'alice'
+        assert decoded.session_id == 99
+
+    def test_2(self):
+        request = AuthenticationContinue()
+        request.authentication_flags = 0
+        request.user_msg = 'secret'
+        decoded = self.parse(request, seq_no = 3)
+        assert type(decoded) is AuthenticationContinue
+        assert decoded.user_msg == 'secret'
+
+    def test_3(self):
+        decoded = self.parse(authorization_request(['service=shell']))
+        assert type(decoded) is AuthorizationRequest
+        assert decoded.get_reply().seq_no == 2
+
+    def test_4(self):
+        request = Packet()
+        request.packet_type = 9
+        request.plaintext_body = b''
+        decoded = self.parse(request)
+        assert type(decoded) is Packet
+        assert decoded.packet_type == 9
@@ -0,0 +1,303 @@
+#!/usr/bin/python
+# -*- mode: python; coding: utf-8 -*-
+
+# Copyright © 2008 by Jeffrey C. Ollie
+#
+# This file is part of Secant.
+#
+# Secant is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Secant is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Secant.  If not, see <http://www.gnu.org/licenses/>.
+
+import pytest
+from lxml import etree
+from twisted.internet import defer
+
+from secant import clients
+from secant import config
+from secant import packet
+from secant import users
+from secant.policy import *
+from secant.session.authorization import AuthorizationSessionHandler
+from secant.session.authorization import decisions
+from secant.test import Installed
+from secant.test import Settings
+
+users_xml = b"""
+<users>
+  <group>
+    <name>noc</name>
+    <authorization>
+      <rule service="shell" cmd="show" status="pass_add">
+        <av-pair name="priv-lvl">1</av-pair>
+      </rule>
+      <rule service="shell" cmd="configure" status="fail"/>
+    </authorization>
+  </group>
+  <group>
+    <name>all</name>
+    <authorization>
+      <rule status="pass_repl">
+        <av-pair name="timeout" optional="true">5</av-pair>
+      </rule>
+    </authorization>
+  </group>
+  <user>
+    <username>alice</username>
+    <groups><group>noc</group><group>all</group></groups>
+    <authorization>
+      <rule service="shell" cmd="show" status="fail">
+        <cmd-args>running-config.*</cmd-args>
+      </rule>
+      <rule cmd="reload" status="fail"/>
+    </authorization>
+  </user>
+  <user>
+    <username>bob</username>
+    <groups><group>noc</group></groups>
+  </user>
+  <user>
+    <username>carol</username>
+    <groups><group>noc</group></groups>
+  </user>
+</users>
+"""
+
+def policies(tmp_path):
+    path = tmp_path / 'users.xml'
+    path.write_bytes(users_xml)
+    users, groups = config.parse_users(str(path))
+    return Policies(users, groups)
+
+def decide(policies, username, service, command, arguments = []):
+    rule = policies.for_user(username).decide(service, command, arguments)
+    if rule is None:
+        return None
+    return rule.status, [str(av_pair) for av_pair in rule.av_pairs]
+
+class TestPolicies:
+    def test_1(self, tmp_path):
+        p = policies(tmp_path)
+        assert decide(p, 'alice', 'shell', 'show', ['running-config', '<cr>']) == ('fail', [])
+        assert decide(p, 'alice', 'shell', 'show', ['version', '<cr>']) == ('pass_add', ['priv-lvl=1'])
+        assert decide(p, 'alice', 'shell', 'configure', ['terminal']) == ('fail', [])
+        assert decide(p, 'alice', 'shell', 'ping', ['192.0.2.1']) == ('pass_repl', ['timeout*5'])
+
+    def test_2(self, tmp_path):
+        p = policies(tmp_path)
+        # cmd without a service applies to every service.
+        assert decide(p, 'alice', 'shell', 'reload') == ('fail', [])
+        assert decide(p, 'alice', 'exec', 'reload') == ('fail', [])
+        assert decide(p, 'alice', 'exec', None) == ('pass_repl', ['timeout*5'])
+
+    def test_3(self, tmp_path):
+        p = policies(tmp_path)
+        assert decide(p, 'bob', 'shell', 'show', ['running-config']) == ('pass_add', ['priv-lvl=1'])
+        assert decide(p, 'bob', 'shell', 'ping') is None
+        assert decide(p, 'nobody', 'shell', 'show') is None
+        assert p.for_user('bob') is p.for_user('carol')
+        assert p.for_user('alice') is not p.for_user('bob')
+
+    def test_4(self):
+        with pytest.raises(PolicyError):
+            Rule(status = 'maybe')
+        with pytest.raises(PolicyError):
+            Rule(arguments = '(')
+        with pytest.raises(PolicyError):
+            default_rule('maybe')
+
+    def test_5(self):
+        element = etree.fromstring(b'<user><authorization><rule service="*" cmd="" status="fail"/></authorization></user>')
+        rule, = parse_rules(element)
+        assert (rule.service, rule.command) == (None, None)
+
+    def test_6(self):
+        # However many rules there are, each one still gets its own
+        # decision.
+        rules = [Rule(service = 'shell', command = 'cmd{}'.format(i), arguments = 'arg{}'.format(i),
+                      av_pairs = [packet.Argument(key = 'rule', value = str(i))]) for i in range(500)]
+        policy = Policy(rules)
+        assert str(policy.decide('shell', 'cmd321', ['arg321']).av_pairs[0]) == 'rule=321'
+        assert policy.decide('shell', 'cmd321', ['arg322']) is None
+
+    def test_7(self):
+        # Patterns with inline flags, backreferences or named groups
+        # don't break the combined pattern of the rules around them.
+        rules = [Rule(service = 'shell', command = 'show', arguments = 'ip .*', av_pairs = [packet.Argument(key = 'rule', value = '1')]),
+                 Rule(service = 'shell', command = 'show', arguments = '(?i)version.*', av_pairs = [packet.Argument(key = 'rule', value = '2')]),
+                 Rule(service = 'shell', command = 'show', arguments = r'(a)\1', av_pairs = [packet.Argument(key = 'rule', value = '3')]),
+                 Rule(service = 'shell', command = 'show', arguments = '(?P<r0>b+)', av_pairs = [packet.Argument(key = 'rule', value = '4')]),
+                 Rule(service = 'shell', command = 'show', arguments = 'c', av_pairs = [packet.Argument(key = 'rule', value = '5')]),
+                 Rule(service = 'shell', command = 'show', arguments = 'v.*', av_pairs = [packet.Argument(key = 'rule', value = '6')])]
+        policy = Policy(rules)
+
+        def decide(arguments):
+            rule = policy.decide('shell', 'show', arguments)
+            return rule and str(rule.av_pairs[0])
+
+        assert decide(['ip', 'route']) == 'rule=1'
+        assert decide(['VERSION']) == 'rule=2'
+        assert decide(['version']) == 'rule=2'
+        assert decide(['aa']) == 'rule=3'
+        assert decide(['ab']) is None
+        assert decide(['bbb']) == 'rule=4'
+        assert decide(['c']) == 'rule=5'
+        assert decide(['vlan']) == 'rule=6'
+
+class Lookups:
+    def __init__(self):
+        self.usernames = []
+
+    def __call__(self, username):
+        self.usernames.append(username)
+        return defer.succeed(None)
+
+class CachedLookups(Lookups):
+    # Answers from the user cache, as users.find_user does.
+    def __call__(self, username):
+        Lookups.__call__(self, username)
+        return defer.succeed(users.user_cache.lookup(username))
+
+def request(user, args):
+    request = packet.AuthorizationRequest(secret_key = b'hello')
+    request.authen_method = packet.TAC_PLUS_AUTHEN_METH_TACACSPLUS
+    request.priv_lvl = packet.TAC_PLUS_PRIV_LVL_USER
+    request.authen_type = packet.TAC_PLUS_AUTHEN_TYPE_ASCII
+    request.authen_service = packet.TAC_PLUS_AUTHEN_SVC_LOGIN
+    request.user = user
+    request.args = [packet.Argument(argument) for argument in args]
+    data = request.pack()
+    return packet.parse_request(data[:12], data[12:], b'hello')
+
+def authorize(user, args, client = None):
+    result = []
+    AuthorizationSessionHandler(client, 1).process_request(request(user, args)).addCallback(result.append)
+    return result[0]
+
+class TestAuthorizationHandler:
+    def test_1(self, tmp_path, monkeypatch):
+        monkeypatch.setattr('secant.users.find_user', Lookups())
+        with Installed(config.current.replace(policy = policies(tmp_path))):
+            reply = authorize('bob', ['service=shell', 'cmd=show', 'cmd-arg=version'])
+            assert reply.authorization_status == packet.TAC_PLUS_AUTHOR_STATUS_PASS_ADD
+            assert [str(arg) for arg in reply.args] == ['priv-lvl=1']
+
+    def test_2(self, tmp_path, monkeypatch):
+        monkeypatch.setattr('secant.users.find_user', Lookups())
+        snapshot = config.current.replace(policy = policies(tmp_path),
+                                          settings = dict(config.current.settings, authorization_default = 'fail'))
+        with Installed(snapshot):
+            reply = authorize('bob', ['service=shell', 'cmd=ping'])
+            assert reply.authorization_status == packet.TAC_PLUS_AUTHOR_STATUS_FAIL
+            assert reply.args == []
+            reply.pack()
+
+    def test_3(self, tmp_path, monkeypatch):
+        # A failed lookup is answered rather than dropping the session.
+        monkeypatch.setattr('secant.users.find_user', lambda username: defer.fail(users.UnknownUser(username)))
+        with Installed(config.current.replace(policy = policies(tmp_path))):
+            reply = authorize('mallory', ['service=shell', 'cmd=show'])
+            assert reply.authorization_status == packet.TAC_PLUS_AUTHOR_STATUS_FAIL
+            reply.pack()
+        monkeypatch.setattr('secant.users.find_user', lambda username: defer.fail(RuntimeError('etcd is down')))
+        with Installed(config.current.replace(policy = policies(tmp_path))):
+            reply = authorize('bob', ['service=shell', 'cmd=show'])
+            assert reply.authorization_status == packet.TAC_PLUS_AUTHOR_STATUS_ERROR
+            assert reply.args == []
+            reply.pack()
+
+class TestDecisionCache:
+    def test_1(self, tmp_path, monkeypatch):
+        lookups = Lookups()
+        monkeypatch.setattr('secant.users.find_user', lookups)
+        with Installed(config.current.replace(policy = policies(tmp_path))):
+            first = authorize('alice', ['service=shell', 'cmd=show', 'cmd-arg=running-config', 'cmd-arg=<cr>'])
+            second = authorize('alice', ['service=shell', 'cmd=show', 'cmd-arg=running-config'])
+            assert first.authorization_status == second.authorization_status == packet.TAC_PLUS_AUTHOR_STATUS_FAIL
+            assert lookups.usernames == ['alice']
+            authorize('alice', ['service=shell', 'cmd=show', 'cmd-arg=version'])
+            authorize('alice', ['service=shell', 'cmd=show', 'cmd-arg=version'], clients.Client('192.0.2.1', group = 'core'))
+            assert lookups.usernames == ['alice', 'alice', 'alice']
+            stats = decisions.stats
+            assert (stats['hits'], stats['misses'], stats['entries']) == (1, 3, 3)
+            assert stats['hit_ratio'] == 0.25
+
+    def test_2(self, tmp_path, monkeypatch):
+        lookups = Lookups()
+        monkeypatch.setattr('secant.users.find_user', lookups)
+        with Installed(config.current.replace(policy = policies(tmp_path))):
+            authorize('alice', ['service=shell', 'cmd=show'])
+            authorize('bob', ['service=shell', 'cmd=show'])
+            users.user_cache.notify('alice')
+            authorize('alice', ['service=shell', 'cmd=show'])
+            authorize('bob', ['service=shell', 'cmd=show'])
+            assert lookups.usernames == ['alice', 'bob', 'alice']
+            users.user_cache.notify(None)
+            authorize('bob', ['service=shell', 'cmd=show'])
+            assert lookups.usernames == ['alice', 'bob', 'alice', 'bob']
+
+    def test_3(self, tmp_path, monkeypatch):
+        lookups = Lookups()
+        monkeypatch.setattr('secant.users.find_user', lookups)
+        with Installed(config.current.replace(policy = policies(tmp_path))):
+            assert [str(arg) for arg in authorize('bob', ['service=shell', 'cmd=show']).args] == ['priv-lvl=1']
+        # The new configuration has no rules, so the decision changes.
+        with Installed(config.current.replace(policy = Policies())):
+            assert [str(arg) for arg in authorize('bob', ['service=shell', 'cmd=show']).args] == ['priv-lvl=15']
+        assert lookups.usernames == ['bob', 'bob']
+
+    def test_4(self, tmp_path, monkeypatch):
+        lookups = Lookups()
+        monkeypatch.setattr('secant.users.find_user', lookups)
+        with Settings(authorization_cache_size = 0):
+            authorize('bob', ['service=shell', 'cmd=show'])
+            authorize('bob', ['service=shell', 'cmd=show'])
+            assert lookups.usernames == ['bob', 'bob']
+            assert decisions.stats['entries'] == 0
+
+    def test_5(self, tmp_path, monkeypatch):
+        # A decision that was being reached when the user changed is
+        # not kept.
+        pending = []
+        def find_user(username):
+            pending.append(defer.Deferred())
+            return pending[-1]
+        monkeypatch.setattr('secant.users.find_user', find_user)
+        with Installed(config.current.replace(policy = policies(tmp_path))):
+            result = []
+            AuthorizationSessionHandler(None, 1).process_request(request('bob', ['service=shell', 'cmd=show'])).addCallback(result.append)
+            users.user_cache.notify('bob')
+            pending.pop().callback(None)
+            assert result[0].authorization_status == packet.TAC_PLUS_AUTHOR_STATUS_PASS_ADD
+            assert decisions.stats['entries'] == 0
+            AuthorizationSessionHandler(None, 1).process_request(request('bob', ['service=shell', 'cmd=show']))
+            assert len(pending) == 1
+
+    def test_6(self, tmp_path, monkeypatch):
+        # Without the watch a decision is used only while the user
+        # record it was reached with is the one cached.
+        lookups = CachedLookups()
+        monkeypatch.setattr('secant.users.find_user', lookups)
+        snapshot = config.current.replace(policy = policies(tmp_path),
+                                          settings = dict(config.current.settings, user_cache_watch = False))
+        with Installed(snapshot):
+            users.user_cache.store(users.User('bob', passwords_index = 5))
+            try:
+                authorize('bob', ['service=shell', 'cmd=show'])
+                authorize('bob', ['service=shell', 'cmd=show'])
+                assert lookups.usernames == ['bob']
+                users.user_cache.store(users.User('bob', passwords_index = 6))
+                authorize('bob', ['service=shell', 'cmd=show'])
+                authorize('bob', ['service=shell', 'cmd=show'])
+                assert lookups.usernames == ['bob', 'bob']
+            finally:
+                users.user_cache.cache.pop('bob')
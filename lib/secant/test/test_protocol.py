@@ -0,0 +1,326 @@
+#!/usr/bin/python
+# -*- mode: python; coding: utf-8 -*-
+
+# Copyright © 2008 by Jeffrey C. Ollie
+#
+# This file is part of Secant.
+#
+# Secant is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Secant is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Secant.  If not, see <http://www.gnu.org/licenses/>.
+
+import struct
+
+from twisted.internet import defer
+from twisted.internet.address import IPv4Address
+from twisted.internet.task import Clock
+from twisted.internet.testing import StringTransport
+
+from secant import clients
+from secant import config
+from secant import packet
+from secant import framing
+from secant import spool
+from secant import timers
+from secant import TacacsProtocol
+from secant import TacacsProtocolFactory
+from secant.test import Settings
+
+secret = b'hello'
+
+def accounting_request(session_id, seq_no = 1, flags = 0):
+    body = struct.pack('!BBBBBBBBB', packet.TAC_PLUS_ACCT_FLAG_START, 1, 1, 1, 1, 4, 0, 0, 1)
+    body += b'\x0d'
+    body += b'user'
+    body += b'service=shell'
+    request = packet.Packet(secret_key = secret)
+    request.packet_type = packet.TAC_PLUS_ACCT
+    request.session_id = session_id
+    request.seq_no = seq_no
+    request.header_flags = flags
+    request.plaintext_body = body
+    request.length = len(request.plaintext_body)
+    request.pack_header()
+    request.encrypt_body()
+    return request.header + request.ciphertext_body
+
+def login_start(session_id):
+    request = packet.AuthenticationStart(secret_key = secret)
+    request.session_id = session_id
+    request.seq_no = 1
+    request.action = packet.TAC_PLUS_AUTHEN_LOGIN
+    request.priv_lvl = packet.TAC_PLUS_PRIV_LVL_USER
+    request.authen_type = packet.TAC_PLUS_AUTHEN_TYPE_ASCII
+    request.service = packet.TAC_PLUS_AUTHEN_SVC_LOGIN
+    return request.pack()
+
+def replies(transport):
+    frames = framing.FrameBuffer()
+    frames.feed(transport.value())
+    result = []
+    for header, body in frames:
+        reply = packet.Packet(secret_key = secret)
+        reply.set_header(header)
+        reply.set_body(body)
+        result.append(reply)
+    return result
+
+class TCPTransport(StringTransport):
+    def setTcpNoDelay(self, enabled):
+        pass
+
+def client_snapshot():
+    index = clients.ClientIndex()
+    index.add('127.0.0.0/8', clients.Client('127.0.0.1', secret = secret))
+    return config.current.replace(clients = index)
+
+class MemorySink:
+    def __init__(self):
+        self.records = []
+
+    def submit(self, record):
+        self.records.append(record)
+        return defer.succeed(None)
+
+def connect():
+    config.install(client_snapshot())
+    spool.sink = MemorySink()
+    protocol = TacacsProtocol(IPv4Address('TCP', '127.0.0.1', 12345))
+    transport = TCPTransport()
+    protocol.makeConnection(transport)
+    return protocol, transport
+
+class TestUnknownClient:
+    def test_1(self):
+        config.install(config.current.replace(clients = clients.ClientIndex()))
+        protocol = TacacsProtocol(IPv4Address('TCP', '192.0.2.1', 12345))
+        transport = TCPTransport()
+        protocol.makeConnection(transport)
+        assert transport.disconnecting
+        protocol.dataReceived(accounting_request(1))
+        assert transport.value() == b''
+
+class TestPipelining:
+    def test_1(self):
+        protocol, transport = connect()
+        protocol.dataReceived(b''.join(accounting_request(session_id) for session_id in range(1, 6)))
+        result = replies(transport)
+        assert [reply.session_id for reply in result] == [1, 2, 3, 4, 5]
+        assert all(reply.seq_no == 2 for reply in result)
+        assert all(reply.plaintext_body[4] == packet.TAC_PLUS_ACCT_STATUS_SUCCESS for reply in result)
+        assert len(protocol.sessions) == 0
+
+    def test_2(self):
+        protocol, transport = connect()
+        data = accounting_request(1) + accounting_request(2)
+        protocol.dataReceived(data[:5])
+        protocol.dataReceived(data[5:30])
+        assert replies(transport) == []
+        protocol.dataReceived(data[30:])
+        assert [reply.session_id for reply in replies(transport)] == [1, 2]
+
+class SlowHandler:
+    def __init__(self):
+        self.requests = []
+        self.finished = False
+
+    def process_request(self, request):
+        d = defer.Deferred()
+        self.requests.append((request, d))
+        return d
+
+    def reply_sent(self, reply):
+        pass
+
+    def reply(self, index = 0):
+        request, d = self.requests.pop(index)
+        reply = request.get_reply()
+        reply.accounting_status = packet.TAC_PLUS_ACCT_STATUS_SUCCESS
+        d.callback(reply)
+
+class TestConcurrency:
+    def test_1(self):
+        protocol, transport = connect()
+        slow = SlowHandler()
+        protocol.sessions.add(1, slow)
+        protocol.dataReceived(accounting_request(1) + accounting_request(2) + accounting_request(3))
+        assert [reply.session_id for reply in replies(transport)] == [2, 3]
+        assert list(protocol.inflight) == [1]
+        slow.reply()
+        assert [reply.session_id for reply in replies(transport)] == [2, 3, 1]
+        assert protocol.inflight == {}
+
+    def test_2(self):
+        protocol, transport = connect()
+        slow = SlowHandler()
+        protocol.sessions.add(1, slow)
+        protocol.dataReceived(accounting_request(1, seq_no = 1) + accounting_request(1, seq_no = 3))
+        assert len(slow.requests) == 1
+        assert protocol.backlog_count == 1
+        slow.reply()
+        assert len(slow.requests) == 1
+        assert slow.requests[0][0].seq_no == 3
+        slow.reply()
+        assert [reply.seq_no for reply in replies(transport)] == [2, 4]
+
+    def test_3(self):
+        protocol, transport = connect()
+        slow = SlowHandler()
+        for session_id in range(1, 5):
+            protocol.sessions.add(session_id, slow)
+        with Settings(max_inflight_requests = 2):
+            protocol.dataReceived(b''.join(accounting_request(session_id) for session_id in range(1, 5)))
+            assert len(protocol.inflight) == 2
+            assert transport.producerState == 'paused'
+            slow.reply(1)
+            assert sorted(protocol.inflight) == [1, 3]
+            assert transport.producerState == 'paused'
+            slow.reply(0)
+            slow.reply(0)
+            assert sorted(protocol.inflight) == [4]
+            assert transport.producerState == 'producing'
+            slow.reply(0)
+            assert [reply.session_id for reply in replies(transport)] == [2, 1, 3, 4]
+
+class BrokenHandler:
+    finished = False
+
+    def __init__(self, fail):
+        self.fail = fail
+
+    def process_request(self, request):
+        return self.fail(request)
+
+    def reply_sent(self, reply):
+        self.finished = True
+
+def raises(request):
+    raise RuntimeError('broken handler')
+
+def bad_reply(request):
+    reply = request.get_reply()
+    reply.accounting_status = packet.TAC_PLUS_ACCT_STATUS_SUCCESS
+    reply.server_msg = 'caf\u00e9'
+    return defer.succeed(reply)
+
+class TestErrors:
+    def check(self, fail):
+        # The client gets an error reply, the request is no longer in
+        # flight and the next request for the session is handled.
+        protocol, transport = connect()
+        protocol.sessions.add(1, BrokenHandler(fail))
+        protocol.dataReceived(accounting_request(1) + accounting_request(1, seq_no = 3))
+        result = replies(transport)
+        assert [(reply.session_id, reply.seq_no) for reply in result] == [(1, 2), (1, 4)]
+        assert result[0].plaintext_body[4] == packet.TAC_PLUS_ACCT_STATUS_ERROR
+        assert protocol.inflight == {}
+        assert protocol.backlog_count == 0
+        assert 1 not in protocol.sessions
+
+    def test_1(self):
+        self.check(lambda request: defer.fail(RuntimeError('lookup failed')))
+
+    def test_2(self):
+        self.check(raises)
+
+    def test_3(self):
+        # The reply can't be encoded.
+        self.check(bad_reply)
+
+class TestSessionLimits:
+    def test_1(self):
+        # Logins waiting for the client to send a username are idle, the
+        # least recently used one makes room for a new session.
+        protocol, transport = connect()
+        evictions = protocol.sessions.registry.evictions
+        with Settings(max_sessions_per_connection = 2):
+            protocol.dataReceived(login_start(1) + login_start(2))
+            protocol.dataReceived(login_start(3))
+            assert list(protocol.sessions.handlers) == [2, 3]
+            assert [(reply.session_id, reply.plaintext_body[0]) for reply in replies(transport)] == \
+                [(session_id, packet.TAC_PLUS_AUTHEN_STATUS_GETUSER) for session_id in [1, 2, 3]]
+        assert protocol.sessions.registry.evictions == evictions + 1
+
+    def test_2(self):
+        # A session waiting for its reply is never evicted, the idle
+        # login is.
+        protocol, transport = connect()
+        slow = SlowHandler()
+        protocol.sessions.add(1, slow)
+        with Settings(max_sessions_per_connection = 2):
+            protocol.dataReceived(accounting_request(1) + login_start(2) + login_start(3))
+            assert list(protocol.sessions.handlers) == [1, 3]
+            slow.reply()
+            assert [reply.session_id for reply in replies(transport)] == [2, 3, 1]
+
+    def test_3(self):
+        # With every session waiting for its reply a new session is
+        # turned away.
+        protocol, transport = connect()
+        slow = SlowHandler()
+        protocol.sessions.add(1, slow)
+        protocol.sessions.add(2, slow)
+        with Settings(max_sessions_per_connection = 2):
+            protocol.dataReceived(accounting_request(1) + accounting_request(2) + login_start(3))
+            assert list(protocol.sessions.handlers) == [1, 2]
+            result = replies(transport)
+            assert [reply.session_id for reply in result] == [3]
+            assert result[0].plaintext_body[0] == packet.TAC_PLUS_AUTHEN_STATUS_ERROR
+
+class TestGuards:
+    def connect(self, monkeypatch):
+        clock = Clock()
+        monkeypatch.setattr(timers, 'wheel', timers.TimerWheel(clock = clock))
+        protocol, transport = connect()
+        protocol.factory = TacacsProtocolFactory()
+        return clock, protocol, transport
+
+    def test_1(self, monkeypatch):
+        with Settings(max_body_length = 16):
+            clock, protocol, transport = self.connect(monkeypatch)
+        protocol.dataReceived(accounting_request(1)[:12])
+        assert transport.disconnected
+        assert protocol.factory.dropped['body_too_large'] == 1
+        protocol.dataReceived(accounting_request(1)[12:])
+        assert transport.value() == b''
+
+    def test_2(self, monkeypatch):
+        clock, protocol, transport = self.connect(monkeypatch)
+        data = accounting_request(1) + accounting_request(2)
+        with Settings(frame_read_timeout = 5.0):
+            protocol.dataReceived(data[:30])
+            clock.advance(4.0)
+            # Finishing a frame restarts the clock for the next one.
+            protocol.dataReceived(data[30:50])
+            clock.advance(4.0)
+            assert not transport.disconnected
+            clock.advance(2.0)
+            assert transport.disconnected
+        assert protocol.factory.dropped['read_timeout'] == 1
+        assert len(replies(transport)) == 1
+
+    def test_3(self, monkeypatch):
+        with Settings(connection_idle_timeout = 10.0):
+            clock, protocol, transport = self.connect(monkeypatch)
+            slow = SlowHandler()
+            protocol.sessions.add(1, slow)
+            protocol.dataReceived(accounting_request(1))
+            # Waiting on a reply isn't idle.
+            clock.pump([1.0] * 20)
+            assert not transport.disconnecting
+            slow.reply()
+            clock.pump([1.0] * 9)
+            assert not transport.disconnecting
+            clock.pump([1.0] * 2)
+            assert transport.disconnecting
+            assert not transport.disconnected
+        assert protocol.factory.dropped['idle_timeout'] == 1
@@ -0,0 +1,222 @@
+#!/usr/bin/python
+# -*- mode: python; coding: utf-8 -*-
+
+# Copyright © 2008 by Jeffrey C. Ollie
+#
+# This file is part of Secant.
+#
+# Secant is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Secant is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Secant.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+
+import pytest
+
+from twisted.internet import defer
+from twisted.internet.task import Clock
+
+from secant import clients
+from secant import config
+from secant import templates
+from secant.reload import *
+from secant.session import SessionHandler
+from secant.test import Installed
+from secant.test.test_protocol import accounting_request
+from secant.test.test_protocol import connect
+
+config_xml = """<?xml version="1.0" encoding="UTF-8"?>
+<config>
+  <config-files>
+    <clients>
+      <path>%s</path>
+    </clients>
+    <users>
+      <path>%s</path>
+    </users>
+  </config-files>
+  <settings>
+    <max_inflight_requests>%d</max_inflight_requests>
+  </settings>
+</config>
+"""
+
+clients_xml = """<?xml version="1.0" encoding="UTF-8"?>
+<clients>
+  <client>
+    <address>10.0.0.0/8</address>
+    <secret>%s</secret>
+  </client>
+</clients>
+"""
+
+users_xml = """<?xml version="1.0" encoding="UTF-8"?>
+<users>
+  <user>
+    <username>test</username>
+    <groups>
+      <group>admin</group>
+    </groups>
+  </user>
+</users>
+"""
+
+def write_config(tmp_path, secret = 'one', inflight = 8):
+    (tmp_path / 'clients.xml').write_text(clients_xml % secret)
+    (tmp_path / 'users.xml').write_text(users_xml)
+    (tmp_path / 'config.xml').write_text(config_xml % (tmp_path / 'clients.xml', tmp_path / 'users.xml', inflight))
+    return [str(tmp_path / 'config.xml')]
+
+class ManualReloader(Reloader):
+    """Build snapshots in the test thread, or hand back a Deferred
+    that the test fires itself."""
+
+    manual = False
+
+    def buildSnapshot(self, config_paths):
+        if self.manual:
+            self.waiting = defer.Deferred()
+            self.waiting.addCallback(lambda ignored: config.build_snapshot(config_paths))
+            return self.waiting
+        return defer.maybeDeferred(config.build_snapshot, config_paths)
+
+class TestSnapshot:
+    def test_1(self, tmp_path):
+        snapshot = config.build_snapshot(write_config(tmp_path))
+        with pytest.raises(AttributeError):
+            snapshot.settings = {}
+        with pytest.raises(TypeError):
+            snapshot.settings['max_inflight_requests'] = 1
+        assert snapshot.settings['max_inflight_requests'] == 8
+        assert snapshot.clients.lookup('10.1.2.3').get_secret() == b'one'
+        assert snapshot.users['test'].groups == ['admin']
+        assert sorted(snapshot.mtimes) == sorted(str(tmp_path / name) for name in ['config.xml', 'clients.xml', 'users.xml'])
+
+    def test_2(self, tmp_path):
+        snapshot = config.build_snapshot(write_config(tmp_path))
+        generation = config.current.generation
+        with Installed(snapshot):
+            assert config.current is snapshot
+            assert config.current.generation == generation + 1
+            assert config.settings is snapshot.settings
+            assert clients.find_client('10.1.2.3').get_secret() == b'one'
+        assert config.current is not snapshot
+
+    def test_3(self, tmp_path):
+        config_paths = write_config(tmp_path)
+        (tmp_path / 'clients.xml').write_text("""<clients>
+  <client>
+    <address>10.0.0.0/8</address>
+    <prompts><username>Who are you? </username></prompts>
+  </client>
+  <client>
+    <address>192.0.2.0/24</address>
+    <address>198.51.100.0/24</address>
+  </client>
+</clients>""")
+        snapshot = config.build_snapshot(config_paths)
+        first = snapshot.clients.lookup('10.1.2.3')
+        second = snapshot.clients.lookup('198.51.100.1')
+        assert len(snapshot.clients.clients) == 2
+        assert first.prompt_replies.templates['username'].server_msg == 'Who are you? '
+        assert first.prompt_replies.templates['password'].server_msg == 'Password: '
+        assert second.prompt_replies is snapshot.prompt_replies
+
+    def test_4(self, tmp_path):
+        # Each snapshot finds templates on its own search path, and
+        # building one doesn't change the search path of the templates
+        # in use.
+        snapshots = []
+        for name in ['one', 'two']:
+            directory = tmp_path / name
+            directory.mkdir()
+            (directory / 'banner.txt').write_text('banner ' + name)
+            config_paths = write_config(directory)
+            (directory / 'config.xml').write_text("""<config>
+  <template-search-paths>
+    <genshi-newtext><path>%s</path></genshi-newtext>
+  </template-search-paths>
+  <messages>
+    <banner template="genshi-newtext" filename="banner.txt"/>
+  </messages>
+</config>""" % directory)
+            snapshots.append(config.build_snapshot(config_paths))
+        assert [snapshot.messages['banner'].render() for snapshot in snapshots] == ['banner one', 'banner two']
+        assert snapshots[0].template_search_paths == {'genshi-newtext': [str(tmp_path / 'one')]}
+        assert templates.template_creators['genshi-newtext'].loader.search_path == []
+
+class TestReload:
+    def test_1(self, tmp_path):
+        config_paths = write_config(tmp_path)
+        with Installed(config.build_snapshot(config_paths)):
+            handler = SessionHandler(None, 1)
+            write_config(tmp_path, secret = 'two', inflight = 4)
+            reloader = ManualReloader(Clock(), config_paths)
+            reloader.reload()
+            assert reloader.reloads == 1
+            assert config.settings['max_inflight_requests'] == 4
+            assert clients.find_client('10.1.2.3').get_secret() == b'two'
+            # A session that was already running keeps its configuration.
+            assert handler.snapshot.settings['max_inflight_requests'] == 8
+            assert SessionHandler(None, 2).snapshot is config.current
+
+    def test_2(self, tmp_path):
+        config_paths = write_config(tmp_path)
+        with Installed(config.build_snapshot(config_paths)):
+            snapshot = config.current
+            (tmp_path / 'clients.xml').write_text('<clients>')
+            reloader = ManualReloader(Clock(), config_paths)
+            reloader.reload()
+            assert reloader.failures == 1
+            assert config.current is snapshot
+
+    def test_3(self, tmp_path):
+        config_paths = write_config(tmp_path)
+        with Installed(config.build_snapshot(config_paths)):
+            reloader = ManualReloader(Clock(), config_paths)
+            reloader.manual = True
+            reloader.reload()
+            first = reloader.waiting
+            reloader.reload()
+            reloader.reload()
+            assert reloader.waiting is first
+            first.callback(None)
+            # The requests that came in while busy are handled by one
+            # more reload.
+            assert reloader.waiting is not first
+            reloader.waiting.callback(None)
+            assert reloader.reloads == 2
+            assert not reloader.busy
+
+    def test_4(self, tmp_path):
+        config_paths = write_config(tmp_path)
+        with Installed(config.build_snapshot(config_paths)):
+            reloader = ManualReloader(Clock(), config_paths)
+            assert not reloader.changed()
+            path = tmp_path / 'clients.xml'
+            mtime = os.stat(path).st_mtime
+            os.utime(path, (mtime + 10, mtime + 10))
+            assert reloader.changed()
+            reloader.check()
+            assert reloader.reloads == 1
+            assert not reloader.changed()
+
+    def test_5(self):
+        with Installed(config.current):
+            protocol, transport = connect()
+            protocol.dataReceived(accounting_request(1))
+            assert not transport.disconnecting
+            # The client is removed from the configuration, the next
+            # request on its connection closes it.
+            config.install(config.current.replace(clients = clients.ClientIndex()))
+            protocol.dataReceived(accounting_request(2))
+            assert transport.disconnecting
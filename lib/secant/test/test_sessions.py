@@ -0,0 +1,254 @@
+#!/usr/bin/python
+# -*- mode: python; coding: utf-8 -*-
+
+# Copyright © 2008 by Jeffrey C. Ollie
+#
+# This file is part of Secant.
+#
+# Secant is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Secant is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Secant.  If not, see <http://www.gnu.org/licenses/>.
+
+from twisted.internet import defer
+from twisted.internet.task import Clock
+
+from secant import config
+from secant import packet
+from secant import templates
+from secant import users
+from secant.clients import Client
+from secant.session.authentication import AuthenticationSessionHandler
+from secant.session.authorization import AuthorizationSessionHandler
+from secant.session.table import *
+from secant.timers import TimerWheel
+from secant.test import Installed, Settings
+
+class Handler:
+    def __init__(self, name):
+        self.name = name
+        # Sessions in the table are always still running, finished
+        # ones are removed when their reply is sent.
+        self.finished = False
+
+class TestSessionTable:
+    def test_1(self):
+        clock = Clock()
+        sessions = SessionTable(wheel = TimerWheel(clock = clock), registry = SessionRegistry())
+        with Settings(session_idle_timeout = 10.0):
+            sessions.add(1, 'a')
+            clock.advance(5)
+            sessions.add(2, 'b')
+            clock.advance(4)
+            assert sessions.get(1) == 'a'
+            clock.advance(9)
+            assert 1 in sessions
+            assert 2 not in sessions
+            clock.advance(1)
+            assert len(sessions) == 0
+            assert sessions.registry.expirations == 2
+
+    def test_2(self):
+        clock = Clock()
+        inflight = {1: None}
+        sessions = SessionTable(inflight = inflight, wheel = TimerWheel(clock = clock), registry = SessionRegistry())
+        with Settings(session_idle_timeout = 10.0):
+            sessions.add(1, 'a')
+            clock.advance(30)
+            assert 1 in sessions
+            del inflight[1]
+            clock.advance(10)
+            assert 1 not in sessions
+
+    def test_3(self):
+        sessions = SessionTable(wheel = TimerWheel(clock = Clock()), registry = SessionRegistry())
+        with Settings(max_sessions_per_connection = 2):
+            sessions.add(1, Handler('a'))
+            sessions.add(2, Handler('b'))
+            sessions.get(1)
+            sessions.add(3, Handler('c'))
+            assert list(sessions.handlers) == [1, 3]
+            assert sessions.registry.evictions == 1
+
+    def test_4(self):
+        wheel = TimerWheel(clock = Clock())
+        registry = SessionRegistry()
+        first = SessionTable(inflight = {1: None}, wheel = wheel, registry = registry)
+        second = SessionTable(inflight = {3: None}, wheel = wheel, registry = registry)
+        with Settings(max_sessions = 2):
+            first.add(1, Handler('a'))
+            first.add(2, Handler('b'))
+            assert second.add(3, Handler('c'))
+            assert 1 in first
+            assert 2 not in first
+            assert not first.add(4, Handler('d'))
+            assert registry.stats['sessions'] == 2
+            assert registry.stats['rejections'] == 1
+
+    def test_5(self):
+        registry = SessionRegistry()
+        sessions = SessionTable(wheel = TimerWheel(clock = Clock()), registry = registry)
+        sessions.add(1, 'a')
+        sessions.remove(1)
+        sessions.add(2, 'b')
+        sessions.clear()
+        assert len(registry) == 0
+        assert registry.completions == 1
+        assert sessions.timer is None
+        assert len(sessions.wheel) == 0
+
+    def test_6(self):
+        # When every session has a request outstanding there is nothing
+        # to evict and the new session is turned away.
+        registry = SessionRegistry()
+        sessions = SessionTable(inflight = {1: None, 2: None}, wheel = TimerWheel(clock = Clock()), registry = registry)
+        with Settings(max_sessions_per_connection = 2):
+            sessions.add(1, Handler('a'))
+            sessions.add(2, Handler('b'))
+            assert not sessions.add(3, Handler('c'))
+            assert list(sessions.handlers) == [1, 2]
+        with Settings(max_sessions = 2):
+            assert not SessionTable(wheel = sessions.wheel, registry = registry).add(4, Handler('d'))
+        assert registry.rejections == 2
+
+    def test_7(self):
+        # A reused session_id gets the deadline of the new session, the
+        # old session's heap entry is skipped.
+        clock = Clock()
+        sessions = SessionTable(wheel = TimerWheel(clock = clock), registry = SessionRegistry())
+        with Settings(session_idle_timeout = 10.0):
+            sessions.add(1, 'a')
+            clock.advance(5)
+            sessions.remove(1)
+            sessions.add(1, 'b')
+            clock.advance(6)
+            assert sessions.get(1) == 'b'
+            assert len(sessions.deadlines) == 1
+            clock.advance(10)
+            assert 1 not in sessions
+            assert sessions.deadlines == []
+            assert sessions.registry.expirations == 1
+
+class TestAuthenticationHandler:
+    def test_1(self):
+        request = packet.AuthenticationContinue(secret_key = b'hello')
+        request.seq_no = 3
+        request.authentication_flags = 0
+        result = []
+        AuthenticationSessionHandler(None, 1).process_request(request).addCallback(result.append)
+        reply = result[0]
+        assert reply.seq_no == 4
+        assert reply.authentication_status == packet.TAC_PLUS_AUTHEN_STATUS_ERROR
+        reply.pack()
+
+    def test_2(self):
+        request = packet.AuthenticationStart(secret_key = b'hello')
+        request.seq_no = 1
+        request.action = packet.TAC_PLUS_AUTHEN_CHPASS
+        result = []
+        AuthenticationSessionHandler(None, 1).process_request(request).addCallback(result.append)
+        assert result[0].authentication_status == packet.TAC_PLUS_AUTHEN_STATUS_ERROR
+        assert result[0].server_msg == 'Only LOGIN authentication action is supported.'
+        result[0].pack()
+
+    def start(self, client = None, service = packet.TAC_PLUS_AUTHEN_SVC_LOGIN, user = ''):
+        request = packet.AuthenticationStart(secret_key = b'hello')
+        request.seq_no = 1
+        request.session_id = 7
+        request.action = packet.TAC_PLUS_AUTHEN_LOGIN
+        request.authen_type = packet.TAC_PLUS_AUTHEN_TYPE_ASCII
+        request.service = service
+        request.user = user
+        result = []
+        AuthenticationSessionHandler(client, 7).process_request(request).addCallback(result.append)
+        return result[0]
+
+    def test_3(self):
+        reply = self.start()
+        assert reply.authentication_status == packet.TAC_PLUS_AUTHEN_STATUS_GETUSER
+        assert reply.server_msg == 'Username: '
+
+        data = reply.pack()
+        parsed = packet.AuthenticationReply(reply_to = packet.AuthenticationStart())
+        parsed.plaintext_body = packet.crypt_body(data[:12], b'hello', data[12:])
+        parsed.unpack_body()
+        assert (parsed.authentication_status, parsed.authentication_flags, parsed.server_msg) == \
+            (packet.TAC_PLUS_AUTHEN_STATUS_GETUSER, 0, 'Username: ')
+        assert data[2] == 2
+
+    def test_4(self):
+        reply = self.start(service = packet.TAC_PLUS_AUTHEN_SVC_ENABLE, user = 'alice')
+        assert reply.authentication_status == packet.TAC_PLUS_AUTHEN_STATUS_GETPASS
+        assert reply.authentication_flags == packet.TAC_PLUS_REPLY_FLAG_NOECHO
+        assert reply.server_msg == 'Enable: '
+
+    def test_5(self):
+        client = Client('192.0.2.1', prompts = {'username': templates.PlainTemplate('Login: ')})
+        assert self.start(client).server_msg == 'Login: '
+        assert self.start(client, user = 'alice').server_msg == 'Password: '
+        assert self.start(Client('192.0.2.2')).server_msg == 'Username: '
+
+    def test_6(self):
+        with Installed(config.current.replace(prompts = dict(config.current.prompts, password = 'Secret: '))):
+            assert self.start(user = 'alice').server_msg == 'Secret: '
+        assert self.start(user = 'alice').server_msg == 'Password: '
+
+class BusyUser:
+    def check_password(self, password_type, password):
+        return defer.fail(users.HashPoolBusy())
+
+    def change_password(self, password_type, old_password, new_password):
+        return defer.fail(users.HashPoolBusy())
+
+class TestBusyHashPool:
+    def reply(self, **kw):
+        request = packet.AuthenticationContinue(secret_key = b'hello')
+        request.seq_no = 5
+        request.authentication_flags = 0
+        handler = AuthenticationSessionHandler(None, 1)
+        handler.service = packet.TAC_PLUS_AUTHEN_SVC_LOGIN
+        for name, value in kw.items():
+            setattr(handler, name, value)
+        result = []
+        handler.findUserSucceeded(BusyUser(), request).addCallback(result.append)
+        return result[0]
+
+    def test_1(self):
+        reply = self.reply(password = 'secret')
+        assert reply.authentication_status == packet.TAC_PLUS_AUTHEN_STATUS_ERROR
+        assert reply.server_msg == 'Server busy, try again later.'
+
+    def test_2(self):
+        # Changing a password when the old one can't be checked is an
+        # error too, not a wrong password.
+        reply = self.reply(old_password = 'secret', new_password_1 = 'better', new_password_2 = 'better')
+        assert reply.authentication_status == packet.TAC_PLUS_AUTHEN_STATUS_ERROR
+        assert reply.server_msg == 'Server busy, try again later.'
+        reply.pack()
+
+class TestAuthorizationHandler:
+    def test_1(self, monkeypatch):
+        monkeypatch.setattr('secant.users.find_user', lambda username: defer.succeed(None))
+        request = packet.AuthorizationRequest(secret_key = b'hello')
+        request.authen_method = packet.TAC_PLUS_AUTHEN_METH_TACACSPLUS
+        request.priv_lvl = packet.TAC_PLUS_PRIV_LVL_USER
+        request.authen_type = packet.TAC_PLUS_AUTHEN_TYPE_ASCII
+        request.authen_service = packet.TAC_PLUS_AUTHEN_SVC_LOGIN
+        request.user = 'alice'
+        request.args = [packet.Argument(argument) for argument in ['service=shell', 'cmd=show', 'cmd-arg=ip', 'cmd-arg=route']]
+        data = request.pack()
+        request = packet.parse_request(data[:12], data[12:], b'hello')
+        handler = AuthorizationSessionHandler(None, 1)
+        result = []
+        handler.process_request(request).addCallback(result.append)
+        reply = result[0]
+        assert (handler.service, handler.command, handler.command_arguments) == ('shell', 'show', ['ip', 'route'])
+        assert reply.authorization_status == packet.TAC_PLUS_AUTHOR_STATUS_PASS_ADD
@@ -0,0 +1,241 @@
+# -*- mode: python; coding: utf-8 -*-
+
+# Copyright © 2008,2010 by Jeffrey C. Ollie
+#
+# This file is part of Secant.
+#
+# Secant is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Secant is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Secant.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+import os
+
+from twisted.internet import defer
+from twisted.internet.task import Clock
+from twisted.python import failure
+
+from secant import config
+from secant import packet
+from secant.session.accounting import AccountingSessionHandler
+from secant.spool import *
+from secant.test import Settings
+from secant.test.test_protocol import accounting_request
+from secant.test.test_protocol import secret
+
+class ThreadlessReactor(Clock):
+    def callFromThread(self, f, *a, **kw):
+        f(*a, **kw)
+
+    def addSystemEventTrigger(self, *a, **kw):
+        pass
+
+class ManualPool:
+    """Runs work straight away, or holds on to it until run() when
+    hold is set."""
+
+    def __init__(self):
+        self.hold = False
+        self.waiting = []
+
+    def callInThreadWithCallback(self, onResult, f, *a, **kw):
+        self.waiting.append((onResult, f, a, kw))
+        if not self.hold:
+            self.run()
+
+    def run(self):
+        while self.waiting:
+            onResult, f, a, kw = self.waiting.pop(0)
+            try:
+                result = f(*a, **kw)
+            except Exception:
+                onResult(False, failure.Failure())
+            else:
+                onResult(True, result)
+
+    def stop(self):
+        pass
+
+class MemoryBackend:
+    def __init__(self):
+        self.records = []
+        self.fail = False
+
+    def send(self, records):
+        if self.fail:
+            return defer.fail(BackendError(500, b'down'))
+        self.records.extend(records)
+        return defer.succeed(None)
+
+def make_sink(tmp_path, **settings):
+    sink = AccountingSink(reactor = ThreadlessReactor())
+    sink.pool = ManualPool()
+    settings.setdefault('accounting_spool', str(tmp_path / 'spool'))
+    with Settings(**settings):
+        sink.start()
+    return sink
+
+def spooled(sink):
+    records = []
+    for number in sink.spool.segments():
+        records.extend(sink.spool.read(number, 0, 1000000)[0])
+    return records
+
+class TestSpool:
+    def test_1(self, tmp_path):
+        spool = Spool(str(tmp_path), segment_size = 20, fsync = False)
+        spool.open()
+        spool.append(b'{"a":1}\n{"a":2}\n')
+        spool.append(b'{"a":3}\n')
+        spool.append(b'{"a":4}\n{"a":')
+        assert spool.segments() == [0, 1]
+        assert spool.read(0, 0, 10) == ([{'a': 1}, {'a': 2}, {'a': 3}], 24)
+        assert spool.read(0, 8, 1) == ([{'a': 2}], 16)
+        # The half written record at the end is left alone.
+        assert spool.read(1, 0, 10) == ([{'a': 4}], 8)
+        spool.close()
+
+    def test_2(self, tmp_path):
+        spool = Spool(str(tmp_path), fsync = True)
+        spool.open()
+        spool.append(b'{"a":1}\n')
+        spool.close()
+        spool.open()
+        assert spool.current == 1
+        spool.close()
+
+class TestAccountingSink:
+    def test_1(self, tmp_path):
+        sink = make_sink(tmp_path)
+        with Settings(accounting_batch_size = 10, accounting_batch_delay = 0.5):
+            results = []
+            for i in range(3):
+                sink.submit({'n': i}).addCallback(results.append)
+            assert results == []
+            assert spooled(sink) == []
+            sink.reactor.advance(0.5)
+        assert results == [None, None, None]
+        assert spooled(sink) == [{'n': 0}, {'n': 1}, {'n': 2}]
+        assert sink.batches == 1
+
+    def test_2(self, tmp_path):
+        sink = make_sink(tmp_path)
+        sink.pool.hold = True
+        with Settings(accounting_batch_size = 2):
+            results = []
+            for i in range(5):
+                sink.submit({'n': i}).addCallback(results.append)
+            # The first two went straight out, the rest wait for that
+            # write to finish.
+            assert sink.writing
+            assert len(sink.queue) == 3
+            sink.pool.run()
+            assert len(results) == 4
+            assert sink.batches == 2
+            sink.reactor.advance(config.settings['accounting_batch_delay'])
+            sink.pool.run()
+        assert len(results) == 5
+        assert sink.batches == 3
+        assert sink.committed == 5
+        assert [record['n'] for record in spooled(sink)] == [0, 1, 2, 3, 4]
+
+    def test_3(self, tmp_path):
+        sink = make_sink(tmp_path)
+        sink.pool.hold = True
+        with Settings(accounting_batch_size = 1, accounting_queue_limit = 1):
+            sink.submit({'n': 0})
+            sink.submit({'n': 1})
+            result = []
+            sink.submit({'n': 2}).addErrback(result.append)
+        assert result[0].check(AccountingBusy)
+        assert sink.rejected == 1
+
+    def test_4(self, tmp_path):
+        sink = make_sink(tmp_path)
+        sink.spool.close()
+        sink.spool.fd = -1
+        with Settings(accounting_batch_size = 1):
+            result = []
+            sink.submit({'n': 0}).addErrback(result.append)
+        assert result[0].check(OSError)
+        assert sink.failed == 1
+        assert not sink.writing
+
+class TestAccountingHandler:
+    def request(self):
+        data = accounting_request(1)
+        return packet.parse_request(data[:12], data[12:], secret)
+
+    def test_1(self, tmp_path, monkeypatch):
+        sink = make_sink(tmp_path)
+        sink.pool.hold = True
+        monkeypatch.setattr('secant.spool.sink', sink)
+        with Settings(accounting_batch_size = 1):
+            result = []
+            AccountingSessionHandler(None, 1).process_request(self.request()).addCallback(result.append)
+            # No reply until the record has been written.
+            assert result == []
+            sink.pool.run()
+        assert result[0].accounting_status == packet.TAC_PLUS_ACCT_STATUS_SUCCESS
+        assert spooled(sink)[0]['user'] == 'user'
+        assert spooled(sink)[0]['av_pairs'] == ['service=shell']
+
+    def test_2(self, tmp_path, monkeypatch):
+        sink = make_sink(tmp_path)
+        monkeypatch.setattr('secant.spool.sink', sink)
+        with Settings(accounting_queue_limit = 0):
+            result = []
+            AccountingSessionHandler(None, 1).process_request(self.request()).addCallback(result.append)
+        assert result[0].accounting_status == packet.TAC_PLUS_ACCT_STATUS_ERROR
+
+class TestSpoolDrainer:
+    def test_1(self, tmp_path):
+        sink = make_sink(tmp_path, accounting_segment_size = 30, accounting_fsync = False)
+        backend = MemoryBackend()
+        drainer = SpoolDrainer(sink, backend, reactor = sink.reactor)
+        with Settings(accounting_batch_size = 1, accounting_drain_interval = 1.0, accounting_drain_batch = 2):
+            drainer.start()
+            for i in range(5):
+                sink.submit({'n': i})
+            backend.fail = True
+            sink.reactor.advance(1)
+            assert drainer.failures == 1
+            assert backend.records == []
+            backend.fail = False
+            for i in range(5):
+                sink.reactor.advance(1)
+            drainer.stop()
+        assert [record['n'] for record in backend.records] == [0, 1, 2, 3, 4]
+        # Finished segments are removed, only the one being written is
+        # left.
+        assert sink.spool.segments() == [sink.spool.current]
+        with open(drainer.position_path) as f:
+            assert json.load(f) == {'segment': drainer.segment, 'offset': drainer.offset}
+
+    def test_2(self, tmp_path):
+        sink = make_sink(tmp_path, accounting_fsync = False)
+        backend = MemoryBackend()
+        drainer = SpoolDrainer(sink, backend, reactor = sink.reactor)
+        with Settings(accounting_batch_size = 1):
+            drainer.start()
+            sink.submit({'n': 0})
+            sink.reactor.advance(1)
+            drainer.stop()
+
+            # Pick up where the last one left off.
+            drainer = SpoolDrainer(sink, backend, reactor = sink.reactor)
+            drainer.start()
+            sink.submit({'n': 1})
+            sink.reactor.advance(1)
+            drainer.stop()
+        assert backend.records == [{'n': 0}, {'n': 1}]
@@ -0,0 +1,112 @@
+# -*- mode: python; coding: utf-8 -*-
+
+# Copyright © 2008,2010 by Jeffrey C. Ollie
+#
+# This file is part of Secant.
+#
+# Secant is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Secant is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Secant.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import struct
+
+import genshi.template
+import genshi.template.eval
+import pytest
+from twisted.logger import Logger
+from twisted.logger import LogLevel
+
+from secant import config
+from secant import loglevel
+from secant import packet
+from secant.session.authorization import AuthorizationSessionHandler
+from secant.templates import *
+from secant.test import Installed
+from secant.test import Settings
+
+newtext = template_creators['genshi-newtext']
+
+class Thing:
+    name = 'thing'
+    missing = None
+
+class CountingTemplate:
+    def __init__(self):
+        self.count = 0
+
+    def render(self, *a, **kw):
+        self.count += 1
+        return 'rendered'
+
+class TestFormatTemplate:
+    def test_1(self):
+        sources = ['plain text',
+                   'a ${x} b $y {braces} $$escaped\n',
+                   'continued \\\nline ${thing.name} ${thing.missing}',
+                   '${ {"k": x}["k"] } ${[str(i) for i in range(y)]} ${len(thing.name)}']
+        for source in sources:
+            template = newtext.create_template(source = source)
+            assert isinstance(template, FormatTemplate)
+            genshi_template = genshi.template.NewTextTemplate(source)
+            kw = dict(x = 'x', y = 3, thing = Thing())
+            assert template.render(**kw) == genshi_template.generate(**kw).render(encoding = None)
+
+    def test_2(self):
+        source = '{% if x %}yes{% end %}'
+        template = newtext.create_template(source = source)
+        assert isinstance(template, GenshiTemplate)
+        assert template.render(x = True) == 'yes'
+
+    def test_3(self):
+        source = '{% python\nimport os\n%}${os.sep}'
+        assert isinstance(newtext.create_template(source = source), GenshiTemplate)
+
+    def test_4(self):
+        # Names, attributes and items are looked up the way Genshi
+        # does it, attribute access works on dictionaries too.
+        source = '${request.user}@${request["port"]} ${thing.name.upper()}'
+        template = newtext.create_template(source = source)
+        assert isinstance(template, FormatTemplate)
+        kw = dict(request = {'user': 'alice', 'port': 'tty0'}, thing = Thing())
+        assert template.render(**kw) == genshi.template.NewTextTemplate(source).generate(**kw).render(encoding = None)
+        assert template.render(**kw) == 'alice@tty0 THING'
+
+    def test_5(self):
+        template = newtext.create_template(source = '${nothing}')
+        assert isinstance(template, FormatTemplate)
+        with pytest.raises(genshi.template.eval.UndefinedError):
+            template.render(x = 1)
+        with pytest.raises(genshi.template.eval.UndefinedError):
+            genshi.template.NewTextTemplate('${nothing}').generate(x = 1).render(encoding = None)
+
+class TestLogLevel:
+    def test_1(self):
+        log = Logger(namespace = 'secant.test')
+        with Settings(log_level = 'debug'):
+            assert loglevel.enabled(log, LogLevel.debug)
+        with Settings(log_level = 'info'):
+            assert not loglevel.enabled(log, LogLevel.debug)
+            assert loglevel.enabled(log, LogLevel.warn)
+
+    def test_2(self):
+        template = CountingTemplate()
+        request = packet.AuthorizationRequest(secret_key = b'hello')
+        request.plaintext_body = struct.pack('!BBBBBBBB', 0, 0, 0, 0, 0, 0, 0, 0)
+        request.length = len(request.plaintext_body)
+        request.pack_header()
+        request.unpack_body()
+        for level, count in [('info', 0), ('debug', 1)]:
+            with Installed(config.current.replace(log_formats = {'authorization': template},
+                                                  settings = dict(config.current.settings, log_level = level))):
+                AuthorizationSessionHandler(None, 1).process_request(request)
+            assert template.count == count
@@ -0,0 +1,68 @@
+# -*- mode: python; coding: utf-8 -*-
+
+# Copyright © 2008,2010 by Jeffrey C. Ollie
+#
+# This file is part of Secant.
+#
+# Secant is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Secant is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Secant.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from twisted.internet.task import Clock
+
+from secant.timers import *
+
+class TestTimerWheel:
+    def test_1(self):
+        clock = Clock()
+        wheel = TimerWheel(clock = clock)
+        fired = []
+        wheel.schedule(2.5, lambda: fired.append('a'))
+        cancelled = wheel.schedule(2.5, lambda: fired.append('b'))
+        wheel.schedule(1.0, lambda: fired.append('c'))
+        wheel.cancel(cancelled)
+        clock.advance(1.0)
+        assert fired == ['c']
+        clock.advance(1.5)
+        assert fired == ['c']
+        clock.advance(0.5)
+        assert fired == ['c', 'a']
+        assert len(wheel) == 0
+        assert clock.getDelayedCalls() == []
+
+    def test_2(self):
+        # A timer more than a revolution away waits for its turn.
+        clock = Clock()
+        wheel = TimerWheel(size = 4, clock = clock)
+        fired = []
+        wheel.schedule(10.0, lambda: fired.append(clock.seconds()))
+        clock.pump([1.0] * 9)
+        assert fired == []
+        clock.advance(1.0)
+        assert fired == [10.0]
+
+    def test_3(self):
+        # A late reactor catches up on every slot it missed.
+        clock = Clock()
+        wheel = TimerWheel(clock = clock)
+        fired = []
+        wheel.schedule(1.0, lambda: fired.append(1))
+        wheel.schedule(3.0, lambda: fired.append(3))
+        clock.advance(5.0)
+        assert fired == [1, 3]
+        # A timer that is already due fires on the next tick.
+        wheel.schedule(2.0, lambda: fired.append(2))
+        clock.advance(0.5)
+        assert fired == [1, 3]
+        clock.advance(0.5)
+        assert fired == [1, 3, 2]
@@ -18,7 +18,20 @@
 # You should have received a copy of the GNU General Public License
 # along with Secant.  If not, see <http://www.gnu.org/licenses/>.
 
+import binascii
+import json
+
+import scrypt
+
+from twisted.internet import defer
+from twisted.internet.task import Clock
+from twisted.python import failure
+
+from secant import cache
+from secant import config
+from secant import etcd
 from secant.users import *
+from secant.test import Settings
 
 class TestUser:
     def test_1(self):
@@ -32,3 +45,141 @@ class TestUser:
 
     def test_4(self):
         assert not User('test', 'test123', '321test').check_enable_password('test123')
+
+class ImmediateReactor:
+    def callFromThread(self, f, *a, **kw):
+        f(*a, **kw)
+
+    def addSystemEventTrigger(self, *a, **kw):
+        pass
+
+class ImmediatePool:
+    def callInThreadWithCallback(self, onResult, f, *a, **kw):
+        try:
+            result = f(*a, **kw)
+        except Exception:
+            onResult(False, failure.Failure())
+        else:
+            onResult(True, result)
+
+def hash_password(password):
+    salt = b'0123456789abcdef'
+    return {'salt': binascii.hexlify(salt).decode('ascii'),
+            'hash': binascii.hexlify(scrypt.hash(password, salt)).decode('ascii')}
+
+class TestHashPool:
+    def setup_method(self, method):
+        self.saved = hash_pool.__dict__.copy()
+        hash_pool.reactor = ImmediateReactor()
+        hash_pool.pool = ImmediatePool()
+
+    def teardown_method(self, method):
+        hash_pool.__dict__.update(self.saved)
+
+    def check(self, user, password_type, password):
+        result = []
+        user.check_password(password_type, password).addBoth(result.append)
+        return result[0]
+
+    def test_1(self):
+        user = User('test', passwords = {'login': hash_password('test123')})
+        assert self.check(user, 'login', 'test123') is True
+        assert self.check(user, 'login', '321test') is False
+        assert hash_pool.completed == 2
+        assert hash_pool.pending == 0
+
+    def test_2(self):
+        user = User('test', passwords = {'login': hash_password('test123')})
+        assert self.check(user, 'enable', 'test123') is True
+
+    def test_3(self):
+        user = User('test', passwords = {'login': hash_password('test123')})
+        with Settings(hash_queue_limit = 0):
+            result = self.check(user, 'login', 'test123')
+        assert result.check(HashPoolBusy)
+        assert hash_pool.rejected == 1
+
+class ScriptedEtcd:
+    def __init__(self):
+        self.gets = []
+        self.watches = []
+
+    def get(self, key, recursive = False):
+        d = defer.Deferred()
+        self.gets.append((key, d))
+        return d
+
+    def watch(self, key, index = None, recursive = False):
+        d = defer.Deferred()
+        self.watches.append((index, d))
+        return d
+
+def passwords_node(username, index, password = 'test123'):
+    return {'key': '/secant/users/{}/passwords'.format(username),
+            'value': json.dumps({'login': hash_password(password)}),
+            'modifiedIndex': index}
+
+class TestUserCache:
+    def setup_method(self, method):
+        self.clock = Clock()
+        self.etcd = ScriptedEtcd()
+        self.cache = UserCache(reactor = self.clock, client = self.etcd)
+        self.cache.start()
+        key, d = self.etcd.gets.pop()
+        assert key == '/secant/users'
+        d.callback(etcd.EtcdResponse(action = 'get', index = 7, node = {
+            'key': '/secant/users', 'dir': True,
+            'nodes': [{'key': '/secant/users/alice', 'dir': True, 'nodes': [passwords_node('alice', 3)]},
+                      {'key': '/secant/users/bob', 'dir': True, 'nodes': [passwords_node('bob', 5)]}]}))
+
+    def test_1(self):
+        assert self.cache.lookup('alice').passwords_index == 3
+        assert self.cache.lookup('bob').username == 'bob'
+        assert self.cache.lookup('carol') is UserCache.missing
+        assert self.etcd.watches[0][0] == 8
+
+    def test_2(self):
+        index, d = self.etcd.watches.pop()
+        d.callback(etcd.EtcdResponse(action = 'set', node = passwords_node('alice', 9, 'changed')))
+        assert self.cache.lookup('alice').passwords_index == 9
+        assert self.etcd.watches[0][0] == 10
+
+        index, d = self.etcd.watches.pop()
+        d.callback(etcd.EtcdResponse(action = 'delete', node = {'key': '/secant/users/bob/passwords', 'modifiedIndex': 10}))
+        assert self.cache.lookup('bob') is UserCache.missing
+        assert self.cache.invalidations == 2
+
+    def test_3(self):
+        self.cache.store(User('alice', passwords_index = 2))
+        assert self.cache.lookup('alice').passwords_index == 3
+
+    def test_4(self):
+        self.cache.store_unknown('mallory')
+        assert self.cache.lookup('mallory') is None
+        self.clock.advance(config.settings['user_cache_negative_ttl'])
+        assert self.cache.lookup('mallory') is UserCache.missing
+
+    def test_5(self):
+        index, d = self.etcd.watches.pop()
+        d.errback(etcd.EtcdError(errorCode = 401, message = 'The event in requested index is outdated and cleared'))
+        assert self.etcd.gets[0][0] == '/secant/users'
+
+class TestFindUser:
+    def setup_method(self, method):
+        self.saved = user_cache.cache
+        user_cache.cache = cache.LRUCache(10, 10, clock = Clock())
+
+    def teardown_method(self, method):
+        user_cache.cache = self.saved
+
+    def test_1(self):
+        user_cache.store(User('alice', passwords_index = 1))
+        result = []
+        find_user('alice').addBoth(result.append)
+        assert result[0].username == 'alice'
+
+    def test_2(self):
+        user_cache.store_unknown('mallory')
+        result = []
+        find_user('mallory').addBoth(result.append)
+        assert result[0].check(UnknownUser)
@@ -0,0 +1,189 @@
+# -*- mode: python; coding: utf-8 -*-
+
+# Copyright © 2008,2010 by Jeffrey C. Ollie
+#
+# This file is part of Secant.
+#
+# Secant is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Secant is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Secant.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+import signal
+
+from twisted.internet import error
+from twisted.internet.task import Clock
+from twisted.python import failure
+
+from secant import TacacsProtocolFactory
+from secant import metrics
+from secant.test import Settings
+from secant.workers import *
+
+class FakeProcessTransport:
+    def __init__(self):
+        self.signals = []
+
+    def signalProcess(self, name):
+        self.signals.append(name)
+
+class FakeReactor(Clock):
+    def __init__(self):
+        Clock.__init__(self)
+        self.spawned = []
+
+    def spawnProcess(self, process, executable, args, env = None, childFDs = None):
+        process.transport = FakeProcessTransport()
+        self.spawned.append((process, args, childFDs))
+
+    def callFromThread(self, f, *a, **kw):
+        f(*a, **kw)
+
+class FakeTransport:
+    def __init__(self, factory, connection):
+        self.factory = factory
+        self.connection = connection
+        self.aborted = False
+
+    def loseConnection(self):
+        self.factory.connections.discard(self.connection)
+
+    def abortConnection(self):
+        self.aborted = True
+        self.factory.connections.discard(self.connection)
+
+class FakeConnection:
+    def __init__(self, factory, busy):
+        self.inflight = {1: None} if busy else {}
+        self.backlog = {}
+        self.transport = FakeTransport(factory, self)
+        factory.connections.add(self)
+
+def end(process):
+    process.processEnded(failure.Failure(error.ProcessTerminated(signal = signal.SIGTERM)))
+
+def report(process, message):
+    process.childDataReceived(3, json.dumps(message).encode('utf-8') + b'\n')
+
+class TestMergeStats:
+    def test_1(self):
+        reports = [{'reload': {'generation': 3, 'reloads': 1}, 'hash_pool': {'completed': 10, 'queue_wait_seconds': 0.5}},
+                   {'reload': {'generation': 3, 'reloads': 2}, 'hash_pool': {'completed': 5, 'queue_wait_seconds': 0.25}}]
+        assert merge_stats(reports) == {'reload': {'reloads': 3},
+                                        'hash_pool': {'completed': 15, 'queue_wait_seconds': 0.75}}
+
+class TestWorker:
+    def test_1(self):
+        clock = Clock()
+        worker = Worker(clock)
+        idle = FakeConnection(worker.factory, busy = False)
+        busy = FakeConnection(worker.factory, busy = True)
+        result = []
+        worker.drain(clock.seconds() + 1.0).addCallback(result.append)
+        # Idle connections are closed straight away.
+        assert worker.factory.connections == {busy}
+        clock.advance(0.5)
+        busy.inflight.clear()
+        clock.advance(0.1)
+        assert result == [None]
+        assert not busy.transport.aborted
+
+    def test_2(self):
+        clock = Clock()
+        worker = Worker(clock)
+        busy = FakeConnection(worker.factory, busy = True)
+        result = []
+        worker.drain(clock.seconds() + 1.0).addCallback(result.append)
+        clock.pump([0.1] * 11)
+        assert result == [None]
+        assert busy.transport.aborted
+
+class TestSupervisor:
+    def start(self):
+        reactor = FakeReactor()
+        supervisor = Supervisor(reactor, count = 2)
+        saved = [signal.getsignal(signal.SIGHUP), signal.getsignal(signal.SIGUSR1)]
+        try:
+            with Settings(worker_reuseport = True):
+                supervisor.startService()
+        finally:
+            signal.signal(signal.SIGHUP, saved[0])
+            signal.signal(signal.SIGUSR1, saved[1])
+        return reactor, supervisor
+
+    def test_1(self):
+        reactor, supervisor = self.start()
+        assert [args[args.index('--index') + 1] for process, args, fds in reactor.spawned] == ['0', '1']
+        assert all('--listen-fd' not in args for process, args, fds in reactor.spawned)
+        first, second = [process for process, args, fds in reactor.spawned]
+        report(first, {'ready': True})
+        report(second, {'ready': True})
+
+        supervisor.restart()
+        assert first.transport.signals == ['TERM']
+        assert second.transport.signals == []
+        end(first)
+        replacement = reactor.spawned[-1][0]
+        assert supervisor.workers[0] is replacement
+        # The next worker is only replaced once the new one is ready.
+        assert second.transport.signals == []
+        report(replacement, {'ready': True})
+        assert second.transport.signals == ['TERM']
+        end(second)
+        report(reactor.spawned[-1][0], {'ready': True})
+        assert supervisor.restart_queue is None
+        assert supervisor.stats['supervisor']['restarts'] == 2
+        assert supervisor.stats['supervisor']['ready'] == 2
+
+    def test_2(self):
+        reactor, supervisor = self.start()
+        first = supervisor.workers[0]
+        end(first)
+        assert 0 not in supervisor.workers
+        with Settings(worker_respawn_delay = 1.0):
+            reactor.advance(1.0)
+        assert supervisor.workers[0] is not first
+        assert supervisor.respawns == 1
+
+    def test_3(self):
+        reactor, supervisor = self.start()
+        report(supervisor.workers[0], {'stats': {'accounting': {'committed': 3}}})
+        report(supervisor.workers[1], {'stats': {'accounting': {'committed': 4}}})
+        assert supervisor.stats['total'] == {'accounting': {'committed': 7}}
+
+        supervisor.signalWorkers('HUP')
+        assert supervisor.workers[0].transport.signals == ['HUP']
+
+        result = []
+        supervisor.stopService().addCallback(result.append)
+        workers = list(supervisor.workers.values())
+        for process in workers:
+            assert process.transport.signals[-1] == 'TERM'
+            end(process)
+        assert result
+        # Nothing is started again while stopping.
+        reactor.advance(10)
+        assert supervisor.workers == {}
+
+    def test_4(self):
+        reactor, supervisor = self.start()
+        report(supervisor.workers[0], {'stats': {'accounting': {'committed': 3}},
+                                       'metrics': [{'name': 'secant_sessions_total',
+                                                    'kind': 'counter',
+                                                    'help': 'Sessions started.',
+                                                    'labels': ['type'],
+                                                    'samples': [[['accounting'], 5]]}]})
+        lines = metrics.render(supervisor.collectMetrics()).splitlines()
+        assert 'secant_sessions_total{worker="0",type="accounting"} 5' in lines
+        assert 'secant_accounting_committed{worker="0"} 3' in lines
+        assert 'secant_supervisor_workers 2' in lines
@@ -0,0 +1,108 @@
+# -*- mode: python; coding: utf-8 -*-
+
+# Copyright © 2008,2010 by Jeffrey C. Ollie
+#
+# This file is part of Secant.
+#
+# Secant is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Secant is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Secant.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from twisted.logger import Logger
+
+import math
+
+class Timer:
+    __slots__ = ['deadline', 'function', 'slot']
+
+    def __init__(self, deadline, function):
+        self.deadline = deadline
+        self.function = function
+        self.slot = None
+
+class TimerWheel:
+    """Coarse timers shared by every connection.
+
+    Timers are hashed by deadline into a ring of slots, each covering
+    resolution seconds.  A single reactor call runs once per slot,
+    while there are timers, and calls the functions of the timers in
+    that slot that have come due.  A timer more than one revolution
+    away stays in its slot until the ring comes round to it again.
+    Adding or cancelling a timer doesn't touch the reactor, so it costs
+    the same with a hundred thousand connections as with one.
+
+    Timers fire up to resolution seconds late, never early.
+    """
+
+    log = Logger()
+
+    def __init__(self, resolution = 1.0, size = 256, clock = None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+        self.resolution = resolution
+        self.slots = [set() for i in range(size)]
+        self.count = 0
+        self.tick = None
+        self.call = None
+
+    def __len__(self):
+        return self.count
+
+    def slot_for(self, tick):
+        return self.slots[tick % len(self.slots)]
+
+    def schedule(self, deadline, function):
+        """Call function() at or shortly after deadline.  Returns the
+        Timer, which can be passed to cancel()."""
+        self.start()
+        timer = Timer(deadline, function)
+        tick = max(math.ceil(deadline / self.resolution), self.tick + 1)
+        timer.slot = self.slot_for(tick)
+        timer.slot.add(timer)
+        self.count += 1
+        return timer
+
+    def cancel(self, timer):
+        if timer.slot is not None:
+            timer.slot.discard(timer)
+            timer.slot = None
+            self.count -= 1
+
+    def start(self):
+        if self.call is None:
+            if self.tick is None:
+                self.tick = math.floor(self.clock.seconds() / self.resolution)
+            self.call = self.clock.callLater(max(0, (self.tick + 1) * self.resolution - self.clock.seconds()), self.advance)
+
+    def advance(self):
+        self.call = None
+        now = self.clock.seconds()
+
+        # Run every slot up to now, the reactor may have been late.
+        while (self.tick + 1) * self.resolution <= now and self.count:
+            self.tick += 1
+            slot = self.slot_for(self.tick)
+            for timer in [timer for timer in slot if timer.deadline <= now]:
+                self.cancel(timer)
+                try:
+                    timer.function()
+                except Exception:
+                    self.log.failure('Error running timer.')
+
+        if self.count:
+            self.start()
+        else:
+            self.tick = None
+
+wheel = TimerWheel()
@@ -19,20 +19,98 @@
 # along with Secant.  If not, see <http://www.gnu.org/licenses/>.
 
 from secant import config
+from secant import etcd
+from secant import cache
+from secant import metrics
 
 from twisted.internet import reactor
 from twisted.logger import Logger
 from twisted.internet import defer
+from twisted.internet import threads
+from twisted.python.threadpool import ThreadPool
 from twisted.web import error
 
-from txetcd.client import EtcdClient
-
 import os
 import time
 import scrypt
 import binascii
+import hmac
 import json
 
+class HashPoolBusy(Exception):
+    pass
+
+class HashPool:
+    """Runs scrypt on a dedicated pool of threads so that password
+    checks do not block the reactor.  If more than hash_queue_limit
+    hashes are already waiting or running, new requests fail
+    immediately with HashPoolBusy instead of queueing up behind them.
+    """
+
+    log = Logger()
+
+    def __init__(self, reactor = reactor):
+        self.reactor = reactor
+        self.pool = None
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.queue_wait = 0.0
+        self.hash_time = 0.0
+
+    def start(self):
+        self.pool = ThreadPool(minthreads = 0,
+                               maxthreads = config.settings['hash_workers'],
+                               name = 'secant-scrypt')
+        self.pool.start()
+        self.reactor.addSystemEventTrigger('during', 'shutdown', self.stop)
+
+    def stop(self):
+        if self.pool is not None:
+            self.pool.stop()
+            self.pool = None
+
+    def hash(self, password, salt):
+        if self.pending >= config.settings['hash_queue_limit']:
+            self.log.info('Too many password hashes waiting, rejecting request.')
+            self.rejected += 1
+            return defer.fail(HashPoolBusy())
+
+        if self.pool is None:
+            self.start()
+
+        self.pending += 1
+        d = threads.deferToThreadPool(self.reactor, self.pool, self.run, password, salt, time.monotonic())
+        d.addBoth(self.finished)
+        return d
+
+    def run(self, password, salt, queued):
+        started = time.monotonic()
+        result = scrypt.hash(password, salt)
+        return result, started - queued, time.monotonic() - started
+
+    def finished(self, result):
+        self.pending -= 1
+        if isinstance(result, tuple):
+            result, queue_wait, hash_time = result
+            self.completed += 1
+            self.queue_wait += queue_wait
+            self.hash_time += hash_time
+            if metrics.enabled:
+                metrics.stage_seconds.observe(queue_wait, 'hash_queue')
+                metrics.stage_seconds.observe(hash_time, 'hash')
+        return result
+
+    @property
+    def stats(self):
+        return {'pending': self.pending,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'queue_wait_seconds': self.queue_wait,
+                'hash_seconds': self.hash_time}
+
+hash_pool = HashPool()
+
 class User:
     log = Logger()
 
@@ -53,49 +131,59 @@ class User:
         current_password_salt = binascii.unhexlify(self.passwords.get(password_type, {}).get('salt', ''))
         current_password_hash = binascii.unhexlify(self.passwords.get(password_type, {}).get('hash', ''))
 
-        if (current_password_salt == '' or current_password_hash == '') and password_type == 'enable':
+        if (not current_password_salt or not current_password_hash) and password_type == 'enable':
             self.log.debug('User "{u:}" does not have an enable password, falling back to login password', u = self.username)
             current_password_salt = binascii.unhexlify(self.passwords.get('login', {}).get('salt', ''))
             current_password_hash = binascii.unhexlify(self.passwords.get('login', {}).get('hash', ''))
 
-        if current_password_salt == '' and current_password_hash == '':
+        if not current_password_salt and not current_password_hash:
             self.log.debug('Authentication failed for user "{u:}" because the user does not have a password set in the database',
                            u = self.username)
             return defer.succeed(False)
 
-        supplied_password_hash = scrypt.hash(supplied_password, current_password_salt)
-        
-        if current_password_hash == supplied_password_hash:
+        d = hash_pool.hash(supplied_password, current_password_salt)
+        d.addCallback(self.check_password_1, current_password_hash)
+        return d
+
+    def check_password_1(self, supplied_password_hash, current_password_hash):
+        if hmac.compare_digest(current_password_hash, supplied_password_hash):
             self.log.debug('Authentication for user {u:} succeeded.', u = self.username)
-            return defer.succeed(True)
+            return True
 
         else:
             self.log.debug('Authentication for user {u:} failed.', u = self.username)
-            return defer.succeed(False)
+            return False
 
     def change_password(self, password_type, old_supplied_password, new_supplied_password):
         finished = defer.Deferred()
         d = self.check_password(password_type, old_supplied_password)
         d.addCallback(self.change_password_1, password_type, new_supplied_password, finished)
+        d.addErrback(finished.errback)
         return finished
     
     def change_password_1(self, result, password_type, new_supplied_password, finished):
         if not result:
             self.log.debug('Not changing password because old password does not match!')
             finished.callback(False)
+            return
 
         new_supplied_password_salt = open('/dev/urandom', 'rb').read(64)
-        new_supplied_password_hash = scrypt.hash(new_supplied_password, new_supplied_password_hash)
+        d = hash_pool.hash(new_supplied_password, new_supplied_password_salt)
+        d.addCallback(self.change_password_2, password_type, new_supplied_password_salt, finished)
+        d.addErrback(finished.errback)
+
+    def change_password_2(self, new_supplied_password_hash, password_type, new_supplied_password_salt, finished):
         self.passwords[password_type]['salt'] = binascii.hexlify(new_supplied_password_salt).decode('ascii')
         self.passwords[password_type]['hash'] = binascii.hexlify(new_supplied_password_hash).decode('ascii')
         value = json.dumps(self.passwords).encode('utf-8')
         
-        d = self.client.set('/secant/users/{}/passwords'.format(self.username),
-                            value = value,
-                            prev_index = self.passwords_index)
-        d.addCallback(self.change_password_2, finished)
+        d = etcd.get_client().set('/secant/users/{}/passwords'.format(self.username),
+                                  value = value,
+                                  prev_index = self.passwords_index)
+        d.addCallback(self.change_password_3, finished)
+        d.addErrback(finished.errback)
     
-    def change_password_2(self, result, finished):
+    def change_password_3(self, result, finished):
         finished.callback(True)
         
 class AlwaysFailUser(User):
@@ -115,23 +203,211 @@ class AlwaysSucceedUser(User):
 #def find_user(username):
 #    return defer.succeed(AlwaysSucceedUser(username))
 
+class UnknownUser(Exception):
+    pass
+
+users_prefix = '/secant/users'
+
+def user_from_node(username, node):
+    return User(username = username,
+                passwords = json.loads(node.value),
+                passwords_index = node.modifiedIndex)
+
+class UserCache:
+    """In-memory cache of user records in front of etcd.
+
+    start() loads every user with one recursive GET of /secant/users
+    and then watches that prefix, using the modifiedIndex of each
+    change to pick up where the last watch left off, so that entries
+    are replaced or dropped as soon as they change in etcd.  Entries
+    also expire after user_cache_ttl seconds in case a change is
+    missed, and the cache holds at most user_cache_size users.
+    Usernames that etcd doesn't know about are remembered for
+    user_cache_negative_ttl seconds so that repeated attempts with a
+    bad username don't each cost a round trip.
+
+    Functions in listeners are called with the username whenever a
+    user changes in etcd, or with None when every user was reloaded,
+    so that anything derived from user records can be thrown away.
+    """
+
+    log = Logger()
+
+    missing = object()
+
+    def __init__(self, reactor = reactor, client = None):
+        self.reactor = reactor
+        self.client = client
+        self.running = False
+        self.watch_deferred = None
+        self.watch_index = None
+        self.invalidations = 0
+        self.listeners = []
+        self.configure()
+
+    def configure(self):
+        self.cache = cache.LRUCache(maxsize = config.settings['user_cache_size'],
+                                    ttl = config.settings['user_cache_ttl'],
+                                    clock = self.reactor)
+
+    def etcd(self):
+        if self.client is None:
+            return etcd.get_client()
+        return self.client
+
+    def lookup(self, username):
+        """Return the cached User, None if the user is known not to
+        exist, or UserCache.missing if we have to ask etcd."""
+        return self.cache.get(username, self.missing)
+
+    def cached_index(self, username):
+        """Return the modifiedIndex of the record cached for username,
+        or None if there isn't one.  Doesn't count as a lookup."""
+        if username not in self.cache:
+            return None
+        user = self.cache.entries[username][0]
+        if user is None:
+            return None
+        return user.passwords_index
+
+    def store(self, user):
+        # Don't let a slow lookup overwrite a newer record that came in
+        # through the watch.
+        entry = self.cache.entries.get(user.username)
+        if entry is not None and entry[0] is not None and entry[0].passwords_index is not None:
+            if user.passwords_index is not None and user.passwords_index < entry[0].passwords_index:
+                return
+        self.cache.set(user.username, user)
+
+    def store_unknown(self, username):
+        self.cache.set(username, None, ttl = config.settings['user_cache_negative_ttl'])
+
+    def start(self):
+        self.configure()
+        self.running = True
+        return self.preload()
+
+    def stop(self):
+        self.running = False
+        if self.watch_deferred is not None:
+            self.watch_deferred.cancel()
+            self.watch_deferred = None
+
+    def preload(self):
+        d = self.etcd().get(users_prefix, recursive = True)
+        d.addCallbacks(self.preloaded, self.preloadFailed)
+        return d
+
+    def preloaded(self, response):
+        self.cache.clear()
+        last_index = 0
+        for user_node in response.node.nodes:
+            username = user_node.key[len(users_prefix) + 1:]
+            for node in user_node.nodes:
+                if node.key == user_node.key + '/passwords':
+                    self.store(user_from_node(username, node))
+                    last_index = max(last_index, node.modifiedIndex or 0)
+
+        self.log.info('Loaded {count:} users from etcd.', count = len(self.cache))
+        self.notify(None)
+
+        if response.index is not None:
+            last_index = response.index
+        self.watch(last_index + 1)
+
+    def preloadFailed(self, failure):
+        if failure.check(etcd.EtcdError) and failure.value.code == 100:
+            self.log.info('No users in etcd yet.')
+            self.watch(failure.value.index + 1)
+            return
+
+        self.log.failure('Unable to load users from etcd, trying again.', failure)
+        if self.running:
+            self.reactor.callLater(config.settings['user_cache_retry_delay'], self.preload)
+
+    def watch(self, index):
+        if not self.running or not config.settings['user_cache_watch']:
+            return
+        self.watch_index = index
+        self.watch_deferred = self.etcd().watch(users_prefix, index = index, recursive = True)
+        self.watch_deferred.addCallbacks(self.changed, self.watchFailed)
+
+    def changed(self, response):
+        self.watch_deferred = None
+        node = response.node
+        username, _, rest = node.key[len(users_prefix) + 1:].partition('/')
+
+        if rest == 'passwords' and node.value is not None and response.action not in ['delete', 'expire']:
+            self.log.debug('User {u:} changed, updating cache.', u = username)
+            self.cache.pop(username)
+            self.store(user_from_node(username, node))
+
+        else:
+            self.log.debug('User {u:} changed, dropping from cache.', u = username)
+            self.cache.pop(username)
+
+        self.invalidations += 1
+        self.notify(username)
+        self.watch(node.modifiedIndex + 1)
+
+    def notify(self, username):
+        for listener in self.listeners:
+            listener(username)
+
+    def watchFailed(self, failure):
+        self.watch_deferred = None
+        if not self.running:
+            return
+
+        # etcd only remembers the last 1000 events, if we fell further
+        # behind than that start over from a full load.
+        if failure.check(etcd.EtcdError) and failure.value.code == 401:
+            self.log.info('Missed too many changes to users, reloading.')
+            self.preload()
+            return
+
+        self.log.failure('Error watching users, trying again.', failure)
+        self.reactor.callLater(config.settings['user_cache_retry_delay'], self.watch, self.watch_index)
+
+    @property
+    def stats(self):
+        stats = self.cache.stats
+        stats['invalidations'] = self.invalidations
+        return stats
+
+user_cache = UserCache()
+
 class find_user(defer.Deferred):
     log = Logger()
 
     def __init__(self, username):
         defer.Deferred.__init__(self)
-        self.log.debug('looking for user: {u:}', u = username)
         self.username = username
-        self.client = EtcdClient(reactor)
-        d = self.client.get('/secant/users/{}/passwords'.format(self.username))
+        if metrics.enabled:
+            metrics.time_deferred(self, 'find_user')
+
+        user = user_cache.lookup(username)
+        if user is None:
+            self.log.debug('user {u:} is known not to exist', u = username)
+            self.errback(UnknownUser(username))
+            return
+
+        if user is not UserCache.missing:
+            self.callback(user)
+            return
+
+        self.log.debug('looking for user: {u:}', u = username)
+        d = etcd.get_client().get('{}/{}/passwords'.format(users_prefix, self.username))
         d.addCallbacks(self.gotResponse, self.errResponse)
         
     def gotResponse(self, response):
-        passwords = json.loads(response.node.value)
-        passwords_index = response.node.modifiedIndex
-        self.callback(User(username = self.username,
-                           passwords = passwords,
-                           passwords_index = response.node.modifiedIndex))
+        user = user_from_node(self.username, response.node)
+        user_cache.store(user)
+        self.callback(user)
 
     def errResponse(self, failure):
+        if failure.check(etcd.EtcdError) and failure.value.code == 100:
+            user_cache.store_unknown(self.username)
+            self.errback(UnknownUser(self.username))
+            return
         self.errback(failure)
@@ -0,0 +1,449 @@
+# -*- mode: python; coding: utf-8 -*-
+
+# Copyright © 2008,2010 by Jeffrey C. Ollie
+#
+# This file is part of Secant.
+#
+# Secant is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Secant is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Secant.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from twisted.application import service
+from twisted.internet import defer
+from twisted.internet import error
+from twisted.internet import protocol
+from twisted.internet import task
+from twisted.logger import Logger
+
+import argparse
+import json
+import os
+import signal
+import socket
+import sys
+
+import secant
+from secant import admission
+from secant import aio
+from secant import config
+from secant import etcd
+from secant import framing
+from secant import metrics
+from secant import packet
+from secant import reload
+from secant import spool
+from secant import users
+from secant import TacacsProtocolFactory
+from secant.session import authorization
+from secant.session import table
+
+def listen_socket(address, port, reuseport = False):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuseport:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((address, port))
+    sock.listen(1024)
+    sock.setblocking(False)
+    return sock
+
+def collect_stats(worker = None):
+    """Gather the counters kept by the different parts of the server."""
+    stats = {'admission': admission.control.stats,
+             'hash_pool': users.hash_pool.stats,
+             'user_cache': users.user_cache.stats,
+             'sessions': table.registry.stats,
+             'pad_cache': packet.pad_cache.stats,
+             'arenas': framing.arenas.stats,
+             'accounting': spool.sink.stats,
+             'authorization_cache': authorization.decisions.stats}
+    if etcd.client is not None:
+        stats['etcd'] = etcd.client.stats
+    if worker is not None:
+        stats['reload'] = worker.reloader.stats
+        stats['worker'] = {'connections': len(worker.factory.connections)}
+        stats['dropped'] = dict(worker.factory.dropped)
+    return stats
+
+# Numbers that describe one process and make no sense added up.
+unsummed = ['generation', 'segment', 'offset', 'hit_ratio']
+
+def merge_stats(reports):
+    """Add up the stats reported by several workers."""
+    total = {}
+    for stats in reports:
+        for section, values in stats.items():
+            merged = total.setdefault(section, {})
+            for key, value in values.items():
+                if key not in unsummed and isinstance(value, (int, float)):
+                    merged[key] = merged.get(key, 0) + value
+    return total
+
+class Worker(service.Service):
+    """Accepts and handles TACACS+ connections.  This is the whole
+    server when there is a single process, otherwise each worker
+    process started by the Supervisor runs one.
+
+    Stopping a worker stops it accepting connections, closes the ones
+    that have nothing outstanding and waits up to worker_drain_timeout
+    seconds for the rest to finish before closing them too.
+
+    With the twisted core connections are accepted by the reactor,
+    with the asyncio core (which needs the asyncio reactor) they are
+    accepted by the asyncio event loop, see secant.aio.
+    """
+
+    log = Logger()
+
+    def __init__(self, reactor, index = None, listen_fd = None, status_fd = None, core = 'twisted'):
+        self.reactor = reactor
+        self.index = index
+        self.listen_fd = listen_fd
+        self.status_fd = status_fd
+        self.core = core
+        self.factory = TacacsProtocolFactory()
+        self.reloader = reload.Reloader(reactor)
+        self.port = None
+        self.reporter = None
+        self.metrics_port = None
+
+    def privilegedStartService(self):
+        service.Service.privilegedStartService(self)
+        if self.listen_fd is None:
+            sock = listen_socket(config.settings['listen_address'],
+                                 config.settings['listen_port'],
+                                 reuseport = self.index is not None and config.settings['worker_reuseport'])
+        else:
+            sock = socket.socket(fileno = self.listen_fd)
+
+        if self.core == 'twisted':
+            self.port = self.reactor.adoptStreamPort(sock.fileno(), socket.AF_INET, self.factory)
+            sock.close()
+        else:
+            # The asyncio server owns the socket from now on.
+            self.port = aio.Port(sock, self.factory)
+
+    def startService(self):
+        if self.port is None:
+            self.privilegedStartService()
+        service.Service.startService(self)
+
+        self.reloader.start()
+        users.user_cache.start()
+
+        directory = config.settings['accounting_spool']
+        if self.index is not None:
+            directory = os.path.join(directory, 'worker%d' % self.index)
+        spool.start(self.reactor, directory = directory)
+
+        if config.settings['metrics_port']:
+            self.registerGauges()
+            if self.index is None:
+                self.metrics_port = metrics.listen(self.reactor, self.collectMetrics)
+            else:
+                # The supervisor serves the metrics of every worker.
+                metrics.enable()
+
+        if self.status_fd is not None:
+            self.report({'ready': True})
+            self.reporter = task.LoopingCall(self.reportStats)
+            self.reporter.clock = self.reactor
+            self.reporter.start(config.settings['worker_stats_interval'], now = False)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        self.log.info('Stopping, waiting for {count:} connections to finish.',
+                      count = len(self.factory.connections))
+        if self.reporter is not None and self.reporter.running:
+            self.reporter.stop()
+        self.reloader.stop()
+        if self.metrics_port is not None:
+            self.metrics_port.stopListening()
+            self.metrics_port = None
+
+        d = defer.maybeDeferred(self.port.stopListening)
+        d.addCallback(lambda ignored: self.drain(self.reactor.seconds() + config.settings['worker_drain_timeout']))
+        return d
+
+    def drain(self, deadline):
+        for connection in list(self.factory.connections):
+            if not connection.inflight and not connection.backlog:
+                connection.transport.loseConnection()
+
+        if not self.factory.connections:
+            return
+
+        if self.reactor.seconds() >= deadline:
+            self.log.warn('Closing {count:} connections that did not finish in time.',
+                          count = len(self.factory.connections))
+            for connection in list(self.factory.connections):
+                connection.transport.abortConnection()
+            return
+
+        return task.deferLater(self.reactor, 0.1, self.drain, deadline)
+
+    def report(self, message):
+        try:
+            os.write(self.status_fd, json.dumps(message).encode('utf-8') + b'\n')
+        except OSError:
+            self.log.error('Lost contact with the supervisor, stopping.')
+            self.status_fd = None
+            self.reactor.stop()
+
+    def reportStats(self):
+        message = {'stats': collect_stats(self)}
+        if metrics.enabled:
+            message['metrics'] = metrics.registry.collect()
+        self.report(message)
+
+    def registerGauges(self):
+        connections = self.factory.connections
+        metrics.registry.gauge('secant_open_connections',
+                               'Connections that are open now.',
+                               lambda: len(connections))
+        metrics.registry.gauge('secant_buffered_bytes',
+                               'Bytes received that have not been decoded yet.',
+                               lambda: sum(len(connection.frames) for connection in connections))
+        metrics.registry.gauge('secant_inflight_requests',
+                               'Requests waiting for their session handler to reply.',
+                               lambda: sum(len(connection.inflight) for connection in connections))
+        metrics.registry.gauge('secant_backlog_requests',
+                               'Requests waiting for an earlier request of the same session.',
+                               lambda: sum(connection.backlog_count for connection in connections))
+
+    def collectMetrics(self):
+        return metrics.registry.collect() + metrics.stats_families(collect_stats(self))
+
+class WorkerProcess(protocol.ProcessProtocol):
+    """The supervisor's end of one worker process.  The worker writes
+    one JSON message per line to its file descriptor 3."""
+
+    def __init__(self, supervisor, index):
+        self.supervisor = supervisor
+        self.index = index
+        self.buffer = b''
+        self.ready = False
+        self.replaced = False
+        self.stats = {}
+        self.metrics = []
+        self.ended = defer.Deferred()
+
+    def childDataReceived(self, childFD, data):
+        self.buffer += data
+        while b'\n' in self.buffer:
+            line, self.buffer = self.buffer.split(b'\n', 1)
+            self.supervisor.workerReported(self, json.loads(line))
+
+    def processEnded(self, reason):
+        self.supervisor.workerEnded(self, reason)
+        self.ended.callback(None)
+
+    def signal(self, name):
+        try:
+            self.transport.signalProcess(name)
+        except error.ProcessExitedAlready:
+            pass
+
+class Supervisor(service.Service):
+    """Runs a number of worker processes that share the work.
+
+    The listening socket is opened here and handed to every worker
+    unless worker_reuseport is set, in which case each worker opens
+    its own and the kernel spreads connections between them.  Workers
+    that die are started again.  SIGHUP is passed on to the workers so
+    that they all reload their configuration, and SIGUSR1 replaces the
+    workers one at a time, starting the next only when the new one is
+    ready, so the server keeps accepting connections throughout.
+    """
+
+    log = Logger()
+
+    def __init__(self, reactor, count = None, command = None):
+        self.reactor = reactor
+        self.count = count
+        # How to start a worker, followed by the worker's arguments.
+        if command is None:
+            command = [sys.executable, '-m', 'secant.workers']
+        self.command = command
+        self.socket = None
+        self.workers = {}
+        self.restart_queue = None
+        self.restarting = None
+        self.respawns = 0
+        self.restarts = 0
+        self.metrics_port = None
+
+    def privilegedStartService(self):
+        service.Service.privilegedStartService(self)
+        if self.socket is None and not config.settings['worker_reuseport']:
+            self.socket = listen_socket(config.settings['listen_address'], config.settings['listen_port'])
+
+    def startService(self):
+        self.privilegedStartService()
+        service.Service.startService(self)
+
+        if self.count is None:
+            self.count = config.settings['workers']
+        for index in range(self.count):
+            self.spawn(index)
+
+        if config.settings['metrics_port']:
+            self.metrics_port = metrics.listen(self.reactor, self.collectMetrics)
+
+        signal.signal(signal.SIGHUP, self.signalled)
+        signal.signal(signal.SIGUSR1, self.signalled)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self.metrics_port is not None:
+            self.metrics_port.stopListening()
+            self.metrics_port = None
+        workers = list(self.workers.values())
+        for worker in workers:
+            worker.signal('TERM')
+        d = defer.gatherResults([worker.ended for worker in workers])
+        d.addCallback(self.stopped)
+        return d
+
+    def stopped(self, ignored):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+    def signalled(self, signum, frame):
+        if signum == signal.SIGHUP:
+            self.reactor.callFromThread(self.signalWorkers, 'HUP')
+        else:
+            self.reactor.callFromThread(self.restart)
+
+    def signalWorkers(self, name):
+        for worker in self.workers.values():
+            worker.signal(name)
+
+    def spawn(self, index):
+        worker = WorkerProcess(self, index)
+
+        args = self.command + ['--index', str(index)]
+        child_fds = {0: 0, 1: 1, 2: 2, 3: 'r'}
+        if self.socket is not None:
+            args += ['--listen-fd', '4']
+            child_fds[4] = self.socket.fileno()
+        args += config.current.config_paths
+
+        # Make sure the worker finds the same secant package.
+        env = dict(os.environ)
+        lib = os.path.dirname(os.path.dirname(os.path.abspath(secant.__file__)))
+        env['PYTHONPATH'] = os.pathsep.join([lib] + [path for path in env.get('PYTHONPATH', '').split(os.pathsep) if path])
+
+        self.reactor.spawnProcess(worker, args[0], args, env = env, childFDs = child_fds)
+        self.workers[index] = worker
+        self.log.info('Started worker {index:}.', index = index)
+        return worker
+
+    def respawn(self, index):
+        if self.running and index not in self.workers:
+            self.respawns += 1
+            self.spawn(index)
+
+    def workerReported(self, worker, message):
+        if message.get('ready'):
+            worker.ready = True
+            self.log.info('Worker {index:} is ready.', index = worker.index)
+            if self.restarting == worker.index:
+                self.restartNext()
+        if 'stats' in message:
+            worker.stats = message['stats']
+        if 'metrics' in message:
+            worker.metrics = message['metrics']
+
+    def workerEnded(self, worker, reason):
+        if self.workers.get(worker.index) is worker:
+            del self.workers[worker.index]
+
+        if not self.running:
+            return
+
+        if worker.replaced:
+            self.spawn(worker.index)
+        else:
+            self.log.error('Worker {index:} exited unexpectedly: {reason:}', index = worker.index, reason = reason.value)
+            self.reactor.callLater(config.settings['worker_respawn_delay'], self.respawn, worker.index)
+
+    def restart(self):
+        if self.restart_queue is not None:
+            self.log.info('Already replacing workers.')
+            return
+        self.log.info('Replacing workers.')
+        self.restart_queue = sorted(self.workers)
+        self.restartNext()
+
+    def restartNext(self):
+        if not self.restart_queue:
+            self.log.info('All workers replaced.')
+            self.restart_queue = None
+            self.restarting = None
+            return
+
+        self.restarting = self.restart_queue.pop(0)
+        worker = self.workers.get(self.restarting)
+        if worker is None:
+            self.restartNext()
+            return
+        self.restarts += 1
+        worker.replaced = True
+        worker.signal('TERM')
+
+    @property
+    def stats(self):
+        return {'supervisor': {'workers': len(self.workers),
+                               'ready': len([worker for worker in self.workers.values() if worker.ready]),
+                               'respawns': self.respawns,
+                               'restarts': self.restarts},
+                'total': merge_stats(worker.stats for worker in self.workers.values()),
+                'workers': {index: worker.stats for index, worker in self.workers.items()}}
+
+    def collectMetrics(self):
+        # Each worker's metrics are as of its last report, labelled
+        # with its index.
+        families = metrics.stats_families({'supervisor': self.stats['supervisor']})
+        for index, worker in sorted(self.workers.items()):
+            families += metrics.add_label(worker.metrics + metrics.stats_families(worker.stats), 'worker', str(index))
+        return families
+
+def main(argv = None, core = 'twisted'):
+    from twisted.internet import reactor
+    from twisted.logger import globalLogBeginner
+    from twisted.logger import textFileLogObserver
+
+    from secant import loglevel
+
+    parser = argparse.ArgumentParser(description = 'Secant worker process')
+    parser.add_argument('--index', type = int)
+    parser.add_argument('--listen-fd', type = int)
+    parser.add_argument('config_paths', nargs = '*')
+    options = parser.parse_args(argv)
+
+    globalLogBeginner.beginLoggingTo([loglevel.observer(textFileLogObserver(sys.stdout))])
+
+    config.load_config(options.config_paths)
+
+    worker = Worker(reactor, index = options.index, listen_fd = options.listen_fd, status_fd = 3, core = core)
+    reactor.callWhenRunning(worker.startService)
+    reactor.addSystemEventTrigger('before', 'shutdown', worker.stopService)
+    reactor.run()
+
+if __name__ == '__main__':
+    # Run main() from the secant.workers module rather than __main__ so
+    # that there is only one copy of everything.
+    from secant import workers
+    workers.main()
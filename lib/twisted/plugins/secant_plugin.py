@@ -17,18 +17,19 @@
 # You should have received a copy of the GNU General Public License
 # along with Secant.  If not, see <http://www.gnu.org/licenses/>.
 
-from zope.interface import implements
+from zope.interface import implementer
 
 from twisted.python import usage
 from twisted.plugin import IPlugin
 from twisted.application.service import IServiceMaker
-from twisted.application import internet
-from twisted.internet.protocol import Factory
+from twisted.application.service import MultiService
+from twisted.internet import reactor
+from twisted.logger import ILogObserver
+from twisted.logger import LegacyLogObserverWrapper
 
 from secant import config
-from secant import users
-from secant import clients
-from secant import TacacsProtocol
+from secant import loglevel
+from secant import workers
 
 class SecantOptions(usage.Options):
     def __init__(self):
@@ -38,8 +39,31 @@ class SecantOptions(usage.Options):
     def opt_config(self, path):
         self['config_paths'].append(path)
 
+class SecantService(MultiService):
+    """Runs the server under twistd.  twistd starts logging to the
+    observer the application provides, if there is one, so when this
+    is added to the application it provides the observer twistd would
+    have used anyway, behind the log_level filter that bin/server.py
+    and the workers use."""
+
+    def __init__(self, server, twistd_options):
+        MultiService.__init__(self)
+        server.setServiceParent(self)
+        self.twistd_options = twistd_options
+
+    def setServiceParent(self, parent):
+        MultiService.setServiceParent(self, parent)
+        if self.twistd_options is None:
+            return
+
+        from twisted.scripts import twistd
+        observer = twistd._SomeApplicationRunner.loggerFactory(self.twistd_options)._getLogObserver()
+        if not ILogObserver.providedBy(observer):
+            observer = LegacyLogObserverWrapper(observer)
+        parent.setComponent(ILogObserver, loglevel.observer(observer))
+
+@implementer(IServiceMaker, IPlugin)
 class SecantServiceMaker(object):
-    implements(IServiceMaker, IPlugin)
     tapname = "secant"
     description = "TACACS+ Server"
     options = SecantOptions
@@ -47,9 +71,11 @@ class SecantServiceMaker(object):
     def makeService(self, options):
         config.load_config(options['config_paths'])
 
-        factory = Factory()
-        factory.protocol = TacacsProtocol
+        if config.settings['workers'] > 1:
+            server = workers.Supervisor(reactor)
+        else:
+            server = workers.Worker(reactor)
 
-        return internet.TCPServer(49, factory)
+        return SecantService(server, getattr(options, 'parent', None))
 
 secantServiceMaker = SecantServiceMaker()